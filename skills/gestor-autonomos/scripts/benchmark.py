@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Benchmarks de los scripts de gestor-autonomos.
+
+Mide el rendimiento sobre datos sintéticos reproducibles (misma semilla →
+mismos datos):
+
+- fechas:    parsear_fecha frente al parser detectado de crear_parser_fechas
+- funciones: tiempo por llamada de parsear_importe, parsear_fecha y validar_nif
+- procesos:  filas/s y memoria máxima (RSS) de procesar_substack_stripe,
+             procesar_csv y generar_libro sobre CSVs generados
+- generar:   solo escribe los CSVs sintéticos (Stripe, Substack, facturas)
+
+Los resultados se pueden guardar en JSON (--guardar) y comparar con los de
+otra revisión (--comparar).
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from procesar_stripe import parsear_fecha, parsear_importe, crear_parser_fechas
+from procesar_facturas import validar_nif
+
+MESES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+         'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+def generar_fechas(filas: int, formato: str, semilla: int = 42) -> List[str]:
+    """
+    Genera fechas como las de una exportación real de un año.
+    substack: '02-Oct-25' (se repiten mucho)
+    stripe:   '2025-10-02 14:30:00' (casi todas distintas)
+    """
+    rnd = random.Random(semilla)
+    fechas = []
+    for _ in range(filas):
+        mes = rnd.randint(1, 12)
+        dia = rnd.randint(1, 28)
+        if formato == 'substack':
+            fechas.append(f"{dia:02d}-{MESES[mes - 1]}-25")
+        else:
+            fechas.append(f"2025-{mes:02d}-{dia:02d} {rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}")
+    return fechas
+
+def medir(funcion: Callable, valores: List[str]) -> float:
+    """Segundos que tarda `funcion` en recorrer todos los valores."""
+    inicio = time.perf_counter()
+    for valor in valores:
+        funcion(valor)
+    return time.perf_counter() - inicio
+
+def benchmark_fechas(filas: int, semilla: int = 42) -> Dict:
+    """
+    Compara parsear_fecha con el parser detectado + caché de crear_parser_fechas.
+    stripe_utc son las mismas fechas de Stripe leídas como UTC y pasadas al
+    día en Madrid (lo que hace 'Created (UTC)').
+    """
+    resultados = {}
+    for formato, utc in (('substack', False), ('stripe', False), ('stripe_utc', True)):
+        valores = generar_fechas(filas, formato, semilla)
+        parser = crear_parser_fechas(valores[:1000], utc=utc)
+        original = partial(parsear_fecha, utc=utc)
+
+        # Mismo resultado antes de medir
+        for valor in valores[:10000]:
+            assert parser(valor) == original(valor), valor
+
+        t_original = medir(original, valores)
+        t_nuevo = medir(parser, valores)
+        resultados[formato] = {
+            'filas': filas,
+            'parsear_fecha_s': round(t_original, 3),
+            'crear_parser_fechas_s': round(t_nuevo, 3),
+            'filas_por_s_original': int(filas / t_original),
+            'filas_por_s_nuevo': int(filas / t_nuevo),
+            'aceleracion': round(t_original / t_nuevo, 1),
+        }
+    return resultados
+
+# ---------------------------------------------------------------------------
+# Datos sintéticos
+# ---------------------------------------------------------------------------
+
+PAISES_UE = ['ES', 'ES', 'ES', 'FR', 'DE', 'IT', 'NL', 'PT', 'IE', 'BE']
+PAISES_NO_UE = ['US', 'US', 'GB', 'CA', 'MX', 'CL', 'AU', 'CH']
+PAISES_VACIOS = ['', '', 'null', 'N/A']
+MONEDAS = [('€', 'eur')] * 5 + [('$', 'usd')] * 3 + [('£', 'gbp'), ('CA$', 'cad')]
+PRECIOS = ['5.00', '6.00', '8.00', '10.00', '50.00', '60.00', '85.00', '100.00', '140.00', '7.50', '12.34']
+LETRAS_NIF = 'TRWAGMYFPDXBNJZSQVHLCKE'
+
+PROPORCION_ERRORES = 0.005
+VERSION_DATOS = 2      # Súbela al cambiar un generador: los CSVs guardados dejan de valer
+
+def _pais(rnd: random.Random) -> str:
+    r = rnd.random()
+    if r < 0.55:
+        return rnd.choice(PAISES_UE)
+    if r < 0.85:
+        return rnd.choice(PAISES_NO_UE)
+    return rnd.choice(PAISES_VACIOS)
+
+def filas_stripe(filas: int, semilla: int = 42, año: int = 2025, errores: float = PROPORCION_ERRORES):
+    """Exportación de pagos del Dashboard de Stripe: monedas y países mezclados, algunos vacíos."""
+    rnd = random.Random(semilla)
+    yield ['id', 'Amount', 'Currency', 'Created (UTC)', 'Customer Email', 'Stripe fee',
+           'country (billing)', 'Card Country']
+    for i in range(filas):
+        _, moneda = rnd.choice(MONEDAS)
+        importe = rnd.choice(PRECIOS)
+        fecha = (f"{año}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} "
+                 f"{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}")
+        email = f"u{rnd.randint(1, filas // 3 + 1)}@example.com" if rnd.random() > 0.03 else ''
+        fila = [f"ch_{semilla}_{i:09d}", importe, moneda, fecha, email, '0.50', _pais(rnd), _pais(rnd)]
+        if rnd.random() < errores:
+            # Filas raras: importe ilegible, más de 6 decimales o columnas de menos
+            tipo = rnd.randint(0, 2)
+            if tipo == 0:
+                fila[1] = 'N/A'
+            elif tipo == 1:
+                fila[1] = '1.1234567'
+            else:
+                fila = fila[:4]
+        yield fila
+
+def filas_substack(filas: int, semilla: int = 42, año: int = 2025, errores: float = PROPORCION_ERRORES):
+    """Exportación de pagos de Substack: importes con símbolo de moneda, fecha '02-Oct-25'."""
+    rnd = random.Random(semilla)
+    yield ['email', 'date', 'currency', 'amount', 'Substack fee', 'Stripe fee',
+           'country (ip)', 'country (billing)']
+    for _ in range(filas):
+        simbolo, moneda = rnd.choice(MONEDAS)
+        importe = rnd.choice(PRECIOS)
+        fecha = f"{rnd.randint(1, 28):02d}-{MESES[rnd.randint(0, 11)]}-{año % 100:02d}"
+        comision = f"{float(importe) * 0.1:.2f}"
+        fila = [f"user{rnd.randint(1, filas // 3 + 1)}@example.com", fecha, moneda, f"{simbolo}{importe}",
+                f"{simbolo}{comision}", f"{simbolo}0.{rnd.randint(10, 99)}", _pais(rnd), _pais(rnd)]
+        if rnd.random() < errores:
+            tipo = rnd.randint(0, 2)
+            if tipo == 0:
+                fila[3] = f"{simbolo}abc"
+            elif tipo == 1:
+                fila[1] = 'sin fecha'
+            else:
+                fila[4] = f"{simbolo}1.2345678"
+        yield fila
+
+def nif_aleatorio(rnd: random.Random) -> str:
+    """NIF, NIE o CIF; uno de cada veinte con la letra mal."""
+    r = rnd.random()
+    if r < 0.7:
+        numero = rnd.randint(0, 99999999)
+        nif = f"{numero:08d}{LETRAS_NIF[numero % 23]}"
+    elif r < 0.85:
+        inicial = rnd.choice('XYZ')
+        numero = rnd.randint(0, 9999999)
+        nif = f"{inicial}{numero:07d}{LETRAS_NIF[int('XYZ'.index(inicial) * 10 ** 7 + numero) % 23]}"
+    else:
+        nif = f"{rnd.choice('ABEGH')}{rnd.randint(0, 9999999):07d}{rnd.randint(0, 9)}"
+    if rnd.random() < 0.05:
+        nif = nif[:-1] + ('A' if nif[-1] != 'A' else 'B')
+    return nif
+
+def filas_facturas(filas: int, semilla: int = 42, año: int = 2025, errores: float = PROPORCION_ERRORES):
+    """Facturas (numero,fecha,nif,concepto,base_imponible,tipo_iva,tipo_retencion)."""
+    rnd = random.Random(semilla)
+    yield ['numero', 'fecha', 'nif', 'concepto', 'base_imponible', 'tipo_iva', 'tipo_retencion']
+    for i in range(filas):
+        base = f"{rnd.randint(10, 500000) / 100:.2f}"
+        fila = [f"F{año}-{i:07d}", f"{año}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+                nif_aleatorio(rnd) if rnd.random() > 0.01 else '', f"Servicio {rnd.randint(1, 50)}",
+                base, rnd.choice(['21', '21', '21', '10', '4', '0']), rnd.choice(['0', '0', '15', '7'])]
+        if rnd.random() < errores:
+            fila[4] = rnd.choice(['abc', '1.000,50', ''])
+        yield fila
+
+GENERADORES = {
+    'stripe': filas_stripe,
+    'substack': filas_substack,
+    'facturas': filas_facturas,
+}
+
+def generar_csv(tipo: str, filas: int, directorio: str, semilla: int = 42,
+                errores: float = PROPORCION_ERRORES) -> str:
+    """
+    Escribe el CSV sintético y devuelve su ruta. El nombre lleva tipo,
+    filas, semilla, errores y VERSION_DATOS, así que si ya existe se reutiliza.
+    """
+    os.makedirs(directorio, exist_ok=True)
+    ruta = os.path.join(directorio, f"{tipo}-{filas}-s{semilla}-e{errores:g}-v{VERSION_DATOS}.csv")
+    if not os.path.exists(ruta):
+        temporal = ruta + '.tmp'
+        with open(temporal, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(GENERADORES[tipo](filas, semilla, errores=errores))
+        os.replace(temporal, ruta)
+    return ruta
+
+# ---------------------------------------------------------------------------
+# Funciones y procesos
+# ---------------------------------------------------------------------------
+
+def benchmark_funciones(filas: int, semilla: int = 42) -> Dict:
+    """Tiempo por llamada de las funciones de parseo y validación."""
+    stripe = list(filas_stripe(filas, semilla, errores=0))[1:]
+    substack = list(filas_substack(filas, semilla, errores=0))[1:]
+    casos = {
+        'parsear_importe': (parsear_importe, [fila[3] for fila in substack]),
+        'parsear_fecha[substack]': (parsear_fecha, [fila[1] for fila in substack]),
+        'parsear_fecha[stripe]': (parsear_fecha, [fila[3] for fila in stripe]),
+        'validar_nif': (validar_nif, [nif_aleatorio(random.Random(semilla + i)) for i in range(filas)]),
+    }
+    resultados = {}
+    for nombre, (funcion, valores) in casos.items():
+        segundos = medir(funcion, valores)
+        resultados[nombre] = {
+            'llamadas': len(valores),
+            'segundos': round(segundos, 3),
+            'por_s': int(len(valores) / segundos) if segundos else None,
+            'us_por_llamada': round(segundos / len(valores) * 1e6, 3),
+        }
+    return resultados
+
+def _rss_max_mb() -> float:
+    """Memoria residente máxima del proceso actual (ru_maxrss: KB en Linux, bytes en macOS)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+def _ejecutar_proceso(nombre: str, ruta: str) -> Dict:
+    """Se ejecuta en un proceso nuevo para que el RSS máximo sea solo el de esta prueba."""
+    from procesar_stripe import iterar_csv, procesar_substack_stripe
+    from procesar_facturas import procesar_csv
+    from generar_libro import generar_libro
+    
+    inicio = time.perf_counter()
+    if nombre.startswith('procesar_substack_stripe'):
+        resultado = procesar_substack_stripe(iterar_csv(ruta), 4, 2025, detalle=False)
+        filas = resultado['resumen']['total_pagos']
+    elif nombre == 'procesar_csv':
+        resultado = procesar_csv(ruta, 'emitidas')
+        filas = resultado['num_facturas'] + resultado['num_errores']
+    else:
+        resultado = generar_libro(4, 2025, facturas_emitidas=ruta)
+        filas = len(resultado['ingresos'])
+    segundos = time.perf_counter() - inicio
+    return {'segundos': segundos, 'procesadas': filas, 'rss_max_mb': _rss_max_mb()}
+
+def benchmark_procesos(filas: int, directorio: str, semilla: int = 42) -> Dict:
+    """Filas/s y RSS máximo de los procesos completos, cada uno en su propio proceso."""
+    pruebas = {
+        'procesar_substack_stripe[substack]': generar_csv('substack', filas, directorio, semilla),
+        'procesar_substack_stripe[stripe]': generar_csv('stripe', filas, directorio, semilla),
+        'procesar_csv': generar_csv('facturas', filas, directorio, semilla),
+        # generar_libro no tolera importes ilegibles: facturas sin errores
+        'generar_libro': generar_csv('facturas', filas, directorio, semilla, errores=0),
+    }
+    contexto = multiprocessing.get_context('spawn')
+    resultados = {}
+    for nombre, ruta in pruebas.items():
+        with contexto.Pool(1) as pool:
+            r = pool.apply(_ejecutar_proceso, (nombre, ruta))
+        resultados[nombre] = {
+            'filas': filas,
+            'procesadas': r['procesadas'],
+            'segundos': round(r['segundos'], 3),
+            'filas_por_s': int(filas / r['segundos']) if r['segundos'] else None,
+            'rss_max_mb': r['rss_max_mb'],
+        }
+    return resultados
+
+# ---------------------------------------------------------------------------
+# Resultados
+# ---------------------------------------------------------------------------
+
+def revision_git() -> Optional[str]:
+    """Commit actual (con '+' si hay cambios sin confirmar), o None fuera de git."""
+    directorio = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directorio,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        cambios = subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=directorio,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if cambios else '')
+
+def metadatos(filas: int, semilla: int) -> Dict:
+    return {
+        'revision': revision_git(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+        'filas': filas,
+        'semilla': semilla,
+    }
+
+# Métrica a comparar en cada sección (más alto = mejor)
+METRICAS = {'fechas': 'filas_por_s_nuevo', 'funciones': 'por_s', 'procesos': 'filas_por_s'}
+UMBRAL_REGRESION = 0.9
+
+def comparar(actual: Dict, anterior: Dict) -> List[Dict]:
+    """Cociente actual/anterior de la métrica de cada prueba presente en ambos."""
+    filas = []
+    for seccion, metrica in METRICAS.items():
+        for nombre, r in actual.get(seccion, {}).items():
+            previo = anterior.get(seccion, {}).get(nombre)
+            if not previo or not previo.get(metrica) or not r.get(metrica):
+                continue
+            cociente = r[metrica] / previo[metrica]
+            filas.append({
+                'prueba': f"{seccion}/{nombre}",
+                'anterior': previo[metrica],
+                'actual': r[metrica],
+                'cociente': round(cociente, 2),
+                'regresion': cociente < UMBRAL_REGRESION,
+            })
+    return filas
+
+def imprimir_resultados(resultados: Dict):
+    print("\n" + "="*72)
+    meta = resultados['meta']
+    print(f"   BENCHMARK ({meta['filas']:,} filas, revisión {meta['revision'] or '?'})")
+    print("="*72)
+    for formato, r in resultados.get('fechas', {}).items():
+        print(f"\n   fechas {formato}:")
+        print(f"   parsear_fecha:        {r['parsear_fecha_s']:>8.3f} s  ({r['filas_por_s_original']:>10,} filas/s)")
+        print(f"   crear_parser_fechas:  {r['crear_parser_fechas_s']:>8.3f} s  ({r['filas_por_s_nuevo']:>10,} filas/s)")
+        print(f"   Aceleración:          {r['aceleracion']:>8.1f}x")
+    if resultados.get('funciones'):
+        print(f"\n   {'Función':<36}{'µs/llamada':>12}{'llamadas/s':>14}")
+        for nombre, r in resultados['funciones'].items():
+            print(f"   {nombre:<36}{r['us_por_llamada']:>12.3f}{r['por_s'] or 0:>14,}")
+    if resultados.get('procesos'):
+        print(f"\n   {'Proceso':<36}{'s':>8}{'filas/s':>12}{'RSS MB':>10}")
+        for nombre, r in resultados['procesos'].items():
+            print(f"   {nombre:<36}{r['segundos']:>8.2f}{r['filas_por_s'] or 0:>12,}{r['rss_max_mb']:>10.1f}")
+    if resultados.get('comparacion'):
+        print(f"\n   Comparado con {resultados['comparacion_con']}:")
+        for c in resultados['comparacion']:
+            marca = '⚠️ ' if c['regresion'] else '  '
+            print(f"   {marca}{c['prueba']:<46}{c['cociente']:>6.2f}x")
+    print("="*72 + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks de los scripts de gestor-autonomos',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Ejemplos de uso:
+  # Parseo de fechas con 1M de filas:
+  python3 benchmark.py fechas --filas 1000000
+  
+  # Todo con 100k filas, guardando el resultado para compararlo después:
+  python3 benchmark.py todo --filas 100000 --guardar bench-antes.json
+  python3 benchmark.py todo --filas 100000 --guardar bench-despues.json --comparar bench-antes.json
+  
+  # Solo generar los CSVs sintéticos (se reutilizan entre ejecuciones):
+  python3 benchmark.py generar --filas 10000000 --dir /tmp/bench-gestor
+        """
+    )
+    parser.add_argument('prueba', choices=['fechas', 'funciones', 'procesos', 'todo', 'generar'],
+                        help='Benchmark a ejecutar')
+    parser.add_argument('--filas', type=int, default=1000000, help='Filas sintéticas (default: 1M)')
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--dir', type=str, default=os.path.join('/tmp', 'bench-gestor-autonomos'),
+                        help='Directorio de los CSVs generados (se reutilizan si ya existen)')
+    parser.add_argument('--errores', type=float, default=PROPORCION_ERRORES,
+                        help=f'Proporción de filas malas en los CSVs (default: {PROPORCION_ERRORES})')
+    parser.add_argument('--guardar', type=str, help='Guarda los resultados en este JSON')
+    parser.add_argument('--comparar', type=str, help='JSON de una ejecución anterior para comparar')
+    parser.add_argument('--json', action='store_true', help='Salida en formato JSON')
+    
+    args = parser.parse_args()
+    
+    try:
+        if args.prueba == 'generar':
+            for tipo in GENERADORES:
+                ruta = generar_csv(tipo, args.filas, args.dir, args.semilla, args.errores)
+                print(f"{ruta}  ({os.path.getsize(ruta) / 1e6:,.1f} MB)")
+            return
+        
+        resultados = {'meta': metadatos(args.filas, args.semilla)}
+        if args.prueba in ('fechas', 'todo'):
+            resultados['fechas'] = benchmark_fechas(args.filas, args.semilla)
+        if args.prueba in ('funciones', 'todo'):
+            resultados['funciones'] = benchmark_funciones(args.filas, args.semilla)
+        if args.prueba in ('procesos', 'todo'):
+            resultados['procesos'] = benchmark_procesos(args.filas, args.dir, args.semilla)
+        
+        if args.comparar:
+            with open(args.comparar, 'r', encoding='utf-8') as f:
+                resultados['comparacion'] = comparar(resultados, json.load(f))
+            resultados['comparacion_con'] = args.comparar
+        
+        if args.guardar:
+            with open(args.guardar, 'w', encoding='utf-8') as f:
+                json.dump(resultados, f, indent=2, ensure_ascii=False)
+        
+        if args.json:
+            print(json.dumps(resultados, indent=2, ensure_ascii=False))
+        else:
+            imprimir_resultados(resultados)
+    
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Cubo de ingresos de Stripe/Substack: totales por mes × país × moneda × UE.
+
+procesar_stripe.py --cubo ingresos.sqlite lo rellena en la misma lectura de
+la exportación. Después este script responde consultas ("ingresos UE por
+país y mes", "peso del USD por trimestre", "fees sobre ingresos") en
+milisegundos, sin volver a leer los pagos.
+
+El cubo es un SQLite con una fila por celda (mes, país, moneda, UE) y los
+importes en micro-euros (enteros: las sumas son exactas). mes es AAAAMM;
+AAAA00 son los pagos sin fecha del año. Cada ejecución de procesar_stripe.py
+sustituye los meses de su periodo, así que se puede ir rellenando trimestre
+a trimestre.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+VERSION_CUBO = 1
+
+# Medidas de cada celda, en este orden
+MEDIDAS = ('num_pagos', 'num_rectificaciones', 'bruto', 'base', 'iva', 'fees')
+MEDIDAS_IMPORTE = MEDIDAS[2:]
+
+ESQUEMA_SQL = """
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS celdas (
+    mes INTEGER NOT NULL,
+    pais TEXT NOT NULL,
+    moneda TEXT NOT NULL,
+    ue INTEGER NOT NULL,
+    num_pagos INTEGER NOT NULL,
+    num_rectificaciones INTEGER NOT NULL,
+    bruto INTEGER NOT NULL,
+    base INTEGER NOT NULL,
+    iva INTEGER NOT NULL,
+    fees INTEGER NOT NULL,
+    PRIMARY KEY (mes, pais, moneda, ue)
+) WITHOUT ROWID;
+"""
+
+class CuboIngresos:
+    """
+    Celdas del cubo en memoria, mientras se procesan los pagos.
+    
+    `celdas` es {(mes, pais, moneda, ue): [num_pagos, num_rectificaciones,
+    bruto, base, iva, fees]} con los importes en la unidad del motor de
+    cálculo (`cero` es su cero). pais es '' si el pago no tiene; ue es 1
+    para UE y sin país (criterio conservador), 0 para exportación. bruto es
+    lo cobrado en EUR (IVA incluido en UE) y fees la suma de Substack y
+    Stripe. Los reembolsos suman en negativo en la celda del país de su
+    cargo, como en el modelo 303.
+    """
+    __slots__ = ('celdas', 'cero')
+    
+    def __init__(self, cero=Decimal('0')):
+        self.celdas: Dict[Tuple[int, str, str, int], List] = {}
+        self.cero = cero
+    
+    def celda(self, mes: int, pais: Optional[str], moneda: str, ue: bool) -> List:
+        """La celda (creada vacía si no existe) para sumarle un pago."""
+        clave = (mes, pais or '', moneda, 1 if ue else 0)
+        celda = self.celdas.get(clave)
+        if celda is None:
+            cero = self.cero
+            celda = self.celdas[clave] = [0, 0, cero, cero, cero, cero]
+        return celda
+    
+    def fusionar(self, otro: 'CuboIngresos') -> 'CuboIngresos':
+        """Suma las celdas de `otro` (in situ) y lo devuelve."""
+        for clave, valores in otro.celdas.items():
+            celda = self.celdas.get(clave)
+            if celda is None:
+                self.celdas[clave] = list(valores)
+            else:
+                for i, valor in enumerate(valores):
+                    celda[i] += valor
+        return self
+    
+    def guardar(self, ruta: str, meses: Iterable[int], a_decimal: Callable[[object], Decimal]):
+        """
+        Escribe el cubo en el SQLite `ruta` (lo crea si no existe). Las celdas
+        de `meses` que hubiera se sustituyen, las demás se conservan.
+        `a_decimal` pasa un importe de la unidad del motor a Decimal.
+        """
+        def micros(valor) -> int:
+            return int(a_decimal(valor).scaleb(6).to_integral_value(ROUND_HALF_UP))
+        
+        filas = [(*clave, num, rect, *(micros(v) for v in importes))
+                 for clave, (num, rect, *importes) in self.celdas.items()]
+        conexion = abrir_cubo(ruta, crear=True)
+        try:
+            with conexion:
+                conexion.executemany("DELETE FROM celdas WHERE mes = ?", [(mes,) for mes in meses])
+                conexion.executemany(
+                    "INSERT INTO celdas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (mes, pais, moneda, ue) DO UPDATE SET "
+                    + ", ".join(f"{m} = {m} + excluded.{m}" for m in MEDIDAS),
+                    filas)
+                conexion.execute("INSERT OR REPLACE INTO meta VALUES ('actualizado', ?)",
+                                 (datetime.now().isoformat(timespec='seconds'),))
+        finally:
+            conexion.close()
+
+def meses_periodo(año: int, trimestres: Iterable[int]) -> List[int]:
+    """Los meses (AAAAMM) de los trimestres pedidos, más AAAA00 (sin fecha)."""
+    return [año * 100] + [año * 100 + mes for t in trimestres for mes in range(3 * t - 2, 3 * t + 1)]
+
+def abrir_cubo(ruta: str, crear: bool = False) -> sqlite3.Connection:
+    """Conexión al cubo, comprobando la versión (con `crear`, lo crea si no existe)."""
+    if not crear and not os.path.exists(ruta):
+        raise FileNotFoundError(f"Cubo no encontrado: {ruta}")
+    conexion = sqlite3.connect(ruta)
+    try:
+        conexion.executescript(ESQUEMA_SQL)
+        fila = conexion.execute("SELECT valor FROM meta WHERE clave = 'version'").fetchone()
+        if fila is None:
+            with conexion:
+                conexion.execute("INSERT INTO meta VALUES ('version', ?)", (str(VERSION_CUBO),))
+        elif int(fila[0]) != VERSION_CUBO:
+            raise ValueError(f"{ruta}: cubo de la versión {fila[0]}, se esperaba la {VERSION_CUBO}")
+    except Exception:
+        conexion.close()
+        raise
+    return conexion
+
+# ---------------------------------------------------------------------------
+# Consultas
+# ---------------------------------------------------------------------------
+
+# Dimensiones por las que se puede agrupar: expresión SQL sobre las celdas
+DIMENSIONES = {
+    'año': 'mes / 100',
+    'trimestre': 'mes / 100 * 10 + (mes % 100 + 2) / 3',
+    'mes': 'mes',
+    'pais': 'pais',
+    'moneda': 'moneda',
+    'ue': 'ue',
+}
+DIMENSIONES_TIEMPO = ('año', 'trimestre', 'mes')
+
+def etiqueta(dimension: str, valor) -> str:
+    """Valor de una dimensión como se muestra: 2025-03, 2025-T1, UE..."""
+    if dimension == 'mes':
+        año, mes = divmod(valor, 100)
+        return f"{año}-{mes:02d}" if mes else f"{año}-sin fecha"
+    if dimension == 'trimestre':
+        año, trimestre = divmod(valor, 10)
+        return f"{año}-T{trimestre}" if trimestre else f"{año}-sin fecha"
+    if dimension == 'ue':
+        return 'UE' if valor else 'no UE'
+    if dimension == 'pais':
+        return valor or 'SIN_PAIS'
+    return str(valor)
+
+def _mes(texto: str) -> int:
+    """'2025-03' → 202503 (argumentos --desde/--hasta)."""
+    try:
+        fecha = datetime.strptime(texto, '%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"mes no válido (AAAA-MM): {texto}") from None
+    return fecha.year * 100 + fecha.month
+
+def consultar(
+    ruta: str,
+    por: Iterable[str] = ('mes',),
+    desde: Optional[int] = None,
+    hasta: Optional[int] = None,
+    paises: Optional[Iterable[str]] = None,
+    monedas: Optional[Iterable[str]] = None,
+    ue: Optional[bool] = None
+) -> Dict:
+    """
+    Agrega las celdas del cubo por las dimensiones de `por` (ver DIMENSIONES)
+    con los filtros dados (meses AAAAMM, ambos incluidos). Devuelve los
+    grupos con sus medidas, fees sobre bruto y la cuota de cada grupo en el
+    bruto de su periodo (o del total, si no se agrupa por tiempo), y el total.
+    """
+    por = list(por)
+    condiciones, parametros = [], []
+    if desde is not None:
+        condiciones.append("mes >= ?")
+        parametros.append(desde)
+    if hasta is not None:
+        condiciones.append("mes <= ?")
+        parametros.append(hasta)
+    for columna, valores in (('pais', paises), ('moneda', monedas)):
+        if valores:
+            valores = [v.upper() for v in valores]
+            condiciones.append(f"{columna} IN ({', '.join('?' * len(valores))})")
+            parametros.extend('' if v == 'SIN_PAIS' else v for v in valores)
+    if ue is not None:
+        condiciones.append("ue = ?")
+        parametros.append(1 if ue else 0)
+    
+    grupos_sql = [DIMENSIONES[d] for d in por]
+    consulta = (
+        f"SELECT {', '.join(grupos_sql + [f'SUM({m})' for m in MEDIDAS])} FROM celdas"
+        + (f" WHERE {' AND '.join(condiciones)}" if condiciones else "")
+        + (f" GROUP BY {', '.join(grupos_sql)} ORDER BY {', '.join(grupos_sql)}" if grupos_sql else "")
+    )
+    conexion = abrir_cubo(ruta)
+    try:
+        filas = conexion.execute(consulta, parametros).fetchall()
+        actualizado = conexion.execute("SELECT valor FROM meta WHERE clave = 'actualizado'").fetchone()
+    finally:
+        conexion.close()
+    
+    # Cuota sobre el bruto del mismo periodo (primera dimensión de tiempo agrupada)
+    tiempo = next((por.index(d) for d in por if d in DIMENSIONES_TIEMPO), None)
+    bruto_periodo: Dict = {}
+    for fila in filas:
+        periodo = fila[tiempo] if tiempo is not None else None
+        bruto_periodo[periodo] = bruto_periodo.get(periodo, 0) + (fila[len(por) + 2] or 0)
+    
+    def medidas(valores) -> Dict:
+        num, rect, *importes = (v or 0 for v in valores)
+        resultado = {'num_pagos': num, 'num_rectificaciones': rect}
+        for nombre, micros in zip(MEDIDAS_IMPORTE, importes):
+            resultado[nombre] = str(centimos(micros))
+        bruto, fees = importes[0], importes[3]
+        resultado['fees_sobre_bruto'] = porcentaje(fees, bruto)
+        return resultado
+    
+    grupos = []
+    total = [0] * len(MEDIDAS)
+    for fila in filas:
+        claves, valores = fila[:len(por)], fila[len(por):]
+        if not grupos_sql and valores[0] is None:
+            break  # Sin celdas: SUM sin GROUP BY devuelve una fila de NULL
+        grupo = {d: etiqueta(d, v) for d, v in zip(por, claves)}
+        grupo.update(medidas(valores))
+        periodo = claves[tiempo] if tiempo is not None else None
+        grupo['cuota'] = porcentaje(valores[2] or 0, bruto_periodo[periodo])
+        grupos.append(grupo)
+        total = [t + (v or 0) for t, v in zip(total, valores)]
+    
+    return {
+        'cubo': ruta,
+        'actualizado': actualizado[0] if actualizado else None,
+        'por': por,
+        'grupos': grupos,
+        'total': medidas(total),
+    }
+
+def centimos(micros: int) -> Decimal:
+    """Micro-euros → euros redondeados a céntimos."""
+    return Decimal(micros).scaleb(-6).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+def porcentaje(parte: int, total: int) -> Optional[str]:
+    """parte / total en %, con 2 decimales (None si el total es 0)."""
+    if not total:
+        return None
+    return str((Decimal(parte) * 100 / Decimal(total)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+
+def imprimir_consulta(resultado: Dict):
+    """Tabla de texto con los grupos de la consulta y el total."""
+    por = resultado['por']
+    columnas = por + ['pagos', 'rect.', 'bruto', 'base', 'iva', 'fees', 'fees %', 'cuota %']
+    filas = [[g[d] for d in por]
+             + [str(g['num_pagos']), str(g['num_rectificaciones']), g['bruto'], g['base'], g['iva'], g['fees'],
+                g['fees_sobre_bruto'] or '-', g['cuota'] or '-']
+             for g in resultado['grupos']]
+    t = resultado['total']
+    total = (['TOTAL'] + [''] * (len(por) - 1) if por else []) + [
+        str(t['num_pagos']), str(t['num_rectificaciones']), t['bruto'], t['base'], t['iva'], t['fees'],
+        t['fees_sobre_bruto'] or '-', '100.00' if resultado['grupos'] else '-']
+    anchos = [max(len(str(f[i])) for f in [columnas, total] + filas) for i in range(len(columnas))]
+    
+    def linea(valores):
+        return '  '.join(str(v).ljust(a) if i < len(por) else str(v).rjust(a)
+                         for i, (v, a) in enumerate(zip(valores, anchos)))
+    
+    print(f"\n📊 CUBO DE INGRESOS ({resultado['cubo']}, actualizado {resultado['actualizado'] or '-'})")
+    print("=" * max(70, sum(anchos) + 2 * len(anchos)))
+    print(linea(columnas))
+    print("-" * max(70, sum(anchos) + 2 * len(anchos)))
+    for fila in filas:
+        print(linea(fila))
+    print("-" * max(70, sum(anchos) + 2 * len(anchos)))
+    print(linea(total))
+    print("\nImportes en EUR. cuota % = parte del bruto de su periodo (o del total si no se agrupa por tiempo).")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Consultas sobre el cubo de ingresos de procesar_stripe.py --cubo',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Ejemplos de uso:
+  # Crear/actualizar el cubo al procesar los pagos:
+  python3 procesar_stripe.py --archivo pagos.csv --año 2025 --año-completo --cubo ingresos.sqlite
+  
+  # Ingresos UE por país y mes:
+  python3 cubo_ingresos.py --cubo ingresos.sqlite --por mes pais --ue
+  
+  # Peso del USD por trimestre:
+  python3 cubo_ingresos.py --cubo ingresos.sqlite --por trimestre moneda
+  
+  # Fees sobre ingresos, mes a mes, del primer semestre:
+  python3 cubo_ingresos.py --cubo ingresos.sqlite --por mes --desde 2025-01 --hasta 2025-06
+        """
+    )
+    parser.add_argument('--cubo', required=True, help='SQLite creado con procesar_stripe.py --cubo')
+    parser.add_argument('--por', nargs='*', choices=list(DIMENSIONES), default=['mes'],
+                        help='Dimensiones por las que agrupar, en orden (default: mes; sin valores: solo el total)')
+    parser.add_argument('--desde', type=_mes, help='Primer mes (AAAA-MM)')
+    parser.add_argument('--hasta', type=_mes, help='Último mes (AAAA-MM)')
+    parser.add_argument('--pais', nargs='+', help='Solo estos países (SIN_PAIS = pagos sin país)')
+    parser.add_argument('--moneda', nargs='+', help='Solo estas monedas')
+    alcance = parser.add_mutually_exclusive_group()
+    alcance.add_argument('--ue', dest='ue', action='store_const', const=True,
+                         help='Solo UE (incluye sin país)')
+    alcance.add_argument('--no-ue', dest='ue', action='store_const', const=False,
+                         help='Solo exportaciones (no UE)')
+    parser.add_argument('--json', action='store_true', help='Salida JSON')
+    
+    args = parser.parse_args()
+    
+    try:
+        resultado = consultar(args.cubo, args.por, args.desde, args.hasta, args.pais, args.moneda, args.ue)
+    except (FileNotFoundError, ValueError, sqlite3.Error) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.json:
+        print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    else:
+        imprimir_consulta(resultado)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Apertura de exportaciones para los scripts de gestor-autonomos.
+
+Las exportaciones archivadas suelen guardarse comprimidas. abrir_texto()
+reconoce la compresión por los primeros bytes del archivo (no por la
+extensión) y descomprime al vuelo mientras se lee, sin archivos temporales:
+los lectores (csv.reader, DictReader, json) reciben un archivo de texto
+normal. Un archivo sin comprimir se abre con open() tal cual.
+
+gzip, zip, bzip2 y xz usan la biblioteca estándar; zstd necesita Python
+3.14 (compression.zstd) o el paquete zstandard (pip install zstandard).
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import zipfile
+from typing import IO, Optional
+
+# Bytes iniciales de cada formato
+FIRMAS_COMPRESION = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'PK\x03\x04', 'zip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'BZh', 'bzip2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+
+def tipo_compresion(archivo: str) -> Optional[str]:
+    """'gzip', 'zip', 'zstd', 'bzip2', 'xz' o None si no está comprimido."""
+    with open(archivo, 'rb') as f:
+        cabecera = f.read(6)
+    for firma, tipo in FIRMAS_COMPRESION:
+        if cabecera.startswith(firma):
+            return tipo
+    return None
+
+def _abrir_zstd(archivo: str) -> IO[bytes]:
+    try:
+        from compression import zstd
+        return zstd.open(archivo, 'rb')
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f"{archivo} está comprimido con zstd: hace falta Python 3.14 "
+                          "o el paquete zstandard (pip install zstandard)") from None
+    lector = zstandard.ZstdDecompressor()
+    return lector.stream_reader(open(archivo, 'rb'), read_across_frames=True, closefd=True)
+
+def _abrir_zip(archivo: str) -> IO[bytes]:
+    """Primer CSV/JSON del zip (o su único miembro), sin extraerlo a disco."""
+    # El archivo del zip sigue abierto hasta que se cierra el miembro
+    with zipfile.ZipFile(archivo) as z:
+        nombres = [n for n in z.namelist() if not n.endswith('/')]
+        datos = [n for n in nombres if n.lower().endswith(('.csv', '.json', '.jsonl'))]
+        if not (datos or len(nombres) == 1):
+            raise ValueError(f"{archivo}: el zip no contiene ningún CSV o JSON")
+        return z.open((datos or nombres)[0])
+
+def abrir_binario(archivo: str) -> IO[bytes]:
+    """El contenido del archivo, descomprimido si hace falta."""
+    tipo = tipo_compresion(archivo)
+    if tipo == 'gzip':
+        return gzip.open(archivo, 'rb')
+    if tipo == 'zip':
+        return _abrir_zip(archivo)
+    if tipo == 'zstd':
+        return _abrir_zstd(archivo)
+    if tipo == 'bzip2':
+        return bz2.open(archivo, 'rb')
+    if tipo == 'xz':
+        return lzma.open(archivo, 'rb')
+    return open(archivo, 'rb')
+
+def abrir_texto(archivo: str, encoding: str = 'utf-8', newline: Optional[str] = None) -> IO[str]:
+    """Como open(archivo, 'r', ...), descomprimiendo al vuelo si está comprimido."""
+    if tipo_compresion(archivo) is None:
+        return open(archivo, 'r', encoding=encoding, newline=newline)
+    return io.TextIOWrapper(abrir_binario(archivo), encoding=encoding, newline=newline)
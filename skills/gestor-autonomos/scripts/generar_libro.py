@@ -10,23 +10,26 @@ import json
 import sys
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator, IO
+
+from entrada import abrir_texto
+from salida_json import EscritorJSON, RegistrosDiferidos, volcar_json
 
 def redondear_centimos(valor: Decimal) -> Decimal:
     """Redondea a 2 decimales."""
     return valor.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
-def leer_facturas_csv(archivo: str) -> List[Dict]:
-    """Lee facturas de un archivo CSV."""
-    facturas = []
+def iterar_facturas_csv(archivo: str) -> Iterator[Dict]:
+    """Lee facturas de un archivo CSV de una en una."""
     try:
-        with open(archivo, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                facturas.append(row)
+        with abrir_texto(archivo) as f:
+            yield from csv.DictReader(f)
     except FileNotFoundError:
         print(f"Advertencia: Archivo no encontrado {archivo}", file=sys.stderr)
-    return facturas
+
+def leer_facturas_csv(archivo: str) -> List[Dict]:
+    """Lee facturas de un archivo CSV."""
+    return list(iterar_facturas_csv(archivo))
 
 def procesar_factura(row: Dict, tipo: str) -> Dict:
     """Procesa una factura y calcula totales."""
@@ -53,6 +56,67 @@ def procesar_factura(row: Dict, tipo: str) -> Dict:
         'total': str(total)
     }
 
+def iterar_libro(
+    facturas_emitidas: str = None,
+    facturas_recibidas: str = None
+) -> Iterator[Dict]:
+    """Facturas del libro en orden: primero los ingresos y después los gastos."""
+    if facturas_emitidas:
+        for row in iterar_facturas_csv(facturas_emitidas):
+            yield procesar_factura(row, 'ingreso')
+    if facturas_recibidas:
+        for row in iterar_facturas_csv(facturas_recibidas):
+            yield procesar_factura(row, 'gasto')
+
+class TotalesLibro:
+    """Totales del libro, acumulados factura a factura."""
+    
+    def __init__(self):
+        self.num_ingresos = 0
+        self.num_gastos = 0
+        self.ingresos_base = Decimal('0')
+        self.ingresos_iva = Decimal('0')
+        self.ingresos_retencion = Decimal('0')
+        self.gastos_base = Decimal('0')
+        self.gastos_iva = Decimal('0')
+    
+    def añadir(self, factura: Dict):
+        if factura['tipo'] == 'ingreso':
+            self.num_ingresos += 1
+            self.ingresos_base += Decimal(factura['base_imponible'])
+            self.ingresos_iva += Decimal(factura['cuota_iva'])
+            self.ingresos_retencion += Decimal(factura['retencion'])
+        else:
+            self.num_gastos += 1
+            self.gastos_base += Decimal(factura['base_imponible'])
+            self.gastos_iva += Decimal(factura['cuota_iva'])
+    
+    def resumen(self) -> Dict:
+        return {
+            'ingresos': {
+                'num_facturas': self.num_ingresos,
+                'base_imponible': str(redondear_centimos(self.ingresos_base)),
+                'iva_repercutido': str(redondear_centimos(self.ingresos_iva)),
+                'retenciones': str(redondear_centimos(self.ingresos_retencion))
+            },
+            'gastos': {
+                'num_facturas': self.num_gastos,
+                'base_imponible': str(redondear_centimos(self.gastos_base)),
+                'iva_soportado': str(redondear_centimos(self.gastos_iva))
+            },
+            'liquidacion': {
+                'rendimiento_neto': str(redondear_centimos(self.ingresos_base - self.gastos_base)),
+                'iva_a_liquidar': str(redondear_centimos(self.ingresos_iva - self.gastos_iva))
+            }
+        }
+
+def periodo_libro(trimestre: int, año: int) -> Dict:
+    return {
+        'trimestre': trimestre,
+        'año': año,
+        'descripcion': f'{trimestre}T {año}'
+    }
+
 def generar_libro(
     trimestre: int,
     año: int,
@@ -72,64 +136,51 @@ def generar_libro(
         Libro completo con ingresos, gastos y resúmenes
     """
     libro = {
-        'periodo': {
-            'trimestre': trimestre,
-            'año': año,
-            'descripcion': f'{trimestre}T {año}'
-        },
+        'periodo': periodo_libro(trimestre, año),
         'ingresos': [],
         'gastos': [],
         'resumen': {},
         'fecha_generacion': datetime.now().isoformat()
     }
     
-    # Totales
-    total_ingresos_base = Decimal('0')
-    total_ingresos_iva = Decimal('0')
-    total_ingresos_retencion = Decimal('0')
-    total_gastos_base = Decimal('0')
-    total_gastos_iva = Decimal('0')
-    
-    # Procesar facturas emitidas (ingresos)
-    if facturas_emitidas:
-        rows = leer_facturas_csv(facturas_emitidas)
-        for row in rows:
-            factura = procesar_factura(row, 'ingreso')
-            libro['ingresos'].append(factura)
-            total_ingresos_base += Decimal(factura['base_imponible'])
-            total_ingresos_iva += Decimal(factura['cuota_iva'])
-            total_ingresos_retencion += Decimal(factura['retencion'])
-    
-    # Procesar facturas recibidas (gastos)
-    if facturas_recibidas:
-        rows = leer_facturas_csv(facturas_recibidas)
-        for row in rows:
-            factura = procesar_factura(row, 'gasto')
-            libro['gastos'].append(factura)
-            total_gastos_base += Decimal(factura['base_imponible'])
-            total_gastos_iva += Decimal(factura['cuota_iva'])
-    
-    # Calcular resúmenes
-    libro['resumen'] = {
-        'ingresos': {
-            'num_facturas': len(libro['ingresos']),
-            'base_imponible': str(redondear_centimos(total_ingresos_base)),
-            'iva_repercutido': str(redondear_centimos(total_ingresos_iva)),
-            'retenciones': str(redondear_centimos(total_ingresos_retencion))
-        },
-        'gastos': {
-            'num_facturas': len(libro['gastos']),
-            'base_imponible': str(redondear_centimos(total_gastos_base)),
-            'iva_soportado': str(redondear_centimos(total_gastos_iva))
-        },
-        'liquidacion': {
-            'rendimiento_neto': str(redondear_centimos(total_ingresos_base - total_gastos_base)),
-            'iva_a_liquidar': str(redondear_centimos(total_ingresos_iva - total_gastos_iva))
-        }
-    }
+    totales = TotalesLibro()
+    for factura in iterar_libro(facturas_emitidas, facturas_recibidas):
+        libro['ingresos' if factura['tipo'] == 'ingreso' else 'gastos'].append(factura)
+        totales.añadir(factura)
     
+    libro['resumen'] = totales.resumen()
     return libro
 
+def escribir_libro_json(
+    trimestre: int,
+    año: int,
+    facturas: Iterable[Dict],
+    salida: IO[str],
+    lineas: bool = False,
+    compacto: bool = False
+):
+    """
+    Como generar_libro + json.dump, pero sin el libro en memoria: con
+    facturas=iterar_libro(...) cada factura se aparta en un temporal
+    (RegistrosDiferidos) según llega y el documento se escribe al terminar
+    de leer, así un error en una factura no deja un JSON a medias. Con
+    lineas=True escribe JSON Lines (ver EscritorJSON).
+    """
+    fecha_generacion = datetime.now().isoformat()
+    totales = TotalesLibro()
+    with RegistrosDiferidos() as ingresos, RegistrosDiferidos() as gastos:
+        for factura in facturas:
+            (ingresos if factura['tipo'] == 'ingreso' else gastos).añadir(factura)
+            totales.añadir(factura)
+        
+        escritor = EscritorJSON(salida, lineas, compacto)
+        escritor.cabecera({'periodo': periodo_libro(trimestre, año)})
+        for seccion, registros in (('ingresos', ingresos), ('gastos', gastos)):
+            escritor.abrir(seccion)
+            for factura in registros:
+                escritor.registro(seccion, factura)
+        escritor.cerrar({'resumen': totales.resumen(), 'fecha_generacion': fecha_generacion})
+
 def exportar_csv(libro: Dict, archivo: str):
     """Exporta el libro a formato CSV."""
     with open(archivo, 'w', encoding='utf-8', newline='') as f:
@@ -200,6 +251,8 @@ numero,fecha,nif,concepto,base_imponible,tipo_iva,tipo_retencion
     parser.add_argument('--facturas-recibidas', type=str, help='CSV de facturas recibidas')
     parser.add_argument('--exportar', type=str, help='Exportar a archivo CSV')
     parser.add_argument('--json', action='store_true', help='Salida en formato JSON')
+    parser.add_argument('--jsonl', action='store_true', help='Salida JSON Lines: una factura por línea')
+    parser.add_argument('--compacto', action='store_true', help='JSON sin indentar (más pequeño y rápido)')
     
     args = parser.parse_args()
     
@@ -207,6 +260,13 @@ numero,fecha,nif,concepto,base_imponible,tipo_iva,tipo_retencion
         parser.error("Debe proporcionar al menos --facturas-emitidas o --facturas-recibidas")
     
     try:
+        if (args.json or args.jsonl) and not args.exportar:
+            # Sin el libro en memoria: cada factura se escribe al leerla
+            facturas = iterar_libro(args.facturas_emitidas, args.facturas_recibidas)
+            escribir_libro_json(args.trimestre, args.año, facturas, sys.stdout,
+                                lineas=args.jsonl, compacto=args.compacto)
+            return
+        
         libro = generar_libro(
             trimestre=args.trimestre,
             año=args.año,
@@ -218,8 +278,11 @@ numero,fecha,nif,concepto,base_imponible,tipo_iva,tipo_retencion
             exportar_csv(libro, args.exportar)
             print(f"\n✅ Libro exportado a: {args.exportar}\n")
         
-        if args.json:
-            print(json.dumps(libro, indent=2, ensure_ascii=False))
+        if args.jsonl:
+            escribir_libro_json(args.trimestre, args.año, libro['ingresos'] + libro['gastos'],
+                                sys.stdout, lineas=True, compacto=args.compacto)
+        elif args.json:
+            volcar_json(libro, sys.stdout, args.compacto)
         elif not args.exportar:
             # Mostrar resumen en terminal
             print("\n" + "="*60)
@@ -247,7 +310,7 @@ numero,fecha,nif,concepto,base_imponible,tipo_iva,tipo_retencion
             else:
                 print(f"   IVA a compensar:    {iva:>12,.2f} €")
             print("="*60 + "\n")
-            
+    
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
@@ -10,9 +10,12 @@ import json
 import sys
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple, IO
 import re
 
+from entrada import abrir_texto
+from salida_json import EscritorJSON, RegistrosDiferidos, volcar_json
+
 # Tipos de IVA válidos en España
 TIPOS_IVA = {
     'general': Decimal('21'),
@@ -88,6 +91,73 @@ def calcular_factura(
         'total': str(total)
     }
 
+def procesar_fila(linea: int, row: Dict) -> dict:
+    """Calcula una factura del CSV y valida su NIF."""
+    base = Decimal(row.get('base_imponible', '0').replace(',', '.'))
+    iva = Decimal(row.get('tipo_iva', '21').replace(',', '.'))
+    ret = Decimal(row.get('tipo_retencion', '0').replace(',', '.'))
+    
+    calculo = calcular_factura(base, iva, ret)
+    
+    # Validar NIF
+    nif = row.get('nif', '')
+    validacion_nif = validar_nif(nif) if nif else {'valido': False, 'mensaje': 'NIF vacío'}
+    
+    factura = {
+        'linea': linea,
+        'numero': row.get('numero', ''),
+        'fecha': row.get('fecha', ''),
+        'nif': nif,
+        'nif_valido': validacion_nif['valido'],
+        'concepto': row.get('concepto', ''),
+        **calculo
+    }
+    
+    if not validacion_nif['valido']:
+        factura['advertencia_nif'] = validacion_nif['mensaje']
+    
+    return factura
+
+def iterar_facturas(filas: Iterable[Dict]) -> Iterator[Tuple[str, dict]]:
+    """
+    Procesa las filas de una en una.
+    Produce ('factura', factura) o ('error', {'linea', 'error', 'datos'}).
+    """
+    for i, row in enumerate(filas, start=2):  # Línea 2 en adelante (1 es cabecera)
+        try:
+            yield 'factura', procesar_fila(i, row)
+        except Exception as e:
+            yield 'error', {
+                'linea': i,
+                'error': str(e),
+                'datos': row
+            }
+
+class TotalesFacturas:
+    """Totales de un lote de facturas, acumulados una a una."""
+    
+    def __init__(self):
+        self.num_facturas = 0
+        self.base = Decimal('0')
+        self.iva = Decimal('0')
+        self.retencion = Decimal('0')
+        self.total = Decimal('0')
+    
+    def añadir(self, factura: dict):
+        self.num_facturas += 1
+        self.base += Decimal(factura['base_imponible'])
+        self.iva += Decimal(factura['cuota_iva'])
+        self.retencion += Decimal(factura['retencion'])
+        self.total += Decimal(factura['total'])
+    
+    def a_dict(self) -> dict:
+        return {
+            'base_imponible': str(redondear_centimos(self.base)),
+            'iva': str(redondear_centimos(self.iva)),
+            'retencion': str(redondear_centimos(self.retencion)),
+            'total': str(redondear_centimos(self.total))
+        }
+
 def procesar_csv(archivo: str, tipo: str) -> dict:
     """
     Procesa un archivo CSV de facturas.
@@ -104,55 +174,16 @@ def procesar_csv(archivo: str, tipo: str) -> dict:
     """
     facturas = []
     errores = []
-    
-    total_base = Decimal('0')
-    total_iva = Decimal('0')
-    total_retencion = Decimal('0')
-    total_facturas = Decimal('0')
+    totales = TotalesFacturas()
     
     try:
-        with open(archivo, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            
-            for i, row in enumerate(reader, start=2):  # Línea 2 en adelante (1 es cabecera)
-                try:
-                    base = Decimal(row.get('base_imponible', '0').replace(',', '.'))
-                    iva = Decimal(row.get('tipo_iva', '21').replace(',', '.'))
-                    ret = Decimal(row.get('tipo_retencion', '0').replace(',', '.'))
-                    
-                    calculo = calcular_factura(base, iva, ret)
-                    
-                    # Validar NIF
-                    nif = row.get('nif', '')
-                    validacion_nif = validar_nif(nif) if nif else {'valido': False, 'mensaje': 'NIF vacío'}
-                    
-                    factura = {
-                        'linea': i,
-                        'numero': row.get('numero', ''),
-                        'fecha': row.get('fecha', ''),
-                        'nif': nif,
-                        'nif_valido': validacion_nif['valido'],
-                        'concepto': row.get('concepto', ''),
-                        **calculo
-                    }
-                    
-                    if not validacion_nif['valido']:
-                        factura['advertencia_nif'] = validacion_nif['mensaje']
-                    
-                    facturas.append(factura)
-                    
-                    # Acumular totales
-                    total_base += Decimal(calculo['base_imponible'])
-                    total_iva += Decimal(calculo['cuota_iva'])
-                    total_retencion += Decimal(calculo['retencion'])
-                    total_facturas += Decimal(calculo['total'])
-                    
-                except Exception as e:
-                    errores.append({
-                        'linea': i,
-                        'error': str(e),
-                        'datos': row
-                    })
+        with abrir_texto(archivo) as f:
+            for clase, registro in iterar_facturas(csv.DictReader(f)):
+                if clase == 'factura':
+                    facturas.append(registro)
+                    totales.añadir(registro)
+                else:
+                    errores.append(registro)
     
     except FileNotFoundError:
         return {'error': f'Archivo no encontrado: {archivo}'}
@@ -164,17 +195,63 @@ def procesar_csv(archivo: str, tipo: str) -> dict:
         'archivo': archivo,
         'num_facturas': len(facturas),
         'num_errores': len(errores),
-        'totales': {
-            'base_imponible': str(redondear_centimos(total_base)),
-            'iva': str(redondear_centimos(total_iva)),
-            'retencion': str(redondear_centimos(total_retencion)),
-            'total': str(redondear_centimos(total_facturas))
-        },
+        'totales': totales.a_dict(),
         'facturas': facturas,
         'errores': errores if errores else None,
         'fecha_proceso': datetime.now().isoformat()
     }
 
+def escribir_csv_json(
+    archivo: str,
+    tipo: str,
+    salida: IO[str],
+    lineas: bool = False,
+    compacto: bool = False
+) -> Optional[dict]:
+    """
+    Como procesar_csv + json.dump, mismas claves en el mismo orden, pero sin
+    la lista de facturas en memoria: se apartan en un temporal
+    (RegistrosDiferidos) y el documento se escribe al terminar de leer, con
+    los totales ya calculados. En JSON Lines los errores salen después de
+    las facturas, uno por línea.
+    Si el archivo no se puede leer no escribe nada y devuelve {'error': ...}.
+    """
+    errores = []
+    totales = TotalesFacturas()
+    with RegistrosDiferidos() as facturas:
+        try:
+            with abrir_texto(archivo) as f:
+                for clase, registro in iterar_facturas(csv.DictReader(f)):
+                    if clase == 'factura':
+                        facturas.añadir(registro)
+                        totales.añadir(registro)
+                    else:
+                        errores.append(registro)
+        except FileNotFoundError:
+            return {'error': f'Archivo no encontrado: {archivo}'}
+        except Exception as e:
+            return {'error': f'Error leyendo archivo: {str(e)}'}
+        
+        escritor = EscritorJSON(salida, lineas, compacto)
+        escritor.cabecera({
+            'tipo': tipo,
+            'archivo': archivo,
+            'num_facturas': totales.num_facturas,
+            'num_errores': len(errores),
+            'totales': totales.a_dict()
+        })
+        escritor.abrir('facturas')
+        for registro in facturas:
+            escritor.registro('facturas', registro)
+        if lineas:
+            for registro in errores:
+                escritor.registro('errores', registro)
+        escritor.cerrar({
+            **({} if lineas else {'errores': errores if errores else None}),
+            'fecha_proceso': datetime.now().isoformat()
+        })
+    return None
+
 def main():
     parser = argparse.ArgumentParser(
         description='Procesador de Facturas para Autónomos',
@@ -210,6 +287,8 @@ F001,2024-01-15,B12345678,Servicios,1000,21,15
     
     # Formato salida
     parser.add_argument('--json', action='store_true', help='Salida en formato JSON')
+    parser.add_argument('--jsonl', action='store_true', help='Con --archivo: JSON Lines, una factura por línea')
+    parser.add_argument('--compacto', action='store_true', help='JSON sin indentar (más pequeño y rápido)')
     
     args = parser.parse_args()
     
@@ -218,7 +297,7 @@ F001,2024-01-15,B12345678,Servicios,1000,21,15
         if args.validar_nif:
             resultado = validar_nif(args.validar_nif)
             if args.json:
-                print(json.dumps(resultado, indent=2, ensure_ascii=False))
+                volcar_json(resultado, sys.stdout, args.compacto)
             else:
                 emoji = "✅" if resultado['valido'] else "❌"
                 print(f"\n{emoji} {args.validar_nif}: {resultado['mensaje']} ({resultado['tipo']})\n")
@@ -232,7 +311,7 @@ F001,2024-01-15,B12345678,Servicios,1000,21,15
                 Decimal(args.retencion)
             )
             if args.json:
-                print(json.dumps(resultado, indent=2, ensure_ascii=False))
+                volcar_json(resultado, sys.stdout, args.compacto)
             else:
                 print("\n" + "="*45)
                 print("   CÁLCULO DE FACTURA")
@@ -248,10 +327,14 @@ F001,2024-01-15,B12345678,Servicios,1000,21,15
         
         # Modo proceso CSV
         if args.archivo and args.tipo:
-            resultado = procesar_csv(args.archivo, args.tipo)
-            if args.json:
-                print(json.dumps(resultado, indent=2, ensure_ascii=False))
+            if args.json or args.jsonl:
+                # Cada factura se escribe según se procesa
+                error = escribir_csv_json(args.archivo, args.tipo, sys.stdout,
+                                          lineas=args.jsonl, compacto=args.compacto)
+                if error:
+                    volcar_json(error, sys.stdout, args.compacto)
             else:
+                resultado = procesar_csv(args.archivo, args.tipo)
                 if 'error' in resultado:
                     print(f"\n❌ Error: {resultado['error']}\n")
                     return
@@ -284,7 +367,7 @@ F001,2024-01-15,B12345678,Servicios,1000,21,15
             return
         
         parser.print_help()
-        
+    
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
@@ -21,12 +21,37 @@ REGLAS FISCALES APLICADAS:
 import argparse
 import csv
 import json
+import hashlib
+import heapq
+from array import array
+from bisect import bisect_right
+import mmap
+import os
 import sys
 import re
-from decimal import Decimal, ROUND_HALF_UP
-from datetime import datetime, date
-from typing import List, Dict, Tuple, Optional
+import threading
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from datetime import datetime, date, timedelta, timezone
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, Callable, Union
+from functools import lru_cache
+from collections import Counter
+from itertools import islice, chain, repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cubo_ingresos import CuboIngresos, meses_periodo
+from entrada import abrir_texto, tipo_compresion
+from salida_json import EscritorJSON, volcar_json
+
+try:
+    import numpy as np
+except ImportError:  # Opcional: solo para --motor numpy
+    np = None
+import urllib.parse
 import urllib.request
+import http.client
+import io
+import time
+import zipfile
 
 # Países UE-27 (sin UK desde 2021)
 PAISES_UE = {
@@ -61,19 +86,84 @@ TIPOS_CAMBIO = {
 
 DIVISOR_IVA = Decimal('1.21')
 
+# Ventanilla única (OSS): tipo general de IVA de cada país de la UE, como
+# (desde, tipo %) en orden de fecha, desde el inicio del régimen (1-7-2021).
+# España no está: sus ventas siguen en el 303 con DIVISOR_IVA. Se puede
+# sustituir país a país con --tipos-oss (ver TablaTiposIVA).
+INICIO_OSS = date(2021, 7, 1)
+TIPOS_IVA_UE = {
+    'AT': ((INICIO_OSS, Decimal('20')),),
+    'BE': ((INICIO_OSS, Decimal('21')),),
+    'BG': ((INICIO_OSS, Decimal('20')),),
+    'CY': ((INICIO_OSS, Decimal('19')),),
+    'CZ': ((INICIO_OSS, Decimal('21')),),
+    'DE': ((INICIO_OSS, Decimal('19')),),
+    'DK': ((INICIO_OSS, Decimal('25')),),
+    'EE': ((INICIO_OSS, Decimal('20')), (date(2024, 1, 1), Decimal('22')), (date(2025, 7, 1), Decimal('24'))),
+    'FI': ((INICIO_OSS, Decimal('24')), (date(2024, 9, 1), Decimal('25.5'))),
+    'FR': ((INICIO_OSS, Decimal('20')),),
+    'GR': ((INICIO_OSS, Decimal('24')),),
+    'HR': ((INICIO_OSS, Decimal('25')),),
+    'HU': ((INICIO_OSS, Decimal('27')),),
+    'IE': ((INICIO_OSS, Decimal('23')),),
+    'IT': ((INICIO_OSS, Decimal('22')),),
+    'LT': ((INICIO_OSS, Decimal('21')),),
+    'LU': ((INICIO_OSS, Decimal('17')), (date(2023, 1, 1), Decimal('16')), (date(2024, 1, 1), Decimal('17'))),
+    'LV': ((INICIO_OSS, Decimal('21')),),
+    'MT': ((INICIO_OSS, Decimal('18')),),
+    'NL': ((INICIO_OSS, Decimal('21')),),
+    'PL': ((INICIO_OSS, Decimal('23')),),
+    'PT': ((INICIO_OSS, Decimal('23')),),
+    'RO': ((INICIO_OSS, Decimal('19')), (date(2025, 8, 1), Decimal('21'))),
+    'SE': ((INICIO_OSS, Decimal('25')),),
+    'SI': ((INICIO_OSS, Decimal('22')),),
+    'SK': ((INICIO_OSS, Decimal('20')), (date(2025, 1, 1), Decimal('23'))),
+}
+
+# Ventas a distancia a otros países de la UE a partir de las cuales se
+# aplica el IVA del país del cliente (OSS)
+UMBRAL_OSS = Decimal('10000')
+
+# Alias de cabecera por campo, en orden de prioridad
+COLUMNAS = {
+    'importe': ['amount', 'Amount'],
+    'moneda': ['currency', 'Currency'],
+    'fecha': ['date', 'Date', 'created', 'Created (UTC)'],
+    'substack_fee': ['Substack fee', 'substack_fee'],
+    'stripe_fee': ['Stripe fee', 'stripe_fee'],
+    'email': ['email', 'Customer Email'],
+    'id': ['id', 'Charge ID', 'balance_transaction_id', 'charge_id', 'Payment ID', 'payment_id'],
+    # Reembolsos y contracargos: cargo que rectifican (si no, su propio id)
+    'cargo': ['Original Charge ID', 'original_charge_id', 'Charge', 'charge', 'charge_id'],
+    # Exportación de cargos: lo reembolsado de cada cargo (importe o sí/no)
+    'reembolsado': ['Amount Refunded', 'amount_refunded', 'Refunded', 'refunded'],
+}
+
+# País: billing > ip > otros
+COLUMNAS_PAIS = [
+    'country (billing)', 'Country (billing)', 'billing_country',
+    'country (ip)', 'Country (ip)', 'ip_country',
+    'Country', 'country', 'Card Country',
+]
+
+VALORES_PAIS_VACIOS = {'', 'NULL', 'NONE', 'N/A'}
+
+# Exportación de clientes o cargos de Stripe (--clientes, ver PaisesPorEmail)
+COLUMNAS_EMAIL_CLIENTES = ['Email', 'email', 'Customer Email', 'customer_email', 'Receipt Email', 'receipt_email']
+COLUMNAS_PAIS_CLIENTES = [
+    'Address Country', 'address_country', 'Card Address Country', 'card_address_country',
+    *COLUMNAS_PAIS, 'Card Issue Country', 'Shipping Address Country',
+]
+
 def redondear(valor: Decimal) -> Decimal:
     """Redondea a 2 decimales."""
     return valor.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
-def parsear_importe(valor: str) -> Tuple[Decimal, str]:
+def _separar_moneda(valor: str) -> Tuple[str, str]:
     """
-    Parsea un importe con símbolo de moneda.
-    Ejemplos: '€60.00', 'CA$140.00', '$50.00', '60.00'
-    Returns: (importe, moneda)
+    Separa el símbolo de moneda y limpia el número.
+    Ejemplos: '€60.00' → ('60.00', 'EUR'), 'CA$140,00' → ('140.00', 'CAD')
     """
-    if not valor or valor.strip() == '':
-        return Decimal('0'), 'EUR'
-    
     valor = str(valor).strip()
     
     # Detectar moneda por símbolo
@@ -91,44 +181,255 @@ def parsear_importe(valor: str) -> Tuple[Decimal, str]:
         moneda = 'GBP'
         valor = valor[1:]
     
-    # Limpiar y convertir
-    valor = valor.replace(',', '.').replace(' ', '').strip()
+    return valor.replace(',', '.').replace(' ', '').strip(), moneda
+
+def parsear_importe(valor: str) -> Tuple[Decimal, str]:
+    """
+    Parsea un importe con símbolo de moneda.
+    Ejemplos: '€60.00', 'CA$140.00', '$50.00', '60.00'
+    Returns: (importe, moneda)
+    """
+    if not valor or valor.strip() == '':
+        return Decimal('0'), 'EUR'
+    
+    valor, moneda = _separar_moneda(valor)
     try:
         return Decimal(valor), moneda
-    except:
+    except InvalidOperation:
         return Decimal('0'), moneda
 
-def parsear_fecha(valor: str) -> Optional[date]:
+def parsear_fecha(valor: str, utc: bool = False) -> Optional[date]:
     """
     Parsea fechas en múltiples formatos.
     Substack: '02-Oct-25', '15-Nov-25'
     Stripe: '2025-10-02', '2025-10-02 14:30:00'
+    
+    Con `utc` la hora es UTC y cuenta el día en Madrid (ver crear_dia_madrid).
     """
     if not valor:
         return None
     
     valor = str(valor).strip()
+    if utc:
+        valor = dia_madrid(valor)
     
     # Formato Substack: DD-MMM-YY
     try:
         return datetime.strptime(valor, '%d-%b-%y').date()
-    except:
+    except ValueError:
         pass
     
     # Formato ISO: YYYY-MM-DD
     try:
         return datetime.strptime(valor.split(' ')[0].split('T')[0], '%Y-%m-%d').date()
-    except:
+    except ValueError:
         pass
     
     # Formato europeo: DD/MM/YYYY
     try:
         return datetime.strptime(valor, '%d/%m/%Y').date()
-    except:
+    except ValueError:
         pass
     
     return None
 
+# Formatos de parsear_fecha, en su mismo orden de prueba
+FORMATOS_FECHA = ('%d-%b-%y', '%Y-%m-%d', '%d/%m/%Y')
+
+MESES_ABREV = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+TAM_MUESTRA_FECHAS = 1000
+TAM_CACHE_FECHAS = 4096
+
+def _fecha_substack(valor: str) -> date:
+    """'02-Oct-25' sin strptime."""
+    dia, mes, año = valor.split('-')
+    if not (dia.isdigit() and len(dia) <= 2 and año.isdigit() and len(año) == 2):
+        raise ValueError(valor)
+    año = int(año)
+    # Mismo pivote que %y: 69-99 → 19xx, 00-68 → 20xx
+    return date(año + (1900 if año >= 69 else 2000), MESES_ABREV[mes.lower()], int(dia))
+
+def _fecha_iso(valor: str) -> date:
+    """'2025-10-02' o '2025-10-02 14:30:00' sin strptime."""
+    texto = valor.split(' ')[0].split('T')[0]
+    if len(texto) != 10 or texto[4] != '-' or texto[7] != '-':
+        raise ValueError(valor)
+    digitos = texto[:4] + texto[5:7] + texto[8:]
+    if not digitos.isdigit():
+        raise ValueError(valor)
+    return date(int(texto[:4]), int(texto[5:7]), int(texto[8:]))
+
+def _fecha_europea(valor: str) -> date:
+    """'02/10/2025' sin strptime."""
+    dia, mes, año = valor.split('/')
+    if not (dia.isdigit() and len(dia) <= 2 and mes.isdigit() and len(mes) <= 2
+            and año.isdigit() and len(año) == 4):
+        raise ValueError(valor)
+    return date(int(año), int(mes), int(dia))
+
+PARSERS_FECHA_RAPIDOS = {
+    '%d-%b-%y': _fecha_substack,
+    '%Y-%m-%d': _fecha_iso,
+    '%d/%m/%Y': _fecha_europea,
+}
+
+def detectar_formato_fecha(muestra: Iterable[str]) -> Optional[str]:
+    """
+    Devuelve el formato de FORMATOS_FECHA con el que parsea parsear_fecha la
+    mayoría de valores de la muestra, o None si no reconoce ninguno.
+    """
+    aciertos = dict.fromkeys(FORMATOS_FECHA, 0)
+    for valor in muestra:
+        valor = str(valor).strip()
+        for formato in FORMATOS_FECHA:
+            texto = valor.split(' ')[0].split('T')[0] if formato == '%Y-%m-%d' else valor
+            try:
+                datetime.strptime(texto, formato)
+            except ValueError:
+                continue
+            aciertos[formato] += 1
+            break
+    
+    mejor = max(FORMATOS_FECHA, key=aciertos.get)
+    return mejor if aciertos[mejor] else None
+
+def _dia_iso(valor: str) -> str:
+    """'2025-10-02 14:30:00' → '2025-10-02'; el resto tal cual."""
+    if len(valor) > 10 and valor[10] in ' T' and valor[4] == '-' and valor[7] == '-':
+        return valor[:10]
+    return valor
+
+# Hora peninsular (Europe/Madrid): CET (UTC+1), y CEST (UTC+2) desde el último
+# domingo de marzo hasta el último de octubre, cambiando a la 01:00 UTC (regla
+# de la UE desde 1996). Las horas UTC de Stripe ('Created (UTC)') se pasan a
+# este horario para saber en qué día, y trimestre, se cobró en España.
+AÑOS_HORARIO = range(1996, 2100)
+EPOCA_ORDINAL = date(1970, 1, 1).toordinal()
+FINES_TRIMESTRE = ('03-31', '06-30', '09-30', '12-31')
+
+def _ultimo_domingo(año: int, mes: int) -> date:
+    fin = date(año, mes, 31)
+    return fin - timedelta(days=(fin.weekday() + 1) % 7)
+
+def _transiciones_madrid(años: Iterable[int]) -> List[int]:
+    """Segundos UTC de cada cambio de hora: inicio y fin del horario de verano de cada año."""
+    return [(_ultimo_domingo(año, mes).toordinal() - EPOCA_ORDINAL) * 86400 + 3600
+            for año in años for mes in (3, 10)]
+
+TRANSICIONES_MADRID = _transiciones_madrid(AÑOS_HORARIO)
+
+def desfase_madrid(segundos_utc: int) -> int:
+    """Segundos que Madrid va por delante de UTC en ese instante (3600 o 7200)."""
+    return 7200 if bisect_right(TRANSICIONES_MADRID, segundos_utc) % 2 else 3600
+
+def _cambio_de_dia_madrid(dia: str) -> Tuple[str, str]:
+    """
+    (umbral, día siguiente) del día UTC 'AAAA-MM-DD': desde la hora UTC
+    `umbral` ('23' en invierno, '22' en verano) en Madrid ya es el día
+    siguiente. El cambio de hora es a la 01:00 UTC, así que a esas horas el
+    horario es el del final del día. Un día no válido no cambia nunca.
+    """
+    try:
+        fecha = date.fromisoformat(dia)
+    except ValueError:
+        return '99', dia
+    segundos = (fecha.toordinal() - EPOCA_ORDINAL) * 86400 + 22 * 3600
+    umbral = '22' if desfase_madrid(segundos) == 7200 else '23'
+    return umbral, (fecha + timedelta(days=1)).isoformat()
+
+def crear_dia_madrid(cambios: Optional[List[str]] = None) -> Callable[[str], str]:
+    """
+    Como _dia_iso para horas UTC, pero da el día en Madrid:
+    '2025-03-31 22:30:00' → '2025-04-01'. El día solo depende de
+    'AAAA-MM-DD hh', así que se memoriza por esos 13 caracteres (unos 8.760
+    al año): casi todas las filas cuestan un corte y una búsqueda en un
+    dict, y la tabla de cambios de hora solo se mira la primera vez.
+    
+    Con `cambios`, cada valor de fin de trimestre que pasa al día siguiente,
+    y por tanto a otro trimestre, se añade a esa lista (atributo `cambios`
+    de la función devuelta). Esas horas no se memorizan para apuntarlas todas.
+    """
+    por_hora = {}
+    
+    def dia(valor: str) -> str:
+        try:
+            return por_hora[valor[:13]]
+        except KeyError:
+            pass
+        if len(valor) > 10 and valor[10] in ' T' and valor[4] == '-' and valor[7] == '-':
+            fecha = valor[:10]
+            hora = valor[11:13]
+            if hora >= '22' and hora.isdigit():
+                umbral, siguiente = _cambio_de_dia_madrid(fecha)
+                if hora >= umbral:
+                    if fecha[5:] in FINES_TRIMESTRE:
+                        if cambios is not None:
+                            cambios.append(valor)
+                        return siguiente
+                    por_hora[valor[:13]] = siguiente
+                    return siguiente
+            por_hora[valor[:13]] = fecha
+            return fecha
+        return valor
+    
+    dia.cambios = cambios
+    return dia
+
+dia_madrid = crear_dia_madrid()
+
+def crear_parser_fechas(
+    muestra: Iterable[str],
+    tam_cache: int = TAM_CACHE_FECHAS,
+    utc: bool = False
+) -> Callable[[str], Optional[date]]:
+    """
+    Crea un parser de fechas para un archivo concreto.
+    
+    Detecta el formato con una muestra de valores y parsea cada fila con un
+    único camino rápido sin strptime; lo que no encaja pasa por parsear_fecha,
+    así que el resultado es siempre el mismo. Los valores ya vistos se sirven
+    de una caché LRU acotada (las exportaciones de Substack repiten la misma
+    fecha miles de veces).
+    
+    Si el parser solo depende del día, el atributo `dia` del parser devuelto
+    da la parte del valor que importa (sirve como clave de agrupación).
+    
+    Con `utc` las fechas ISO con hora están en UTC y cuentan por su día en
+    Madrid (ver crear_dia_madrid); `dia` da ese día y el atributo `cambios`
+    del parser, los valores que por eso pasan a otro trimestre.
+    """
+    rapido = PARSERS_FECHA_RAPIDOS.get(detectar_formato_fecha(muestra))
+    
+    if rapido is None:
+        parsear_cache = lru_cache(maxsize=tam_cache)(parsear_fecha)
+    else:
+        def parsear(valor: str) -> Optional[date]:
+            try:
+                return rapido(valor.strip())
+            except (ValueError, KeyError):
+                return parsear_fecha(valor)
+        
+        parsear_cache = lru_cache(maxsize=tam_cache)(parsear)
+    # Aunque la muestra no sea ISO, con `utc` las fechas ISO que lleguen
+    # después tienen que contar por su día en Madrid
+    if rapido is not _fecha_iso and not utc:
+        return parsear_cache
+    
+    dia = crear_dia_madrid([]) if utc else _dia_iso
+    
+    def parsear_iso(valor: str) -> Optional[date]:
+        # Stripe: '2025-10-02 14:30:00' casi nunca se repite, pero su día sí
+        return parsear_cache(dia(valor))
+    
+    parsear_iso.dia = dia
+    if utc:
+        parsear_iso.cambios = dia.cambios
+    return parsear_iso
+
 def obtener_pais(pago: Dict) -> Optional[str]:
     """
     Obtiene el país del cliente.
@@ -136,22 +437,9 @@ def obtener_pais(pago: Dict) -> Optional[str]:
     
     IMPORTANTE: Si hay country (billing), usarlo aunque esté vacío country (ip)
     """
-    # Prioridad 1: country (billing)
-    for campo in ['country (billing)', 'Country (billing)', 'billing_country']:
-        pais = pago.get(campo, '').strip().upper()
-        if pais and pais not in ['', 'NULL', 'NONE', 'N/A']:
-            return pais
-    
-    # Prioridad 2: country (ip) - solo si no hay billing
-    for campo in ['country (ip)', 'Country (ip)', 'ip_country']:
-        pais = pago.get(campo, '').strip().upper()
-        if pais and pais not in ['', 'NULL', 'NONE', 'N/A']:
-            return pais
-    
-    # Otros campos
-    for campo in ['Country', 'country', 'Card Country']:
+    for campo in COLUMNAS_PAIS:
         pais = pago.get(campo, '').strip().upper()
-        if pais and pais not in ['', 'NULL', 'NONE', 'N/A']:
+        if pais not in VALORES_PAIS_VACIOS:
             return pais
     
     return None
@@ -168,328 +456,3799 @@ def convertir_a_eur(importe: Decimal, moneda: str) -> Tuple[Decimal, Decimal]:
     tc = TIPOS_CAMBIO.get(moneda, Decimal('1.0'))
     return redondear(importe * tc), tc
 
-def procesar_substack_stripe(
-    pagos: List[Dict],
-    trimestre: int,
-    año: int
-) -> Dict:
+# ---------------------------------------------------------------------------
+# Motores de cálculo
+#
+# MotorDecimal es el cálculo de referencia. MotorEntero trabaja con enteros
+# en micro-unidades (1 EUR = 1.000.000) y redondeo ROUND_HALF_UP entero;
+# da exactamente las mismas cifras sin crear objetos Decimal por fila. Un
+# importe con más de 6 decimales no cabe en un entero: queda como Decimal
+# exacto en micro-unidades, que se suma con los enteros sin perder nada.
+# ---------------------------------------------------------------------------
+
+ESCALA_MICROS = 10 ** 6
+MICROS_CENTIMO = ESCALA_MICROS // 100
+
+_IVA_NUM, _IVA_DEN = DIVISOR_IVA.as_integer_ratio()
+
+def _dividir_redondeando(n: int, d: int) -> int:
+    """n / d redondeado a entero con ROUND_HALF_UP (mitades lejos de cero). d > 0."""
+    q, r = divmod(abs(n), d)
+    q = int(q)  # n puede ser un Decimal (más de 6 decimales); el cociente es exacto
+    if 2 * r >= d:
+        q += 1
+    return q if n >= 0 else -q
+
+def _a_micros(valor: Decimal) -> Union[int, Decimal]:
     """
-    Procesa pagos de Substack o Stripe.
+    Decimal → micro-unidades: un entero, o el Decimal exacto en
+    micro-unidades si tiene más de 6 decimales. Error si no es finito.
     """
-    # Fechas del trimestre
-    mes_inicio = (trimestre - 1) * 3 + 1
-    mes_fin = trimestre * 3
-    fecha_inicio = date(año, mes_inicio, 1)
-    fecha_fin = date(año + 1, 1, 1) if mes_fin == 12 else date(año, mes_fin + 1, 1)
+    if not valor.is_finite():
+        raise ValueError(f"Importe no numérico: {valor}")
+    micros = valor.scaleb(6)
+    if micros != micros.to_integral_value():
+        return micros
+    return int(micros)
+
+def parsear_importe_micros(valor: str) -> Tuple[int, str]:
+    """Como parsear_importe, pero devuelve el importe en micro-unidades."""
+    if not valor or valor.strip() == '':
+        return 0, 'EUR'
     
-    # Acumuladores
-    pagos_ue = []
-    pagos_no_ue = []
-    pagos_sin_pais = []
+    texto, moneda = _separar_moneda(valor)
+    entero, _, fraccion = texto.partition('.')
+    if len(fraccion) <= 6 and '_' not in texto:
+        try:
+            return int(entero + fraccion.ljust(6, '0')), moneda
+        except ValueError:
+            pass
     
-    total_bruto_ue = Decimal('0')
-    total_base_ue = Decimal('0')
-    total_iva_ue = Decimal('0')
-    total_base_no_ue = Decimal('0')
-    total_sin_pais = Decimal('0')
+    # Notación científica, separadores raros, basura...: vía Decimal
+    try:
+        importe = Decimal(texto)
+    except InvalidOperation:
+        return 0, moneda
+    return _a_micros(importe), moneda
+
+_TC_MICROS: Dict[Decimal, Optional[int]] = {}
+
+def _tipo_micros(tipo: Decimal) -> Optional[int]:
+    """Tipo de cambio en micro-unidades, memorizado; None si tiene más de 6 decimales."""
+    tipo_micros = _TC_MICROS.get(tipo, -1)
+    if tipo_micros == -1:
+        tipo_micros = _a_micros(tipo)
+        tipo_micros = _TC_MICROS[tipo] = tipo_micros if isinstance(tipo_micros, int) else None
+    return tipo_micros
+
+def convertir_a_eur_micros(importe: int, moneda: str) -> Tuple[int, Decimal]:
+    """Como convertir_a_eur, con importes en micro-unidades."""
+    moneda = moneda.upper()
+    if moneda == 'EUR':
+        return importe, Decimal('1.0')
+    tc = TIPOS_CAMBIO.get(moneda, Decimal('1.0'))
     
-    total_substack_fee = Decimal('0')
-    total_stripe_fee = Decimal('0')
+    tc_micros = _tipo_micros(tc)
+    if tc_micros is None:
+        # Tipo con más de 6 decimales: producto exacto con Decimal
+        return _a_micros(redondear(Decimal(importe).scaleb(-6) * tc)), tc
     
-    conversiones = {}
-    paises_ue = {}
-    paises_no_ue = {}
+    # importe * tc está en 1e-12; se redondea a céntimos (1e-2)
+    centimos = _dividir_redondeando(importe * tc_micros, ESCALA_MICROS * MICROS_CENTIMO)
+    return centimos * MICROS_CENTIMO, tc
+
+def desglose_iva(importe_eur: Decimal) -> Tuple[Decimal, Decimal]:
+    """IVA incluido: Base = Total / 1.21, IVA = Total - Base. Returns: (base, iva)"""
+    base = redondear(importe_eur / DIVISOR_IVA)
+    return base, redondear(importe_eur - base)
+
+def desglose_iva_micros(importe_eur: int) -> Tuple[int, int]:
+    """Como desglose_iva, en micro-unidades."""
+    # Total / (NUM/DEN) en céntimos = Total * DEN * 100 / (NUM * 1e6)
+    base = _dividir_redondeando(importe_eur * _IVA_DEN * 100, _IVA_NUM * ESCALA_MICROS) * MICROS_CENTIMO
+    iva = _dividir_redondeando(importe_eur - base, MICROS_CENTIMO) * MICROS_CENTIMO
+    return base, iva
+
+def desglose_iva_tipo(importe_eur: Decimal, tipo: Decimal) -> Tuple[Decimal, Decimal]:
+    """Como desglose_iva con el tipo `tipo` (%) en lugar del 21 % (OSS)."""
+    base = redondear(importe_eur / (1 + tipo / 100))
+    return base, redondear(importe_eur - base)
+
+def desglose_iva_tipo_micros(importe_eur: int, tipo: Decimal) -> Tuple[int, int]:
+    """Como desglose_iva_tipo, en micro-unidades."""
+    num, den = (1 + tipo / 100).as_integer_ratio()
+    base = _dividir_redondeando(importe_eur * den * 100, num * ESCALA_MICROS) * MICROS_CENTIMO
+    iva = _dividir_redondeando(importe_eur - base, MICROS_CENTIMO) * MICROS_CENTIMO
+    return base, iva
+
+def dividir_por_tipo(importe: Decimal, tipo: Decimal) -> Decimal:
+    """Conversión con un tipo expresado como unidades de moneda por 1 EUR (BCE)."""
+    return redondear(importe / tipo)
+
+def dividir_por_tipo_micros(importe: int, tipo: Decimal) -> int:
+    """Como dividir_por_tipo, en micro-unidades."""
+    tipo_micros = _tipo_micros(tipo)
+    if tipo_micros is None:
+        return _a_micros(redondear(Decimal(importe).scaleb(-6) / tipo))
+    # (importe / 1e6) / (tipo / 1e6) en céntimos = importe * 100 / tipo
+    return _dividir_redondeando(importe * 100, tipo_micros) * MICROS_CENTIMO
+
+def micros_a_decimal(valor: int) -> Decimal:
+    """Micro-unidades → Decimal exacto."""
+    return Decimal(valor).scaleb(-6)
+
+def micros_a_texto(valor: int) -> str:
+    """Micro-unidades → texto con 2 decimales (más si no son céntimos exactos)."""
+    if valor % MICROS_CENTIMO == 0:
+        return str(Decimal(valor // MICROS_CENTIMO).scaleb(-2))
+    return str(micros_a_decimal(valor).normalize())
+
+class MotorDecimal:
+    """Cálculo con Decimal (por defecto)."""
+    nombre = 'decimal'
+    cero = Decimal('0')
+    parsear_importe = staticmethod(parsear_importe)
+    convertir_a_eur = staticmethod(convertir_a_eur)
+    dividir_por_tipo = staticmethod(dividir_por_tipo)
+    desglose_iva = staticmethod(desglose_iva)
+    desglose_iva_tipo = staticmethod(desglose_iva_tipo)
+    a_decimal = staticmethod(lambda valor: valor)
+    desde_decimal = staticmethod(lambda valor: valor)
+    a_texto = staticmethod(str)
+
+TAM_CACHE_IMPORTES = 8192
+
+class MotorEntero:
+    """
+    Cálculo en coma fija con enteros (micro-unidades).
     
-    for pago in pagos:
-        try:
-            # Parsear importe
-            amount_raw = pago.get('amount', pago.get('Amount', '0'))
-            importe, moneda_detectada = parsear_importe(amount_raw)
-            
-            if importe <= 0:
-                continue
-            
-            # Moneda (puede venir en columna separada)
-            moneda = pago.get('currency', pago.get('Currency', moneda_detectada)).upper()
-            if moneda in ['EUR', 'CAD', 'USD', 'GBP']:
-                pass
-            else:
-                moneda = moneda_detectada
-            
-            # Parsear fecha
-            fecha_raw = pago.get('date', pago.get('Date', pago.get('created', pago.get('Created (UTC)', ''))))
-            fecha = parsear_fecha(fecha_raw)
-            
-            # Filtrar por trimestre
-            if fecha and not (fecha_inicio <= fecha < fecha_fin):
-                continue
-            
-            # País (billing > ip)
-            pais = obtener_pais(pago)
-            
-            # Convertir a EUR
-            importe_eur, tc = convertir_a_eur(importe, moneda)
-            
-            # Registrar conversión
-            if moneda != 'EUR':
-                if moneda not in conversiones:
-                    conversiones[moneda] = {'tc': str(tc), 'original': Decimal('0'), 'eur': Decimal('0'), 'count': 0}
-                conversiones[moneda]['original'] += importe
-                conversiones[moneda]['eur'] += importe_eur
-                conversiones[moneda]['count'] += 1
-            
-            # Fees (Substack y Stripe)
-            substack_fee_raw = pago.get('Substack fee', pago.get('substack_fee', '0'))
-            stripe_fee_raw = pago.get('Stripe fee', pago.get('stripe_fee', '0'))
-            
-            substack_fee, _ = parsear_importe(substack_fee_raw)
-            stripe_fee, _ = parsear_importe(stripe_fee_raw)
-            
-            # Convertir fees a EUR (misma moneda que el pago)
-            substack_fee_eur, _ = convertir_a_eur(substack_fee, moneda)
-            stripe_fee_eur, _ = convertir_a_eur(stripe_fee, moneda)
-            
-            total_substack_fee += substack_fee_eur
-            total_stripe_fee += stripe_fee_eur
-            
-            # Calcular desglose IVA
-            pais_es_ue = es_ue(pais) if pais else None
-            
-            # OPCIÓN CONSERVADORA: Sin país → tratar como UE (paga IVA)
-            if pais_es_ue is True or pais_es_ue is None:
-                # UE o sin país: IVA incluido → Base = Total / 1.21
-                base = redondear(importe_eur / DIVISOR_IVA)
-                iva = redondear(importe_eur - base)
-                es_ue_final = True
-            else:
-                # No-UE: Exportación exenta
-                base = importe_eur
-                iva = Decimal('0')
-                es_ue_final = False
-            
-            # Datos del pago
-            pago_proc = {
-                'fecha': str(fecha) if fecha else 'N/A',
-                'email': pago.get('email', pago.get('Customer Email', ''))[:30],
-                'importe_original': f"{importe:.2f} {moneda}",
-                'total_eur': str(importe_eur),
-                'base': str(base),
-                'iva': str(iva),
-                'pais': pais if pais else 'DESCONOCIDO',
-                'substack_fee': str(substack_fee_eur),
-                'stripe_fee': str(stripe_fee_eur),
-            }
-            
-            # Clasificar
-            if es_ue_final:
-                # UE (incluye pagos sin país por criterio conservador)
-                pagos_ue.append(pago_proc)
-                total_bruto_ue += importe_eur
-                total_base_ue += base
-                total_iva_ue += iva
-                pais_key = pais if pais else 'SIN_PAIS'
-                paises_ue[pais_key] = paises_ue.get(pais_key, {'count': 0, 'total': Decimal('0')})
-                paises_ue[pais_key]['count'] += 1
-                paises_ue[pais_key]['total'] += importe_eur
-                if not pais:
-                    pagos_sin_pais.append(pago_proc)
-                    total_sin_pais += importe_eur
-            else:
-                # No-UE (exportación)
-                pagos_no_ue.append(pago_proc)
-                total_base_no_ue += base
-                paises_no_ue[pais] = paises_no_ue.get(pais, {'count': 0, 'total': Decimal('0')})
-                paises_no_ue[pais]['count'] += 1
-                paises_no_ue[pais]['total'] += importe_eur
-                
-        except Exception as e:
-            print(f"⚠️  Error: {e}", file=sys.stderr)
+    Cifras idénticas a MotorDecimal. En el detalle de pagos los importes se
+    escriben siempre con 2 decimales ('60' → '60.00'). Un importe con más
+    de 6 decimales sigue como Decimal exacto (ver _a_micros).
     
-    # Formatear
-    for m in conversiones:
-        conversiones[m]['original'] = str(redondear(conversiones[m]['original']))
-        conversiones[m]['eur'] = str(redondear(conversiones[m]['eur']))
-    for p in paises_ue:
-        paises_ue[p]['total'] = str(redondear(paises_ue[p]['total']))
-    for p in paises_no_ue:
-        paises_no_ue[p]['total'] = str(redondear(paises_no_ue[p]['total']))
+    Los precios se repiten mucho y los resultados son enteros inmutables, así
+    que parseo, conversión y desglose se memorizan en cachés LRU acotadas.
+    """
+    nombre = 'entero'
+    cero = 0
+    parsear_importe = staticmethod(lru_cache(maxsize=TAM_CACHE_IMPORTES)(parsear_importe_micros))
+    convertir_a_eur = staticmethod(lru_cache(maxsize=TAM_CACHE_IMPORTES)(convertir_a_eur_micros))
+    dividir_por_tipo = staticmethod(lru_cache(maxsize=TAM_CACHE_IMPORTES)(dividir_por_tipo_micros))
+    desglose_iva = staticmethod(lru_cache(maxsize=TAM_CACHE_IMPORTES)(desglose_iva_micros))
+    desglose_iva_tipo = staticmethod(lru_cache(maxsize=TAM_CACHE_IMPORTES)(desglose_iva_tipo_micros))
+    a_decimal = staticmethod(micros_a_decimal)
+    desde_decimal = staticmethod(_a_micros)
+    a_texto = staticmethod(micros_a_texto)
+
+class MotorNumpy(MotorEntero):
+    """
+    MotorEntero procesado por columnas con NumPy (ver acumular_columnas).
+    Solo para totales: con detalle de pagos o tipos de cambio diarios se usa
+    el bucle fila a fila de MotorEntero. Necesita NumPy instalado.
+    """
+    nombre = 'numpy'
+    columnar = True
+
+MOTORES = {m.nombre: m for m in (MotorDecimal, MotorEntero, MotorNumpy)}
+
+# ---------------------------------------------------------------------------
+# Tipos de cambio históricos
+# ---------------------------------------------------------------------------
+
+# Si el último tipo publicado es más antiguo, se considera que falta
+MAX_DIAS_SIN_TIPO = 7
+
+class TablaTiposCambio:
+    """
+    Tipos de cambio diarios leídos de un CSV con el formato del BCE
+    (eurofxref-hist.csv): columna Date y una columna por moneda con las
+    unidades de esa moneda por 1 EUR ('N/A' si no hay dato).
     
-    total_fees = total_substack_fee + total_stripe_fee
-    total_ingresos = total_base_ue + total_base_no_ue
-    rendimiento_neto = total_ingresos - total_fees
-    total_bruto = total_bruto_ue + total_base_no_ue
+    Cada moneda se carga la primera vez que se pide, así que solo se leen las
+    que aparecen en la exportación. Se guarda como dos arrays ordenados
+    (fecha ordinal, tipo en micro-unidades) y se busca con bisect: O(log n).
+    Si no hay tipo ese día (fin de semana, festivo) se usa el último día
+    hábil anterior.
+    """
     
-    # Total pagos = UE + no-UE (sin_pais ya está incluido en UE)
-    total_pagos = len(pagos_ue) + len(pagos_no_ue)
+    def __init__(self, archivo: str):
+        self.archivo = archivo
+        self._series: Dict[str, Optional[Tuple[array, array]]] = {}
+        self.tipo = lru_cache(maxsize=TAM_CACHE_FECHAS)(self._tipo)
     
-    return {
-        'periodo': {
-            'trimestre': trimestre,
-            'año': año,
-            'descripcion': f'{trimestre}T {año}'
-        },
-        'resumen': {
-            'total_pagos': total_pagos,
-            'total_bruto_eur': str(redondear(total_bruto)),
-            'ue': {
-                'cantidad': len(pagos_ue),
-                'total_cobrado': str(redondear(total_bruto_ue)),
-                'base_imponible': str(redondear(total_base_ue)),
-                'iva_incluido': str(redondear(total_iva_ue)),
-            },
-            'no_ue': {
-                'cantidad': len(pagos_no_ue),
-                'base_imponible': str(redondear(total_base_no_ue)),
-            },
-            'sin_pais': {
-                'cantidad': len(pagos_sin_pais),
-                'total': str(redondear(total_sin_pais)),
-            }
-        },
-        'fees': {
-            'substack': str(redondear(total_substack_fee)),
-            'stripe': str(redondear(total_stripe_fee)),
-            'total': str(redondear(total_fees)),
-        },
-        'paises': {'ue': paises_ue, 'no_ue': paises_no_ue},
-        'conversiones': conversiones,
-        'modelo_303': {
-            'casilla_01_base_21': str(redondear(total_base_ue)),
-            'casilla_03_cuota_21': str(redondear(total_iva_ue)),
-            'casilla_60_exportaciones': str(redondear(total_base_no_ue)),
-        },
-        'modelo_130': {
-            'ingresos': str(redondear(total_ingresos)),
-            'gastos_fees': str(redondear(total_fees)),
-            'rendimiento_neto': str(redondear(rendimiento_neto)),
-        },
-        'detalle_ue': pagos_ue,
-        'detalle_no_ue': pagos_no_ue,
-        'detalle_sin_pais': pagos_sin_pais if pagos_sin_pais else None,
-    }
+    def _cargar(self, moneda: str) -> Optional[Tuple[array, array]]:
+        with abrir_texto(self.archivo, newline='') as f:
+            reader = csv.reader(f)
+            cabecera = [c.strip().upper() for c in next(reader, [])]
+            if moneda not in cabecera or 'DATE' not in cabecera:
+                return None
+            i_fecha, i_tipo = cabecera.index('DATE'), cabecera.index(moneda)
+            
+            puntos = []
+            for fila in reader:
+                if len(fila) <= max(i_fecha, i_tipo):
+                    continue
+                fecha = parsear_fecha(fila[i_fecha])
+                try:
+                    tipo = _a_micros(Decimal(fila[i_tipo].strip()))
+                except (InvalidOperation, ValueError):
+                    continue
+                if fecha and isinstance(tipo, int) and tipo > 0:
+                    puntos.append((fecha.toordinal(), tipo))
+        
+        if not puntos:
+            return None
+        puntos.sort()
+        return array('l', (p[0] for p in puntos)), array('q', (p[1] for p in puntos))
+    
+    def _tipo(self, moneda: str, fecha: date) -> Optional[Decimal]:
+        """Unidades de `moneda` por 1 EUR el día `fecha` (o el hábil anterior)."""
+        if moneda not in self._series:
+            self._series[moneda] = self._cargar(moneda)
+        serie = self._series[moneda]
+        if serie is None:
+            return None
+        fechas, tipos = serie
+        ordinal = fecha.toordinal()
+        i = bisect_right(fechas, ordinal) - 1
+        if i < 0 or ordinal - fechas[i] > MAX_DIAS_SIN_TIPO:
+            return None
+        return micros_a_decimal(tipos[i])
 
-def cargar_csv(archivo: str) -> List[Dict]:
-    pagos = []
-    with open(archivo, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            pagos.append(row)
-    return pagos
+@lru_cache(maxsize=None)
+def cargar_tipos_cambio(archivo: str) -> TablaTiposCambio:
+    """Una tabla por archivo y proceso (los procesos del pool reciben la ruta)."""
+    return TablaTiposCambio(archivo)
 
-def cargar_json(archivo: str) -> List[Dict]:
-    with open(archivo, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        return data if isinstance(data, list) else data.get('data', [data])
+# ---------------------------------------------------------------------------
+# Tipos de IVA de la UE (ventanilla única, OSS)
+# ---------------------------------------------------------------------------
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Procesador de Ingresos Stripe/Substack para Autónomos',
-        epilog="""
-REGLAS APLICADAS:
-  1. IVA INCLUIDO: Base = Total / 1.21 (para UE)
-  2. Territorialidad por PAÍS (billing > ip), no por moneda
-  3. Fees de Substack/Stripe = gastos deducibles IRPF
+def es_oss(pais: Optional[str]) -> bool:
+    """País de la UE distinto de España: con OSS, su venta lleva el IVA del país."""
+    return pais in TIPOS_IVA_UE
 
-Ejemplo: python3 procesar_stripe.py --archivo pagos.csv --trimestre 4 --año 2025
+class TablaTiposIVA:
+    """
+    Tipo de IVA de cada país de la UE según la fecha, para las ventas por
+    la ventanilla única (OSS).
+    
+    Parte de TIPOS_IVA_UE. Con `archivo` (CSV con columnas pais, desde y
+    tipo; desde en AAAA-MM-DD) los países que aparecen en él se sustituyen
+    enteros por sus filas: sirve para tipos reducidos (prensa o libros
+    electrónicos) o cambios aún no recogidos aquí. Antes del primer tramo
+    se usa el primer tipo.
+    """
+    
+    def __init__(self, archivo: Optional[str] = None):
+        self.archivo = archivo
+        tramos = {pais: list(cambios) for pais, cambios in TIPOS_IVA_UE.items()}
+        if archivo:
+            propios: Dict[str, List[Tuple[date, Decimal]]] = {}
+            with abrir_texto(archivo, newline='') as f:
+                for linea, fila in enumerate(csv.DictReader(f), start=2):
+                    pais = (fila.get('pais') or '').strip().upper()
+                    desde = parsear_fecha((fila.get('desde') or '').strip())
+                    try:
+                        tipo = Decimal((fila.get('tipo') or '').strip().replace(',', '.'))
+                    except InvalidOperation:
+                        tipo = None
+                    if not es_oss(pais) or desde is None or tipo is None or not 0 <= tipo < 100:
+                        raise ValueError(f"{archivo}, línea {linea}: se esperaba pais (UE salvo ES), "
+                                         f"desde (AAAA-MM-DD) y tipo (%)")
+                    propios.setdefault(pais, []).append((desde, tipo))
+            tramos.update(propios)
+        self.tramos = {pais: sorted(cambios) for pais, cambios in tramos.items()}
+        self._fechas = {pais: [d.toordinal() for d, _ in cambios] for pais, cambios in self.tramos.items()}
+    
+    def tipo(self, pais: str, fecha: date) -> Decimal:
+        """Tipo (%) de `pais` (ver es_oss) el día `fecha`."""
+        i = bisect_right(self._fechas[pais], fecha.toordinal()) - 1
+        return self.tramos[pais][max(i, 0)][1]
+    
+    def tipos(self) -> List[Decimal]:
+        """Todos los tipos distintos de la tabla."""
+        return sorted({tipo for cambios in self.tramos.values() for _, tipo in cambios})
+    
+    def huella(self) -> str:
+        """Resumen del contenido (para invalidar checkpoints si cambia la tabla)."""
+        texto = ';'.join(f"{pais}:{desde}={tipo}" for pais, cambios in sorted(self.tramos.items())
+                         for desde, tipo in cambios)
+        return hashlib.sha256(texto.encode()).hexdigest()[:16]
+
+# ---------------------------------------------------------------------------
+# Descarga de tipos del BCE con caché en disco
+# ---------------------------------------------------------------------------
+
+URL_TIPOS_BCE = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+DIR_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'gestor-autonomos')
+CADUCIDAD_TIPOS = 12 * 3600   # segundos; el BCE publica una vez al día
+TIMEOUT_HTTP = 30
+
+class PoolConexiones:
+    """
+    Conexiones HTTP/1.1 keep-alive reutilizadas por (esquema, host, puerto):
+    varias peticiones al mismo servidor no repiten TCP ni TLS.
+    """
+    
+    def __init__(self, timeout: float = TIMEOUT_HTTP):
+        self.timeout = timeout
+        self._conexiones: Dict[Tuple[str, str, int], http.client.HTTPConnection] = {}
+        self.peticiones = 0
+    
+    def _conexion(self, clave: Tuple[str, str, int]) -> http.client.HTTPConnection:
+        conexion = self._conexiones.get(clave)
+        if conexion is None:
+            esquema, host, puerto = clave
+            clase = http.client.HTTPSConnection if esquema == 'https' else http.client.HTTPConnection
+            conexion = self._conexiones[clave] = clase(host, puerto, timeout=self.timeout)
+        return conexion
+    
+    def get(self, url: str, cabeceras: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
         """
-    )
+        GET → (estado, cabeceras, cuerpo). Reintenta una vez si el servidor
+        cerró la conexión. Tras cualquier error la conexión se descarta: su
+        estado ya no es fiable y la siguiente petición abre otra.
+        """
+        partes = urllib.parse.urlsplit(url)
+        clave = (partes.scheme, partes.hostname, partes.port or (443 if partes.scheme == 'https' else 80))
+        ruta = partes.path + ('?' + partes.query if partes.query else '')
+        for intento in (1, 2):
+            conexion = self._conexion(clave)
+            try:
+                conexion.request('GET', ruta or '/', headers=cabeceras or {})
+                respuesta = conexion.getresponse()
+                cuerpo = respuesta.read()
+                self.peticiones += 1
+                return respuesta.status, {k.lower(): v for k, v in respuesta.getheaders()}, cuerpo
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._descartar(clave, conexion)
+                if intento == 2:
+                    raise
+            except BaseException:
+                self._descartar(clave, conexion)
+                raise
     
-    parser.add_argument('--archivo', required=True)
-    parser.add_argument('--trimestre', type=int, required=True, choices=[1,2,3,4])
-    parser.add_argument('--año', type=int, required=True)
-    parser.add_argument('--formato', choices=['csv', 'json'], default='csv')
-    parser.add_argument('--json', action='store_true', help='Salida JSON')
-    parser.add_argument('--exportar', type=str)
-    parser.add_argument('--offline', action='store_true')
+    def _descartar(self, clave: Tuple[str, str, int], conexion: http.client.HTTPConnection):
+        conexion.close()
+        if self._conexiones.get(clave) is conexion:
+            del self._conexiones[clave]
     
-    args = parser.parse_args()
+    def cerrar(self):
+        for conexion in self._conexiones.values():
+            conexion.close()
+        self._conexiones.clear()
+
+class ProveedorTiposBCE:
+    """
+    Descarga el histórico de tipos del BCE y lo guarda en `dir_cache` como
+    CSV (el mismo formato que lee TablaTiposCambio) más un .meta.json con la
+    hora de descarga y ETag/Last-Modified.
     
-    try:
-        pagos = cargar_json(args.archivo) if args.formato == 'json' else cargar_csv(args.archivo)
-        print(f"📥 {len(pagos)} registros cargados", file=sys.stderr)
-        
-        resultado = procesar_substack_stripe(pagos, args.trimestre, args.año)
-        
-        if args.exportar:
-            with open(args.exportar, 'w', encoding='utf-8') as f:
-                json.dump(resultado, f, indent=2, ensure_ascii=False)
-            print(f"✅ Exportado a {args.exportar}", file=sys.stderr)
+    Mientras la copia no caduque no hay ninguna petición; al caducar se hace
+    un GET condicional y un 304 solo renueva la fecha. Con offline=True nunca
+    se conecta: sirve la copia aunque esté caducada, o None si no hay.
+    """
+    
+    def __init__(self, url: str = URL_TIPOS_BCE, dir_cache: str = DIR_CACHE,
+                 caducidad: float = CADUCIDAD_TIPOS, offline: bool = False,
+                 pool: Optional[PoolConexiones] = None):
+        self.url = url
+        self.dir_cache = dir_cache
+        self.caducidad = caducidad
+        self.offline = offline
+        self.pool = pool or PoolConexiones()
+        nombre = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+        self.ruta_csv = os.path.join(dir_cache, f"tipos-bce-{nombre}.csv")
+        self.ruta_meta = self.ruta_csv + '.meta.json'
+    
+    def _leer_meta(self) -> Optional[Dict]:
+        if not os.path.exists(self.ruta_csv):
+            return None
+        try:
+            with open(self.ruta_meta, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _escribir(self, ruta: str, datos: bytes):
+        temporal = ruta + '.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(datos)
+        os.replace(temporal, ruta)
+    
+    def _guardar_meta(self, cabeceras: Dict[str, str]):
+        meta = {
+            'url': self.url,
+            'descargado': time.time(),
+            'etag': cabeceras.get('etag'),
+            'last_modified': cabeceras.get('last-modified'),
+        }
+        self._escribir(self.ruta_meta, json.dumps(meta).encode('utf-8'))
+    
+    @staticmethod
+    def _extraer_csv(cuerpo: bytes) -> bytes:
+        """La descarga del BCE es un zip con un único CSV; también se acepta el CSV tal cual."""
+        if cuerpo[:4] == b'PK\x03\x04':
+            with zipfile.ZipFile(io.BytesIO(cuerpo)) as z:
+                nombres = [n for n in z.namelist() if n.lower().endswith('.csv')]
+                if not nombres:
+                    raise ValueError("El zip de tipos de cambio no contiene ningún CSV")
+                return z.read(nombres[0])
+        return cuerpo
+    
+    def obtener(self) -> Optional[str]:
+        """Ruta del CSV en caché, descargándolo solo si falta o ha caducado."""
+        meta = self._leer_meta()
+        if self.offline:
+            if meta is None:
+                print("⚠️  --offline sin tipos del BCE en caché: se usan los tipos fijos", file=sys.stderr)
+                return None
+            return self.ruta_csv
+        if meta is not None and time.time() - meta.get('descargado', 0) < self.caducidad:
+            return self.ruta_csv
+        
+        cabeceras = {}
+        if meta is not None:
+            if meta.get('etag'):
+                cabeceras['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                cabeceras['If-Modified-Since'] = meta['last_modified']
+        try:
+            estado, respuesta, cuerpo = self.pool.get(self.url, cabeceras)
+        except OSError as e:
+            if meta is None:
+                raise
+            print(f"⚠️  No se pudo actualizar los tipos del BCE ({e}): se usa la caché", file=sys.stderr)
+            return self.ruta_csv
+        
+        if estado == 304 and meta is not None:
+            self._guardar_meta({'etag': meta.get('etag'), 'last-modified': meta.get('last_modified'), **respuesta})
+            return self.ruta_csv
+        if estado != 200:
+            raise ValueError(f"Descarga de tipos de cambio fallida: HTTP {estado} en {self.url}")
+        
+        os.makedirs(self.dir_cache, exist_ok=True)
+        self._escribir(self.ruta_csv, self._extraer_csv(cuerpo))
+        self._guardar_meta(respuesta)
+        print(f"🌐 Tipos del BCE descargados en {self.ruta_csv}", file=sys.stderr)
+        return self.ruta_csv
+
+URL_API_STRIPE = 'https://api.stripe.com'
+TAM_PAGINA_STRIPE = 100          # Máximo que admite la API por página
+DIAS_VENTANA_STRIPE = 7          # Tramo de fechas que descarga cada petición paginada
+CONEXIONES_STRIPE = 4
+MAX_REINTENTOS_HTTP = 5
+MARGEN_CACHE_STRIPE = 3600       # Un tramo se guarda en caché cuando lleva 1 h cerrado
+
+# Monedas cuyo importe en la API no va en céntimos
+MONEDAS_SIN_DECIMALES = {'BIF', 'CLP', 'DJF', 'GNF', 'JPY', 'KMF', 'KRW', 'MGA',
+                         'PYG', 'RWF', 'UGX', 'VND', 'VUV', 'XAF', 'XOF', 'XPF'}
+
+def fila_de_cargo(cargo: Dict) -> Dict[str, str]:
+    """Un cargo de la API como fila de la exportación de pagos del Dashboard."""
+    moneda = (cargo.get('currency') or '').upper()
+    importe = Decimal(int(cargo.get('amount') or 0))
+    reembolsado = Decimal(int(cargo.get('amount_refunded') or 0))
+    if moneda not in MONEDAS_SIN_DECIMALES:
+        importe = importe.scaleb(-2)
+        reembolsado = reembolsado.scaleb(-2)
+    facturacion = cargo.get('billing_details') or {}
+    tarjeta = (cargo.get('payment_method_details') or {}).get('card') or {}
+    creado = datetime.fromtimestamp(cargo.get('created') or 0, tz=timezone.utc)
+    return {
+        'id': cargo.get('id') or '',
+        'Amount': str(importe),
+        'Amount Refunded': str(reembolsado) if reembolsado else '',
+        'Currency': moneda,
+        'Created (UTC)': creado.strftime('%Y-%m-%d %H:%M:%S'),
+        'Customer Email': facturacion.get('email') or cargo.get('receipt_email') or '',
+        'country (billing)': (facturacion.get('address') or {}).get('country') or '',
+        'Card Country': tarjeta.get('country') or '',
+        'Status': cargo.get('status') or '',
+    }
+
+class ClienteStripe:
+    """
+    Descarga los cargos de un rango de fechas con la API REST de Stripe
+    (GET /v1/charges), en lugar de exportarlos a mano desde el Dashboard.
+    
+    El rango se parte en tramos de DIAS_VENTANA_STRIPE días que se piden en
+    paralelo, cada hilo con sus conexiones keep-alive (PoolConexiones); dentro
+    de un tramo las páginas van en orden con starting_after. Un 429 (límite
+    de peticiones) o un 5xx se reintenta tras Retry-After o con espera
+    exponencial.
+    
+    Las páginas de tramos ya cerrados se guardan en `dir_cache`, así que
+    repetir un trimestre pasado no hace ninguna petición; con offline=True
+    solo se usa la caché. La clave de la caché incluye un hash de la clave
+    de API, nunca la clave.
+    
+    `crear_pool` (un pool por hilo) y `esperar` (las pausas entre reintentos)
+    se pueden sustituir, p. ej. para probarlo sin red ni esperas.
+    """
+    
+    def __init__(self, clave: str, url: str = URL_API_STRIPE, dir_cache: str = DIR_CACHE,
+                 conexiones: int = CONEXIONES_STRIPE, offline: bool = False,
+                 crear_pool: Callable[[], PoolConexiones] = PoolConexiones,
+                 esperar: Callable[[float], None] = time.sleep):
+        self.url = url.rstrip('/')
+        self.dir_cache = os.path.join(dir_cache, 'stripe')
+        self.conexiones = max(1, conexiones)
+        self.offline = offline
+        self.crear_pool = crear_pool
+        self.esperar = esperar
+        self._cabeceras = {'Authorization': f'Bearer {clave}'}
+        self._cuenta = hashlib.sha256(clave.encode('utf-8')).hexdigest()[:16]
+        self._local = threading.local()
+        self._pools: List[PoolConexiones] = []
+        self._cerrojo = threading.Lock()
+        self.paginas_cache = 0
+    
+    @property
+    def peticiones(self) -> int:
+        return sum(pool.peticiones for pool in self._pools)
+    
+    def _pool(self) -> PoolConexiones:
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = self.crear_pool()
+            with self._cerrojo:
+                self._pools.append(pool)
+        return pool
+    
+    def _ruta_cache(self, url: str) -> str:
+        nombre = hashlib.sha256(f"{self._cuenta} {url}".encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.dir_cache, f"{nombre}.json")
+    
+    def _pagina(self, params: Dict[str, str], guardar: bool) -> Dict:
+        """Una página de /v1/charges, de la caché si está."""
+        url = f"{self.url}/v1/charges?{urllib.parse.urlencode(params)}"
+        ruta = self._ruta_cache(url)
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                pagina = json.load(f)
+            with self._cerrojo:
+                self.paginas_cache += 1
+            return pagina
+        except (OSError, ValueError):
+            pass
+        if self.offline:
+            raise RuntimeError(f"--offline y sin caché para {url}")
+        
+        for intento in range(MAX_REINTENTOS_HTTP):
+            estado, cabeceras, cuerpo = self._pool().get(url, self._cabeceras)
+            if estado == 200:
+                break
+            if estado == 429 or estado >= 500:
+                espera = float(cabeceras.get('retry-after') or 0) or min(0.5 * 2 ** intento, 8)
+                self.esperar(espera)
+                continue
+            try:
+                mensaje = json.loads(cuerpo)['error']['message']
+            except (ValueError, KeyError, TypeError):
+                mensaje = cuerpo[:200].decode('utf-8', 'replace')
+            raise RuntimeError(f"API de Stripe: HTTP {estado}: {mensaje}")
+        else:
+            raise RuntimeError(f"API de Stripe: HTTP {estado} tras {MAX_REINTENTOS_HTTP} intentos")
+        
+        pagina = json.loads(cuerpo)
+        if guardar:
+            os.makedirs(self.dir_cache, exist_ok=True)
+            temporal = f"{ruta}.{threading.get_ident()}.tmp"
+            with open(temporal, 'wb') as f:
+                f.write(cuerpo)
+            os.replace(temporal, ruta)
+        return pagina
+    
+    def _cargos_tramo(self, desde: int, hasta: int) -> List[Dict]:
+        """Todos los cargos con desde <= created < hasta (segundos UNIX), página a página."""
+        guardar = hasta <= time.time() - MARGEN_CACHE_STRIPE
+        params = {'created[gte]': str(desde), 'created[lt]': str(hasta), 'limit': str(TAM_PAGINA_STRIPE)}
+        cargos = []
+        while True:
+            pagina = self._pagina(params, guardar)
+            datos = pagina.get('data') or []
+            cargos.extend(datos)
+            if not pagina.get('has_more') or not datos:
+                return cargos
+            params['starting_after'] = datos[-1]['id']
+    
+    def cargos(self, desde: datetime, hasta: datetime) -> Iterator[Dict]:
+        """Cargos del rango [desde, hasta), tramo a tramo en orden de fechas."""
+        inicio, fin = int(desde.timestamp()), int(hasta.timestamp())
+        paso = DIAS_VENTANA_STRIPE * 86400
+        tramos = [(t, min(t + paso, fin)) for t in range(inicio, fin, paso)]
+        with ThreadPoolExecutor(max_workers=self.conexiones) as hilos:
+            for cargos in hilos.map(lambda tramo: self._cargos_tramo(*tramo), tramos):
+                yield from cargos
+    
+    def cerrar(self):
+        for pool in self._pools:
+            pool.cerrar()
+
+def rango_trimestres(año: int, trimestres: Iterable[int]) -> Tuple[datetime, datetime]:
+    """[inicio, fin) en UTC que cubre los trimestres pedidos de `año` en hora de Madrid."""
+    def medianoche_madrid(dia: datetime) -> datetime:
+        # A medianoche nunca hay cambio de hora: vale el desfase de la medianoche UTC
+        return dia - timedelta(seconds=desfase_madrid(int(dia.timestamp())))
+    
+    trimestres = sorted(trimestres)
+    inicio = datetime(año, 3 * trimestres[0] - 2, 1, tzinfo=timezone.utc)
+    ultimo = trimestres[-1]
+    fin = datetime(año + 1, 1, 1, tzinfo=timezone.utc) if ultimo == 4 else \
+        datetime(año, 3 * ultimo + 1, 1, tzinfo=timezone.utc)
+    return medianoche_madrid(inicio), medianoche_madrid(fin)
+
+def filas_api_stripe(
+    cliente: ClienteStripe,
+    año: int,
+    trimestres: Iterable[int]
+) -> Tuple[Optional['EsquemaPagos'], Iterator[List[str]]]:
+    """(esquema, filas) de los cargos cobrados en los trimestres, como si vinieran de un CSV."""
+    desde, hasta = rango_trimestres(año, trimestres)
+    cobrados = (fila_de_cargo(c) for c in cliente.cargos(desde, hasta) if c.get('status') == 'succeeded')
+    return filas_desde_dicts(cobrados)
+
+class FilaIncompleta(list):
+    """
+    Fila de CSV con menos campos de los que usa el esquema (cortada o mal
+    partida). EsquemaPagos.normalizar la rellena con '' para que ningún
+    índice falle y le vacía el importe: todos los bucles la saltan como un
+    importe cero, y al verla la registran como error de fila (registrar).
+    """
+    __slots__ = ('original', 'esperadas')
+    
+    def registrar(self, errores: 'ErroresFilas', linea: int):
+        error = ValueError(f"Fila incompleta: {len(self.original)} de {self.esperadas} columnas")
+        errores.añadir(error, '', linea, ','.join(self.original))
+
+class EsquemaPagos:
+    """
+    Posición de cada campo en las filas de un archivo de pagos.
+    
+    Se resuelve una vez por archivo a partir de la cabecera. Los campos que
+    no existen apuntan a una columna extra vacía que se añade a cada fila, así
+    el bucle por fila solo hace accesos por índice.
+    """
+    __slots__ = ('formato', 'columnas', 'importe', 'moneda', 'fecha',
+                 'substack_fee', 'stripe_fee', 'email', 'id', 'cargo', 'reembolsado', 'paises',
+                 'ancho_minimo', 'alternativas')
+    
+    def __init__(self, columnas: List[str]):
+        self.columnas = list(columnas)
+        self.alternativas: Tuple[Tuple[int, Tuple[str, ...]], ...] = ()
+        vacia = len(self.columnas)
+        posiciones = {}
+        for i, nombre in enumerate(self.columnas):
+            posiciones.setdefault(nombre, i)
+        
+        def resolver(alias: List[str]) -> Optional[int]:
+            for nombre in alias:
+                if nombre in posiciones:
+                    return posiciones[nombre]
+            return None
+        
+        if resolver(COLUMNAS['importe']) is None:
+            raise ValueError(
+                "Formato de exportación no reconocido: falta la columna de importe "
+                f"({' / '.join(COLUMNAS['importe'])}). Columnas encontradas: {', '.join(self.columnas)}"
+            )
+        
+        for campo, alias in COLUMNAS.items():
+            indice = resolver(alias)
+            setattr(self, campo, vacia if indice is None else indice)
+        self.paises = tuple(posiciones[n] for n in COLUMNAS_PAIS if n in posiciones)
+        # Una fila más corta pierde algún campo que se usa; más larga o sin
+        # columnas finales que no se usan, se ajusta sin más
+        usadas = [getattr(self, campo) for campo in COLUMNAS] + list(self.paises)
+        self.ancho_minimo = max(i for i in usadas if i < vacia) + 1
+        
+        if resolver(COLUMNAS['substack_fee']) is not None:
+            self.formato = 'substack'
+        elif 'Created (UTC)' in posiciones:
+            self.formato = 'stripe'
+        else:
+            self.formato = 'generico'
+    
+    def nombre(self, campo: str) -> str:
+        """Cabecera de la columna de `campo` (el propio campo si no existe)."""
+        indice = getattr(self, campo)
+        return self.columnas[indice] if indice < len(self.columnas) else campo
+    
+    def existe(self, campo: str) -> bool:
+        """El archivo tiene columna para `campo`."""
+        return getattr(self, campo) < len(self.columnas)
+    
+    @property
+    def fecha_utc(self) -> bool:
+        """La fecha lleva hora UTC (Stripe: 'Created (UTC)'): cuenta su día en Madrid."""
+        return 'UTC' in self.nombre('fecha')
+    
+    @classmethod
+    def de_registros(cls, primero: Dict) -> 'EsquemaPagos':
+        """
+        Esquema para registros dict (JSON, API), que pueden omitir claves
+        opcionales registro a registro. A las claves del primero se añaden
+        el primer alias de cada campo que no trae y las columnas de país que
+        faltan, y desde_dict busca cada campo por todos sus alias en cada
+        registro, como el pago.get(...) del script original.
+        """
+        propias = list(primero.keys())
+        columnas = list(propias)
+        presentes = set(columnas)
+        for alias in COLUMNAS.values():
+            if presentes.isdisjoint(alias):
+                columnas.append(alias[0])
+                presentes.add(alias[0])
+        columnas += [nombre for nombre in COLUMNAS_PAIS if nombre not in presentes]
+        esquema = cls(columnas)
+        esquema.formato = cls(propias).formato
+        esquema.alternativas = tuple(
+            (getattr(esquema, campo), tuple(a for a in alias if a != esquema.nombre(campo)))
+            for campo, alias in COLUMNAS.items())
+        return esquema
+    
+    def normalizar(self, fila: List[str]) -> List[str]:
+        """
+        Ajusta una fila de csv.reader al ancho de la cabecera + columna vacía.
+        Si le faltan campos que se usan, devuelve una FilaIncompleta.
+        """
+        n = len(self.columnas)
+        if len(fila) != n:
+            if len(fila) < self.ancho_minimo:
+                incompleta = FilaIncompleta(fila + [''] * (n + 1 - len(fila)))
+                incompleta.original = fila
+                incompleta.esperadas = n
+                incompleta[self.importe] = ''
+                return incompleta
+            fila = fila[:n] + [''] * (n - len(fila))
+        fila.append('')
+        return fila
+    
+    def desde_dict(self, pago: Dict) -> List[str]:
+        """Convierte un registro dict (JSON, DictReader) a fila por índice."""
+        fila = []
+        for nombre in self.columnas:
+            valor = pago.get(nombre)
+            fila.append('' if valor is None else valor if isinstance(valor, str) else str(valor))
+        # Campo que este registro trae con otro alias (ver de_registros)
+        for i, alias in self.alternativas:
+            if not fila[i]:
+                for nombre in alias:
+                    valor = pago.get(nombre)
+                    if valor is not None:
+                        fila[i] = valor if isinstance(valor, str) else str(valor)
+                        break
+        fila.append('')
+        return fila
+
+def filas_desde_dicts(pagos: Iterable[Dict]) -> Tuple[Optional[EsquemaPagos], Iterator[List[str]]]:
+    """
+    Resuelve el esquema a partir del primer registro (ver
+    EsquemaPagos.de_registros) y devuelve (esquema, filas). Si no hay
+    registros el esquema es None.
+    """
+    pagos = iter(pagos)
+    primero = next(pagos, None)
+    if primero is None:
+        return None, iter(())
+    esquema = EsquemaPagos.de_registros(primero)
+    
+    def filas() -> Iterator[List[str]]:
+        yield esquema.desde_dict(primero)
+        for pago in pagos:
+            yield esquema.desde_dict(pago)
+    
+    return esquema, filas()
+
+def leer_filas_csv(archivo: str) -> Tuple[Optional[EsquemaPagos], Iterator[List[str]]]:
+    """
+    Abre un CSV con csv.reader y resuelve su esquema con la cabecera.
+    Devuelve (esquema, filas); las filas se leen bajo demanda.
+    """
+    f = abrir_texto(archivo, newline='')
+    reader = csv.reader(f)
+    cabecera = next(reader, None)
+    if cabecera is None:
+        f.close()
+        return None, iter(())
+    try:
+        esquema = EsquemaPagos(cabecera)
+    except ValueError:
+        f.close()
+        raise
+    
+    def filas() -> Iterator[List[str]]:
+        with f:
+            normalizar = esquema.normalizar
+            for fila in reader:
+                if fila:
+                    yield normalizar(fila)
+    
+    return esquema, filas()
+
+CABECERA_INDICE = b'GAIDX\x00\x00\x01'
+
+@lru_cache(maxsize=TAM_CACHE_IMPORTES)
+def es_negativo(valor: str) -> bool:
+    """El importe es menor que cero (reembolso o contracargo); '-0.00' no lo es."""
+    importe, _ = parsear_importe(valor)
+    return importe.is_signed() and not importe.is_zero()
+
+def fecha_con_hora(valor: str) -> bool:
+    """Si la fecha lleva hora ('2025-10-02 14:30:00', ISO con 'T', o segundos Unix de la API)."""
+    valor = valor.strip()
+    return ':' in valor or valor.isdigit()
+
+class TablaHashes:
+    """
+    Tabla de direccionamiento abierto de hashes de 64 bits (ver
+    IndicePagos.hash_clave; 0 marca hueco libre) sobre array('Q'), con un
+    entero por hueco en un array paralelo si se da su `tipo_valor` (código
+    de array). Como mucho la mitad de los huecos ocupados: al pasar de ahí
+    dobla su tamaño y recoloca. Es la tabla de IndicePagos (sin valores),
+    PaisesPorEmail (código de país) y Suscriptores (número de suscriptor).
+    """
+    
+    def __init__(self, tipo_valor: Optional[str] = None, hashes: Optional[array] = None):
+        self.hashes = hashes if hashes is not None else array('Q', bytes(8 * 1024))
+        self.tipo_valor = tipo_valor
+        self.valores = self._valores_vacios(len(self.hashes))
+        self.num = len(self.hashes) - self.hashes.count(0)
+    
+    def _valores_vacios(self, huecos: int) -> Optional[array]:
+        if self.tipo_valor is None:
+            return None
+        return array(self.tipo_valor, bytes(array(self.tipo_valor).itemsize * huecos))
+    
+    def hueco(self, h: int) -> int:
+        """Hueco de `h`: el suyo si está, o el libre donde iría."""
+        tabla = self.hashes
+        mascara = len(tabla) - 1
+        i = h & mascara
+        while True:
+            actual = tabla[i]
+            if actual == h or actual == 0:
+                return i
+            i = (i + 1) & mascara
+    
+    def __contains__(self, h: int) -> bool:
+        return self.hashes[self.hueco(h)] == h
+    
+    def valor(self, h: int) -> Optional[int]:
+        """Valor de `h`, o None si no está."""
+        i = self.hueco(h)
+        return self.valores[i] if self.hashes[i] == h else None
+    
+    def añadir(self, h: int, valor: int = 0) -> bool:
+        """Añade `h` con su valor; False (y sin tocar su valor) si ya estaba."""
+        i = self.hueco(h)
+        if self.hashes[i] == h:
+            return False
+        self.hashes[i] = h
+        if self.valores is not None:
+            self.valores[i] = valor
+        self.num += 1
+        if 2 * self.num > len(self.hashes):
+            hashes, valores = self.hashes, self.valores
+            self.hashes = array('Q', bytes(16 * len(hashes)))
+            self.valores = self._valores_vacios(len(self.hashes))
+            for j, h in enumerate(hashes):
+                if h:
+                    i = self.hueco(h)
+                    self.hashes[i] = h
+                    if valores is not None:
+                        self.valores[i] = valores[j]
+        return True
+
+class IndicePagos:
+    """
+    Pagos ya contados, para descartar los duplicados de descargas solapadas
+    (el mismo cargo en dos exportaciones, o dos veces en la misma).
+    
+    La clave es el id del cargo; sin id, fecha + email + importe + moneda,
+    con la fecha tal cual (hasta el segundo si lleva hora). Si la fecha no
+    lleva hora, dos compras iguales del mismo día tendrían la misma clave:
+    esas filas pasan sin deduplicar (se cuentan en `sin_clave`) salvo con
+    `por_dia`, que acepta el riesgo para exportaciones que solo traen el día.
+    Solo se guarda un hash de 64 bits de la clave en una TablaHashes: 8
+    bytes por hueco y como mucho la mitad ocupados, unos 16-32 bytes por pago frente a los más de
+    100 de un set de str. Con 10M de pagos la probabilidad de que dos
+    claves distintas compartan hash es del orden de 1 entre 370.000.
+    
+    `otros` son índices que también cuentan como ya vistos pero no se
+    modifican (los de los demás archivos en --incremental). guardar() y
+    cargar() llevan la tabla a disco tal cual.
+    """
+    
+    def __init__(self, tabla: Optional[array] = None, por_dia: bool = False):
+        self._tabla = TablaHashes(hashes=tabla)
+        self.por_dia = por_dia
+        self.duplicados = 0
+        self.sin_clave = 0
+        self.otros: List['IndicePagos'] = []
+    
+    @property
+    def num(self) -> int:
+        return self._tabla.num
+    
+    def vaciar(self):
+        self._tabla = TablaHashes()
+    
+    @staticmethod
+    def hash_clave(clave: str) -> int:
+        """Hash estable entre ejecuciones (hash() de Python no lo es); 0 marca hueco libre."""
+        return int.from_bytes(hashlib.blake2b(clave.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+    
+    def __contains__(self, h: int) -> bool:
+        return h in self._tabla
+    
+    def añadir(self, h: int) -> bool:
+        """Añade el hash; False si ya estaba."""
+        return self._tabla.añadir(h)
+    
+    def filtrar(self, filas: Iterable[List[str]], esquema: EsquemaPagos) -> Iterator[List[str]]:
+        """
+        Deja pasar cada pago la primera vez que aparece (aquí o en `otros`)
+        y lo añade a este índice; los repetidos se cuentan en `duplicados`.
+        Un reembolso (importe negativo) puede llevar el id del cargo que
+        rectifica: su clave lleva además fecha e importe, para no confundirse
+        con el cargo ni con otro reembolso parcial del mismo cargo.
+        """
+        otros = [otro for otro in self.otros if otro is not self]
+        i_id = esquema.id
+        i_importe = esquema.importe
+        i_fecha = esquema.fecha
+        claves_compuestas = (esquema.fecha, esquema.email, esquema.importe, esquema.moneda)
+        hash_clave = self.hash_clave
+        por_dia = self.por_dia
+        for fila in filas:
+            if fila.__class__ is FilaIncompleta:
+                yield fila  # Sin clave fiable: el bucle que la recibe la registra como error
+                continue
+            clave = fila[i_id].strip()
+            if not clave:
+                if not por_dia and not fecha_con_hora(fila[i_fecha]):
+                    self.sin_clave += 1
+                    yield fila
+                    continue
+                clave = '\x1f'.join([fila[i].strip().lower() for i in claves_compuestas])
+            elif es_negativo(fila[i_importe]):
+                clave = '\x1f'.join(['reembolso', clave, fila[i_fecha].strip(), fila[i_importe].strip()])
+            h = hash_clave(clave)
+            if any(h in otro for otro in otros) or not self.añadir(h):
+                self.duplicados += 1
+                continue
+            yield fila
+    
+    @classmethod
+    def cargar(cls, ruta: str, por_dia: bool = False) -> 'IndicePagos':
+        """Índice guardado con guardar(); vacío si no existe o no es válido."""
+        try:
+            with open(ruta, 'rb') as f:
+                if f.read(len(CABECERA_INDICE)) != CABECERA_INDICE:
+                    return cls(por_dia=por_dia)
+                tabla = array('Q')
+                tabla.frombytes(f.read())
+        except (OSError, ValueError):
+            return cls(por_dia=por_dia)
+        if not tabla or len(tabla) & (len(tabla) - 1):
+            return cls(por_dia=por_dia)
+        return cls(tabla, por_dia)
+    
+    def guardar(self, ruta: str):
+        temporal = ruta + '.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(CABECERA_INDICE)
+            self._tabla.hashes.tofile(f)
+        os.replace(temporal, ruta)
+
+CABECERA_CARGOS = b'GACRG\x00\x00\x01'
+
+class IndiceCargos:
+    """
+    País de cada cargo por su id, para clasificar los reembolsos y
+    contracargos igual que el cargo que rectifican (ver
+    vincular_rectificaciones).
+    
+    Cada cargo añade el hash de 64 bits de su id (IndicePagos.hash_clave) y
+    el código de su país (0 = sin país) a dos arrays que solo crecen: 10
+    bytes y dos append por cargo, sin tabla que recolocar. Los reembolsos
+    son pocos, así que buscar() hace un hash join con ellos como lado
+    pequeño: un dict con sus hashes y una pasada por los cargos, O(1) por
+    cargo y por reembolso. Si un id se repite, vale el primer cargo.
+    
+    guardar() y cargar() permiten vincular los reembolsos de un trimestre
+    con cargos de trimestres anteriores (--indice-cargos).
+    """
+    
+    def __init__(self, hashes: Optional[array] = None, codigos: Optional[array] = None,
+                 paises: Optional[List[str]] = None):
+        self.hashes = hashes if hashes is not None else array('Q')
+        self.codigos = codigos if codigos is not None else array('H')
+        self.paises = paises if paises is not None else ['']
+        self.codigo_pais = {pais: i for i, pais in enumerate(self.paises)}
+    
+    @property
+    def num(self) -> int:
+        return len(self.hashes)
+    
+    def vaciar(self):
+        self.hashes = array('Q')
+        self.codigos = array('H')
+    
+    def codigo(self, pais: Optional[str]) -> int:
+        """Código del país en `paises` (lo añade si es nuevo; 0 = sin país)."""
+        pais = pais or ''
+        codigo = self.codigo_pais.get(pais)
+        if codigo is None:
+            codigo = self.codigo_pais[pais] = len(self.paises)
+            self.paises.append(pais)
+        return codigo
+    
+    def asignar(self, h: int, pais: Optional[str]):
+        """
+        Apunta el cargo de hash `h` con su país (None si no tiene). En los
+        bucles por fila se hace en línea con hashes, codigos y codigo_pais.
+        """
+        self.hashes.append(h)
+        self.codigos.append(self.codigo(pais))
+    
+    def buscar(self, hashes: Iterable[int]) -> Dict[int, str]:
+        """{hash: país del cargo ('' si no tenía)} de los `hashes` que estén."""
+        buscados = set(hashes)
+        encontrados = {}
+        if buscados:
+            paises = self.paises
+            for h, codigo in zip(self.hashes, self.codigos):
+                if h in buscados and h not in encontrados:
+                    encontrados[h] = paises[codigo]
+        return encontrados
+    
+    def fusionar(self, otro: 'IndiceCargos') -> 'IndiceCargos':
+        """Añade los cargos de `otro` detrás de los de este."""
+        codigos = [self.codigo(pais) for pais in otro.paises]
+        self.hashes.extend(otro.hashes)
+        self.codigos.extend(codigos[c] for c in otro.codigos)
+        return self
+    
+    @classmethod
+    def cargar(cls, ruta: str) -> 'IndiceCargos':
+        """Índice guardado con guardar(); vacío si no existe o no es válido."""
+        try:
+            with open(ruta, 'rb') as f:
+                if f.read(len(CABECERA_CARGOS)) != CABECERA_CARGOS:
+                    return cls()
+                paises = f.readline().decode('utf-8').rstrip('\n').split('\x1f')
+                hashes = array('Q')
+                hashes.frombytes(f.read(8 * int(f.readline())))
+                codigos = array('H')
+                codigos.frombytes(f.read())
+        except (OSError, ValueError):
+            return cls()
+        if len(codigos) != len(hashes) or any(c >= len(paises) for c in set(codigos)):
+            return cls()
+        return cls(hashes, codigos, paises)
+    
+    def guardar(self, ruta: str):
+        """Guarda cada cargo una vez (al volver a leer un periodo se repiten)."""
+        vistos = set()
+        hashes, codigos = array('Q'), array('H')
+        for h, codigo in zip(self.hashes, self.codigos):
+            if h not in vistos:
+                vistos.add(h)
+                hashes.append(h)
+                codigos.append(codigo)
+        temporal = ruta + '.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(CABECERA_CARGOS)
+            f.write('\x1f'.join(self.paises).encode('utf-8') + b'\n')
+            f.write(f"{len(hashes)}\n".encode('ascii'))
+            hashes.tofile(f)
+            codigos.tofile(f)
+        os.replace(temporal, ruta)
+
+class PaisesPorEmail:
+    """
+    País de cada cliente por su email, sacado de una exportación de
+    clientes o cargos de Stripe (--clientes), para completar los pagos que
+    llegan sin país (muchos de Substack) en vez de tratarlos como UE.
+    
+    leer() recorre la exportación fila a fila y solo guarda el hash de 64
+    bits del email en minúsculas (IndicePagos.hash_clave) y el código de su
+    país, en una TablaHashes con valores array('H'): 10 bytes por hueco y
+    como mucho la mitad ocupados, sin ningún email en memoria. Un email que aparece con dos países distintos
+    no se usa (criterio conservador: el pago sigue sin país).
+    """
+    
+    def __init__(self):
+        self._tabla = TablaHashes('H')
+        self.paises = ['']  # Código 0: email con países distintos
+        self._codigo_pais = {'': 0}
+        self.ambiguos = 0
+    
+    @property
+    def num(self) -> int:
+        return self._tabla.num
+    
+    def apuntar(self, email: str, pais: str):
+        """Apunta el país de `email`; si ya tenía otro, el email queda sin país."""
+        h = IndicePagos.hash_clave(email.strip().lower())
+        codigo = self._codigo_pais.get(pais)
+        if codigo is None:
+            codigo = self._codigo_pais[pais] = len(self.paises)
+            self.paises.append(pais)
+        tabla = self._tabla
+        if not tabla.añadir(h, codigo):
+            i = tabla.hueco(h)
+            previo = tabla.valores[i]
+            if previo and previo != codigo:
+                tabla.valores[i] = 0
+                self.ambiguos += 1
+    
+    def pais(self, email: str) -> Optional[str]:
+        """País del cliente con ese email (None si no está o tiene varios)."""
+        email = email.strip().lower()
+        if not email:
+            return None
+        codigo = self._tabla.valor(IndicePagos.hash_clave(email))
+        return self.paises[codigo] or None if codigo is not None else None
+    
+    def huella(self) -> str:
+        """Resumen del contenido, para invalidar los checkpoints si cambia."""
+        h = hashlib.blake2b(digest_size=16)
+        h.update('\x1f'.join(self.paises).encode('utf-8'))
+        h.update(self._tabla.hashes)
+        h.update(self._tabla.valores)
+        return h.hexdigest()
+    
+    @classmethod
+    def leer(cls, archivo: str) -> 'PaisesPorEmail':
+        """
+        Índice de una exportación CSV (comprimida o no) con el email en una
+        de COLUMNAS_EMAIL_CLIENTES y el país en la primera con valor de
+        COLUMNAS_PAIS_CLIENTES. La memoria depende del número de clientes,
+        no del tamaño del archivo.
+        """
+        indice = cls()
+        with abrir_texto(archivo, newline='') as f:
+            reader = csv.reader(f)
+            posiciones = {}
+            for i, nombre in enumerate(next(reader, None) or []):
+                posiciones.setdefault(nombre.strip(), i)
+            i_email = next((posiciones[n] for n in COLUMNAS_EMAIL_CLIENTES if n in posiciones), None)
+            i_paises = [posiciones[n] for n in dict.fromkeys(COLUMNAS_PAIS_CLIENTES) if n in posiciones]
+            if i_email is None or not i_paises:
+                raise ValueError(
+                    f"{archivo}: la exportación de clientes necesita una columna de email "
+                    f"({' / '.join(COLUMNAS_EMAIL_CLIENTES)}) y una de país "
+                    f"({' / '.join(COLUMNAS_PAIS_CLIENTES[:4])}...)"
+                )
+            ancho = max(i_email, *i_paises) + 1
+            apuntar = indice.apuntar
+            for fila in reader:
+                if len(fila) < ancho:
+                    fila += [''] * (ancho - len(fila))
+                email = fila[i_email]
+                if not email.strip():
+                    continue
+                for i in i_paises:
+                    pais = fila[i].strip().upper()
+                    if pais not in VALORES_PAIS_VACIOS:
+                        apuntar(email, pais)
+                        break
+        return indice
+
+def procesar_substack_stripe(
+    pagos: Iterable[Dict],
+    trimestre: int,
+    año: int,
+    detalle: bool = True
+) -> Dict:
+    """
+    Procesa pagos de Substack o Stripe.
+    
+    `pagos` puede ser una lista o cualquier iterable (p. ej. `iterar_csv`);
+    se recorre una sola vez. Con detalle=False no se guardan las listas de
+    pagos y la memoria usada no depende del tamaño del archivo.
+    
+    Las columnas se resuelven una vez a partir del primer registro (ver
+    EsquemaPagos.de_registros).
+    """
+    esquema, filas = filas_desde_dicts(pagos)
+    return procesar_filas(filas, esquema, trimestre, año, detalle)
+
+MAX_MUESTRAS_ERROR = 5
+LARGO_VALOR_ERROR = 100
+
+class ErroresFilas:
+    """
+    Filas que no se han podido procesar, agrupadas por clase de error y
+    columna: cuántas hay y una muestra de las primeras (línea, valor
+    original y mensaje), como mucho MAX_MUESTRAS_ERROR por grupo.
+    
+    Registrar un error es una búsqueda en un dict y, mientras la muestra no
+    está llena, un append; no se escribe nada por fila en stderr. La línea
+    es la del CSV (cabecera = 1) si ningún campo ocupa varias líneas; en
+    JSON, el número de registro + 1.
+    """
+    __slots__ = ('grupos',)
+    
+    def __init__(self):
+        self.grupos: Dict[Tuple[str, str], Dict] = {}
+    
+    def registrar(self, clase: str, columna: str, veces: int, muestras: Iterable[Dict]):
+        """Suma `veces` filas al grupo (clase, columna) y completa su muestra."""
+        grupo = self.grupos.get((clase, columna))
+        if grupo is None:
+            grupo = self.grupos[(clase, columna)] = {'clase': clase, 'columna': columna, 'count': 0, 'muestras': []}
+        grupo['count'] += veces
+        propias = grupo['muestras']
+        propias.extend(islice(muestras, MAX_MUESTRAS_ERROR - len(propias)))
+    
+    def añadir(self, error: Exception, columna: str, linea: int, valor: str):
+        """Una fila con error."""
+        grupo = self.grupos.get((type(error).__name__, columna))
+        if grupo is not None and len(grupo['muestras']) >= MAX_MUESTRAS_ERROR:
+            grupo['count'] += 1
+            return
+        self.registrar(type(error).__name__, columna, 1,
+                       [{'linea': linea, 'valor': valor[:LARGO_VALOR_ERROR], 'mensaje': str(error)}])
+    
+    @property
+    def num_filas(self) -> int:
+        return sum(grupo['count'] for grupo in self.grupos.values())
+    
+    def fusionar(self, otro: 'ErroresFilas') -> 'ErroresFilas':
+        """Suma los grupos de `otro`; la muestra se completa con la suya."""
+        for grupo in otro.grupos.values():
+            self.registrar(grupo['clase'], grupo['columna'], grupo['count'], iter(grupo['muestras']))
+        return self
+    
+    def ajustar_muestras(self, desplazamiento: int = 0, archivo: Optional[str] = None):
+        """Suma `desplazamiento` a las líneas (trozos de CSV) y anota el archivo de origen."""
+        for grupo in self.grupos.values():
+            for muestra in grupo['muestras']:
+                muestra['linea'] += desplazamiento
+                if archivo is not None:
+                    muestra.setdefault('archivo', archivo)
+    
+    def a_lista(self) -> List[Dict]:
+        """Grupos serializables en JSON, los más frecuentes primero."""
+        return sorted(({**g, 'muestras': [dict(m) for m in g['muestras']]} for g in self.grupos.values()),
+                      key=lambda g: -g['count'])
+    
+    @classmethod
+    def desde_lista(cls, grupos: Iterable[Dict]) -> 'ErroresFilas':
+        errores = cls()
+        for grupo in grupos:
+            errores.registrar(grupo['clase'], grupo['columna'], grupo['count'], iter(grupo['muestras']))
+        return errores
+
+class AcumuladorPagos:
+    """
+    Totales de un periodo (trimestre, año o pagos sin fecha).
+    
+    Los importes están en la unidad del motor (Decimal o micro-unidades) y
+    se formatean al final con formatear_resultado. fusionar() suma otro
+    acumulador, así un año se obtiene de sus cuatro trimestres sin releer.
+    
+    `errores` (ErroresFilas) solo lo lleva el acumulador de los pagos sin
+    fecha: una fila con error no tiene trimestre. Igual `cargos`, el
+    IndiceCargos con los cargos leídos, y `cubo_ingresos` (CuboIngresos),
+    si se pide el cubo.
+    
+    Los reembolsos y contracargos (importe negativo) son rectificaciones del
+    trimestre en que se producen. Esperan en `pendientes` hasta que se sabe
+    el país del cargo original (ver vincular_rectificaciones) y entonces se
+    suman, en negativo, a los campos rect_*.
+    
+    Con la ventanilla única (OSS), las ventas UE a otros países llevan el IVA
+    del país del cliente: siguen sumando en los campos *_ue y además en
+    `oss`, {(país, tipo): {'count', 'base', 'iva', 'num_rect', 'rect_base',
+    'rect_iva'}}, que es lo que se saca del 303 y va a la declaración OSS.
+    
+    `num_pais_email` cuenta los pagos sin país en la exportación cuyo país
+    se ha sacado del email del cliente (--clientes, ver PaisesPorEmail).
+    
+    `cambios_zona` (en el de los pagos sin fecha) guarda las fechas UTC de
+    fin de trimestre que en hora de Madrid son ya del trimestre siguiente
+    (ver crear_dia_madrid y cambios_de_trimestre).
+    """
+    __slots__ = ('num_ue', 'num_no_ue', 'num_sin_pais', 'num_pais_email', 'cambios_zona',
+                 'bruto_ue', 'base_ue', 'iva_ue', 'base_no_ue', 'total_sin_pais',
+                 'substack_fee', 'stripe_fee',
+                 'num_rect_ue', 'num_rect_no_ue', 'num_rect_sin_cargo',
+                 'rect_bruto_ue', 'rect_base_ue', 'rect_iva_ue', 'rect_base_no_ue',
+                 'conversiones', 'paises_ue', 'paises_no_ue', 'oss',
+                 'detalle_ue', 'detalle_no_ue', 'detalle_sin_pais', 'detalle_rectificaciones',
+                 'pendientes', 'errores', 'cargos', 'cubo_ingresos')
+    
+    def __init__(self, cero=Decimal('0'), detalle: bool = True):
+        self.num_ue = 0
+        self.num_no_ue = 0
+        self.num_sin_pais = 0
+        self.num_pais_email = 0
+        self.cambios_zona: List[str] = []
+        self.bruto_ue = cero
+        self.base_ue = cero
+        self.iva_ue = cero
+        self.base_no_ue = cero
+        self.total_sin_pais = cero
+        self.substack_fee = cero
+        self.stripe_fee = cero
+        self.num_rect_ue = 0
+        self.num_rect_no_ue = 0
+        self.num_rect_sin_cargo = 0
+        self.rect_bruto_ue = cero
+        self.rect_base_ue = cero
+        self.rect_iva_ue = cero
+        self.rect_base_no_ue = cero
+        self.conversiones = {}
+        self.paises_ue = {}
+        self.paises_no_ue = {}
+        self.oss: Dict[Tuple[str, Decimal], Dict] = {}
+        self.detalle_ue = [] if detalle else None
+        self.detalle_no_ue = [] if detalle else None
+        self.detalle_sin_pais = [] if detalle else None
+        self.detalle_rectificaciones = [] if detalle else None
+        self.pendientes: List[Tuple] = []
+        self.errores: Optional[ErroresFilas] = None
+        self.cargos: Optional[IndiceCargos] = None
+        self.cubo_ingresos: Optional[CuboIngresos] = None
+    
+    @property
+    def num_pagos(self) -> int:
+        return self.num_ue + self.num_no_ue
+    
+    @property
+    def num_rectificaciones(self) -> int:
+        return self.num_rect_ue + self.num_rect_no_ue
+    
+    def fusionar(self, otro: 'AcumuladorPagos') -> 'AcumuladorPagos':
+        """
+        Suma `otro` a este acumulador (in situ) y lo devuelve.
+        
+        Solo suma enteros y Decimal, así que es exacta y asociativa: da igual
+        cómo se agrupen los archivos o en qué orden terminen los procesos.
+        El detalle se concatena, y solo se conserva si ambos lo tienen.
+        """
+        self.num_ue += otro.num_ue
+        self.num_no_ue += otro.num_no_ue
+        self.num_sin_pais += otro.num_sin_pais
+        self.num_pais_email += otro.num_pais_email
+        self.cambios_zona.extend(otro.cambios_zona)
+        self.bruto_ue += otro.bruto_ue
+        self.base_ue += otro.base_ue
+        self.iva_ue += otro.iva_ue
+        self.base_no_ue += otro.base_no_ue
+        self.total_sin_pais += otro.total_sin_pais
+        self.substack_fee += otro.substack_fee
+        self.stripe_fee += otro.stripe_fee
+        self.num_rect_ue += otro.num_rect_ue
+        self.num_rect_no_ue += otro.num_rect_no_ue
+        self.num_rect_sin_cargo += otro.num_rect_sin_cargo
+        self.rect_bruto_ue += otro.rect_bruto_ue
+        self.rect_base_ue += otro.rect_base_ue
+        self.rect_iva_ue += otro.rect_iva_ue
+        self.rect_base_no_ue += otro.rect_base_no_ue
+        self.pendientes.extend(otro.pendientes)
         
-        if args.json:
-            print(json.dumps(resultado, indent=2, ensure_ascii=False))
+        for moneda, c in otro.conversiones.items():
+            if moneda in self.conversiones:
+                propia = self.conversiones[moneda]
+                propia['original'] += c['original']
+                propia['eur'] += c['eur']
+                propia['count'] += c['count']
+            else:
+                self.conversiones[moneda] = dict(c)
+        for propios, ajenos in ((self.paises_ue, otro.paises_ue), (self.paises_no_ue, otro.paises_no_ue)):
+            for pais, d in ajenos.items():
+                if pais in propios:
+                    propios[pais]['count'] += d['count']
+                    propios[pais]['total'] += d['total']
+                else:
+                    propios[pais] = dict(d)
+        for clave, d in otro.oss.items():
+            if clave in self.oss:
+                propia = self.oss[clave]
+                for campo, valor in d.items():
+                    propia[campo] += valor
+            else:
+                self.oss[clave] = dict(d)
+        
+        if self.detalle_ue is not None and otro.detalle_ue is not None:
+            self.detalle_ue.extend(otro.detalle_ue)
+            self.detalle_no_ue.extend(otro.detalle_no_ue)
+            self.detalle_sin_pais.extend(otro.detalle_sin_pais)
+            self.detalle_rectificaciones.extend(otro.detalle_rectificaciones)
         else:
-            r = resultado['resumen']
-            m303 = resultado['modelo_303']
-            m130 = resultado['modelo_130']
-            fees = resultado['fees']
+            self.detalle_ue = self.detalle_no_ue = self.detalle_sin_pais = self.detalle_rectificaciones = None
+        
+        if otro.errores is not None:
+            if self.errores is None:
+                self.errores = ErroresFilas()
+            self.errores.fusionar(otro.errores)
+        if otro.cargos is not None and otro.cargos is not self.cargos:
+            if self.cargos is None:
+                self.cargos = otro.cargos
+            else:
+                self.cargos.fusionar(otro.cargos)
+        if otro.cubo_ingresos is not None and otro.cubo_ingresos is not self.cubo_ingresos:
+            if self.cubo_ingresos is None:
+                self.cubo_ingresos = otro.cubo_ingresos
+            else:
+                self.cubo_ingresos.fusionar(otro.cubo_ingresos)
+        return self
+    
+    _IMPORTES = ('bruto_ue', 'base_ue', 'iva_ue', 'base_no_ue', 'total_sin_pais',
+                 'substack_fee', 'stripe_fee',
+                 'rect_bruto_ue', 'rect_base_ue', 'rect_iva_ue', 'rect_base_no_ue')
+    _CUENTAS = ('num_ue', 'num_no_ue', 'num_sin_pais',
+                'num_rect_ue', 'num_rect_no_ue', 'num_rect_sin_cargo')
+    
+    def a_dict(self, motor: str = 'decimal') -> Dict:
+        """
+        Totales serializables en JSON (importes como texto exacto, sin
+        detalle). Las rectificaciones tienen que estar ya vinculadas.
+        """
+        if self.pendientes:
+            raise ValueError("Rectificaciones sin vincular (ver vincular_rectificaciones)")
+        a_decimal = MOTORES[motor].a_decimal
+        return {
+            **{campo: getattr(self, campo) for campo in self._CUENTAS},
+            **{campo: str(a_decimal(getattr(self, campo))) for campo in self._IMPORTES},
+            'conversiones': {
+                m: {'tc': c['tc'], 'original': str(a_decimal(c['original'])),
+                    'eur': str(a_decimal(c['eur'])), 'count': c['count']}
+                for m, c in self.conversiones.items()
+            },
+            'paises_ue': {p: {'count': d['count'], 'total': str(a_decimal(d['total']))}
+                          for p, d in self.paises_ue.items()},
+            'paises_no_ue': {p: {'count': d['count'], 'total': str(a_decimal(d['total']))}
+                             for p, d in self.paises_no_ue.items()},
+            'oss': [{'pais': pais, 'tipo': str(tipo),
+                     **{campo: v if campo in ('count', 'num_rect') else str(a_decimal(v)) for campo, v in d.items()}}
+                    for (pais, tipo), d in self.oss.items()],
+            'num_pais_email': self.num_pais_email,
+            'cambios_zona': list(self.cambios_zona),
+            **({} if self.errores is None else {'errores': self.errores.a_lista()}),
+        }
+    
+    @classmethod
+    def desde_dict(cls, datos: Dict, motor: str = 'decimal') -> 'AcumuladorPagos':
+        """Inverso de a_dict, en la unidad de `motor`. El detalle queda desactivado."""
+        motor = MOTORES[motor]
+        importe = lambda texto: motor.desde_decimal(Decimal(texto))
+        acc = cls(motor.cero, detalle=False)
+        for campo in cls._CUENTAS:
+            setattr(acc, campo, datos[campo])
+        for campo in cls._IMPORTES:
+            setattr(acc, campo, importe(datos[campo]))
+        acc.conversiones = {
+            m: {'tc': c['tc'], 'original': importe(c['original']),
+                'eur': importe(c['eur']), 'count': c['count']}
+            for m, c in datos['conversiones'].items()
+        }
+        acc.paises_ue = {p: {'count': d['count'], 'total': importe(d['total'])}
+                         for p, d in datos['paises_ue'].items()}
+        acc.paises_no_ue = {p: {'count': d['count'], 'total': importe(d['total'])}
+                            for p, d in datos['paises_no_ue'].items()}
+        acc.oss = {(d['pais'], Decimal(d['tipo'])):
+                   {campo: d[campo] if campo in ('count', 'num_rect') else importe(d[campo]) for campo in CAMPOS_OSS}
+                   for d in datos.get('oss', ())}
+        acc.num_pais_email = datos.get('num_pais_email', 0)
+        acc.cambios_zona = list(datos.get('cambios_zona', ()))
+        if 'errores' in datos:
+            acc.errores = ErroresFilas.desde_lista(datos['errores'])
+        return acc
+
+CAMPOS_OSS = ('count', 'base', 'iva', 'num_rect', 'rect_base', 'rect_iva')
+
+def celda_oss(oss: Dict[Tuple[str, Decimal], Dict], pais: str, tipo: Decimal, cero) -> Dict:
+    """El grupo (país, tipo) de AcumuladorPagos.oss, creado vacío si no existe."""
+    d = oss.get((pais, tipo))
+    if d is None:
+        d = oss[(pais, tipo)] = {'count': 0, 'base': cero, 'iva': cero,
+                                 'num_rect': 0, 'rect_base': cero, 'rect_iva': cero}
+    return d
+
+def cubos_vacios(
+    trimestres: Iterable[int],
+    motor: str = 'decimal',
+    detalle: bool = True
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """Un acumulador vacío por trimestre, más None para los pagos sin fecha (y los errores)."""
+    cero = MOTORES[motor].cero
+    cubos = {t: AcumuladorPagos(cero, detalle) for t in trimestres}
+    cubos[None] = AcumuladorPagos(cero, detalle)
+    cubos[None].errores = ErroresFilas()
+    return cubos
+
+def fusionar_cubos(
+    destino: Dict[Optional[int], AcumuladorPagos],
+    origen: Dict[Optional[int], AcumuladorPagos]
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """Suma cada acumulador de `origen` al del mismo periodo en `destino`."""
+    for periodo, acc in origen.items():
+        destino[periodo].fusionar(acc)
+    return destino
+
+SECCIONES_DETALLE = ('detalle_ue', 'detalle_no_ue', 'detalle_sin_pais', 'detalle_rectificaciones')
+
+class DetalleEmitido:
+    """
+    Ocupa el lugar de una lista de detalle de AcumuladorPagos: cada pago se
+    pasa a `emitir(trimestre, seccion, pago)` en vez de guardarse.
+    """
+    __slots__ = ('emitir', 'trimestre', 'seccion')
+    
+    def __init__(self, emitir: Callable, trimestre: Optional[int], seccion: str):
+        self.emitir = emitir
+        self.trimestre = trimestre
+        self.seccion = seccion
+    
+    def append(self, pago: Dict):
+        self.emitir(self.trimestre, self.seccion, pago)
+
+# Secciones en que entran los pagos sin fecha al procesarlos (las
+# rectificaciones se clasifican después, ver vincular_rectificaciones)
+SECCIONES_PAGOS = ('detalle_ue', 'detalle_no_ue', 'detalle_sin_pais')
+
+class DetalleRepartido:
+    """
+    Ocupa el lugar de una lista de detalle de los pagos sin fecha: cada
+    pago va a esa lista de cada trimestre pedido, en su sitio según el
+    orden del archivo (como con el filtro por fechas de siempre).
+    """
+    __slots__ = ('listas',)
+    
+    def __init__(self, listas: List[List[Dict]]):
+        self.listas = listas
+    
+    def append(self, pago: Dict):
+        for lista in self.listas:
+            lista.append(pago)
+
+def emitir_detalle(cubos: Dict[Optional[int], AcumuladorPagos], emitir: Callable):
+    """Pasa a `emitir` el detalle ya acumulado y lo quita de los acumuladores."""
+    for trimestre, acc in cubos.items():
+        for seccion in SECCIONES_DETALLE:
+            for pago in getattr(acc, seccion) or ():
+                emitir(trimestre, seccion, pago)
+            setattr(acc, seccion, None)
+
+def vincular_rectificaciones(
+    cubos: Dict[Optional[int], AcumuladorPagos],
+    cargos: Optional[IndiceCargos],
+    motor: str = 'decimal',
+    emitir: Optional[Callable] = None,
+    oss: Optional[TablaTiposIVA] = None
+):
+    """
+    Suma los reembolsos pendientes de cada acumulador como rectificaciones.
+    
+    Cada reembolso se clasifica con el país del cargo que rectifica, buscado
+    en `cargos`: UE (o sin país) con IVA incluido, el resto exportación. Si
+    el cargo no está (otra exportación, un trimestre anterior sin
+    --indice-cargos) se usa el país del propio reembolso y se cuenta en
+    num_rect_sin_cargo. Se hace después de leer todo, así da igual que la
+    exportación vaya de más nueva a más antigua.
+    
+    Con `emitir`, el detalle de los reembolsos de acumuladores que ya no lo
+    guardan se entrega ahí. Si hay cubo de ingresos (cubos[None].cubo_ingresos)
+    cada reembolso se suma también a su celda. Con `oss`, el de una venta a
+    otro país de la UE lleva el IVA de ese país en la fecha del reembolso.
+    """
+    motor = MOTORES[motor]
+    desglose_iva = motor.desglose_iva
+    a_texto = motor.a_texto
+    cubo = cubos[None].cubo_ingresos
+    buscados = [h for acc in cubos.values() for h, *_ in acc.pendientes if h]
+    encontrados = cargos.buscar(buscados) if cargos is not None and buscados else {}
+    for trimestre, acc in cubos.items():
+        for h, pais_propio, importe_eur, fecha, pago, en_cubo in acc.pendientes:
+            pais = encontrados.get(h)
+            if pais is None:
+                acc.num_rect_sin_cargo += 1
+                pais = pais_propio
+            if not pais or es_ue(pais):
+                if oss is not None and es_oss(pais):
+                    tipo_iva = oss.tipo(pais, fecha)
+                    base, iva = motor.desglose_iva_tipo(importe_eur, tipo_iva)
+                    d = celda_oss(acc.oss, pais, tipo_iva, motor.cero)
+                    d['num_rect'] += 1
+                    d['rect_base'] += base
+                    d['rect_iva'] += iva
+                else:
+                    base, iva = desglose_iva(importe_eur)
+                acc.num_rect_ue += 1
+                acc.rect_bruto_ue += importe_eur
+                acc.rect_base_ue += base
+                acc.rect_iva_ue += iva
+            else:
+                base, iva = importe_eur, motor.cero
+                acc.num_rect_no_ue += 1
+                acc.rect_base_no_ue += base
+            if cubo is not None and en_cubo is not None:
+                mes, moneda, fees = en_cubo
+                celda = cubo.celda(mes, pais, moneda, not pais or es_ue(pais))
+                celda[1] += 1
+                celda[2] += importe_eur
+                celda[3] += base
+                celda[4] += iva
+                celda[5] += fees
+            if pago is not None:
+                pago.update(base=a_texto(base), iva=a_texto(iva), pais=pais or 'DESCONOCIDO')
+                if acc.detalle_rectificaciones is not None:
+                    acc.detalle_rectificaciones.append(pago)
+                elif emitir is not None:
+                    emitir(trimestre, 'detalle_rectificaciones', pago)
+        acc.pendientes = []
+
+def filas_con_reembolsos(filas: Iterable[List[str]], esquema: EsquemaPagos) -> Iterator[List[str]]:
+    """
+    Las filas y, al final, una fila de reembolso por cada cargo con importe
+    reembolsado ('Amount Refunded' de la exportación de cargos, o
+    'Refunded' = sí para el importe entero), igual que las filas con importe
+    negativo de la de movimientos: con el id del cargo (se vincula a él),
+    su fecha (la exportación no trae la del reembolso) y sin fees. Van al
+    final para no mover el número de línea de las filas del archivo.
+    """
+    i_importe = esquema.importe
+    i_reembolsado = esquema.reembolsado
+    i_fees = (esquema.substack_fee, esquema.stripe_fee)
+    reembolsos = []
+    for fila in filas:
+        yield fila
+        valor = fila[i_reembolsado].strip()
+        if not valor or fila.__class__ is FilaIncompleta:
+            continue
+        if valor.lower() in ('true', 'yes', 'sí', 'si'):
+            valor = fila[i_importe].strip()
+        if parsear_importe(valor)[0] <= 0 or es_negativo(fila[i_importe]):
+            continue  # 'false', '0.00', o una fila que ya es un reembolso
+        reembolso = list(fila)
+        cifra = valor.lstrip('€CA$£')
+        reembolso[i_importe] = valor[:len(valor) - len(cifra)] + '-' + cifra
+        for i in i_fees:
+            reembolso[i] = ''
+        reembolsos.append(reembolso)
+    yield from reembolsos
+
+def trimestre_de(fecha: date, año: int) -> int:
+    """Trimestre (1-4) de la fecha dentro de `año`; 0 si es de otro año."""
+    return (fecha.month + 2) // 3 if fecha.year == año else 0
+
+def _parser_fechas(
+    filas: Iterable[List[str]],
+    i_fecha: int,
+    utc: bool = False
+) -> Tuple[Callable, Iterator[List[str]]]:
+    """Parser de fechas detectado con las primeras filas, y las filas intactas."""
+    filas = iter(filas)
+    muestra = list(islice(filas, TAM_MUESTRA_FECHAS))
+    parsear = crear_parser_fechas((fila[i_fecha] for fila in muestra), utc=utc)
+    return parsear, chain(muestra, filas)
+
+def acumular_filas(
+    filas: Iterable[List[str]],
+    esquema: Optional[EsquemaPagos],
+    año: int,
+    trimestres: Iterable[int] = (1, 2, 3, 4),
+    *,
+    detalle: bool = True,
+    motor: str = 'decimal',
+    tipos_cambio: Optional[str] = None,
+    emitir: Optional[Callable] = None,
+    indice: Optional[IndicePagos] = None,
+    cargos: Optional[IndiceCargos] = None,
+    vincular: bool = True,
+    cubo_ingresos: bool = False,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """
+    Recorre las filas una sola vez y reparte cada pago en el acumulador de
+    su trimestre. Devuelve {trimestre: acumulador} para los `trimestres`
+    pedidos y la clave None para los pagos sin fecha, que no se pueden
+    asignar a ningún trimestre (procesar_filas los suma a cada trimestre,
+    como siempre ha hecho el filtro por fechas).
+    
+    Con `tipos_cambio` (CSV del BCE, ver TablaTiposCambio) cada pago se
+    convierte con el tipo de su fecha; sin fecha o sin tipo publicado se usa
+    TIPOS_CAMBIO.
+    
+    Con `emitir` el detalle de cada pago se entrega según se procesa
+    (emitir(trimestre, 'detalle_ue'|'detalle_no_ue'|'detalle_sin_pais', pago))
+    y los acumuladores devueltos quedan sin detalle.
+    
+    Con `indice` se descartan los pagos que ya estén en él (ver IndicePagos).
+    
+    Los importes negativos (reembolsos, contracargos) se acumulan como
+    rectificaciones de su trimestre. Cada cargo se apunta con su país en
+    `cargos` (si no se pasa y el archivo tiene id, uno nuevo), que queda en
+    cubos[None].cargos, y al terminar cada reembolso se clasifica como su
+    cargo (ver vincular_rectificaciones). Con vincular=False los reembolsos
+    quedan pendientes para vincularlos después con los cargos de otros
+    archivos o trozos.
+    
+    Con `cubo_ingresos`, cubos[None].cubo_ingresos lleva además los totales
+    por mes, país, moneda y UE (ver CuboIngresos) de los pagos de los
+    trimestres pedidos; los sin fecha van al mes AAAA00.
+    
+    Con `oss` (ventanilla única) las ventas a otros países de la UE llevan
+    el IVA del país del cliente en la fecha del pago (sin fecha, el del 1 de
+    enero) y se agrupan por país y tipo en acc.oss, en la misma pasada.
+    
+    Con `paises_email` los pagos sin país toman el de su email en ese
+    índice, si lo tiene, y se cuentan en acc.num_pais_email.
+    """
+    motor = MOTORES[motor]
+    cero = motor.cero
+    parsear_importe = motor.parsear_importe
+    convertir_a_eur = motor.convertir_a_eur
+    dividir_por_tipo = motor.dividir_por_tipo
+    tipo_del_dia = cargar_tipos_cambio(tipos_cambio).tipo if tipos_cambio else None
+    sin_tipo_diario = set()
+    desglose_iva = motor.desglose_iva
+    desglose_iva_tipo = motor.desglose_iva_tipo
+    a_texto = motor.a_texto
+    
+    if indice is not None and esquema is not None:
+        filas = indice.filtrar(filas, esquema)
+    if esquema is not None and esquema.existe('reembolsado'):
+        filas = filas_con_reembolsos(filas, esquema)
+    
+    if cargos is None and esquema is not None and esquema.existe('id'):
+        cargos = IndiceCargos()
+    
+    if getattr(motor, 'columnar', False) and not detalle and tipo_del_dia is None and esquema is not None:
+        return acumular_columnas(filas, esquema, año, trimestres, cargos=cargos, vincular=vincular,
+                                 cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email)
+    
+    cubos = cubos_vacios(trimestres, motor.nombre, detalle)
+    cubos[None].cargos = cargos
+    cubo = cubos[None].cubo_ingresos = CuboIngresos(cero) if cubo_ingresos else None
+    
+    if esquema is None:
+        return cubos
+    
+    if detalle and emitir is not None:
+        for trimestre, acc in cubos.items():
+            for seccion in SECCIONES_DETALLE:
+                setattr(acc, seccion, DetalleEmitido(emitir, trimestre, seccion))
+    elif detalle:
+        for seccion in SECCIONES_PAGOS:
+            setattr(cubos[None], seccion,
+                    DetalleRepartido([getattr(acc, seccion) for t, acc in cubos.items() if t is not None]))
+    
+    i_importe = esquema.importe
+    i_moneda = esquema.moneda
+    i_fecha = esquema.fecha
+    i_substack_fee = esquema.substack_fee
+    i_stripe_fee = esquema.stripe_fee
+    i_email = esquema.email
+    i_id = esquema.id
+    i_cargo = esquema.cargo
+    i_paises = esquema.paises
+    hash_clave = IndicePagos.hash_clave
+    apuntar_cargos = cargos is not None and esquema.existe('id')
+    if apuntar_cargos:
+        hash_cargo, codigo_cargo = cargos.hashes.append, cargos.codigos.append
+        codigo_pais = cargos.codigo_pais
+    
+    parsear, filas = _parser_fechas(filas, i_fecha, esquema.fecha_utc)
+    
+    # Trimestre de cada fecha, memorizado (hay pocas fechas distintas)
+    cubo_de_fecha = {}
+    # Tipo OSS de cada (país, fecha), memorizado igual
+    tipo_oss = {}
+    inicio_año = date(año, 1, 1)
+    sin_fecha = cubos[None]
+    errores = sin_fecha.errores
+    
+    for linea, fila in enumerate(filas, start=2):  # Línea 1 = cabecera
+        try:
+            # Parsear importe
+            importe, moneda_detectada = parsear_importe(fila[i_importe])
+            
+            if not importe:
+                if fila.__class__ is FilaIncompleta:
+                    fila.registrar(errores, linea)
+                continue
+            
+            # Moneda (puede venir en columna separada)
+            moneda = fila[i_moneda].upper()
+            if moneda not in ('EUR', 'CAD', 'USD', 'GBP'):
+                moneda = moneda_detectada
+            
+            # País (billing > ip)
+            pais = None
+            for i in i_paises:
+                valor = fila[i].strip().upper()
+                if valor not in VALORES_PAIS_VACIOS:
+                    pais = valor
+                    break
+            por_email = False
+            if pais is None and paises_email is not None:
+                pais = paises_email.pais(fila[i_email])
+                por_email = pais is not None
+            
+            # Cargo: se apunta aunque sea de otro trimestre, por si se reembolsa
+            if importe > 0 and apuntar_cargos:
+                clave = fila[i_id].strip()
+                if clave:
+                    hash_cargo(hash_clave(clave))
+                    codigo = codigo_pais.get(pais or '')
+                    codigo_cargo(codigo if codigo is not None else cargos.codigo(pais))
+            
+            # Parsear fecha
+            fecha = parsear(fila[i_fecha])
+            
+            # Repartir por trimestre (fuera de los pedidos → descartar)
+            if fecha:
+                try:
+                    acc = cubo_de_fecha[fecha]
+                except KeyError:
+                    acc = cubo_de_fecha[fecha] = cubos.get(trimestre_de(fecha, año))
+                if acc is None:
+                    continue
+            else:
+                acc = sin_fecha
+            
+            # Convertir a EUR (tipo del día si hay tabla histórica)
+            tipo = None
+            if tipo_del_dia is not None and moneda != 'EUR':
+                tipo = tipo_del_dia(moneda, fecha) if fecha else None
+                if tipo is None and moneda not in sin_tipo_diario:
+                    sin_tipo_diario.add(moneda)
+                    print(f"⚠️  Sin tipo diario para {moneda} en algunos pagos: se usa el fijo", file=sys.stderr)
+            if tipo is None:
+                importe_eur, tc = convertir_a_eur(importe, moneda)
+            else:
+                importe_eur = dividir_por_tipo(importe, tipo)
+            
+            # Registrar conversión
+            if moneda != 'EUR':
+                conversiones = acc.conversiones
+                if moneda not in conversiones:
+                    conversiones[moneda] = {'tc': 'BCE diario' if tipo is not None else str(tc),
+                                            'original': cero, 'eur': cero, 'count': 0}
+                conversiones[moneda]['original'] += importe
+                conversiones[moneda]['eur'] += importe_eur
+                conversiones[moneda]['count'] += 1
+            
+            # Fees (Substack y Stripe)
+            substack_fee, _ = parsear_importe(fila[i_substack_fee])
+            stripe_fee, _ = parsear_importe(fila[i_stripe_fee])
+            
+            # Convertir fees a EUR (misma moneda y tipo que el pago)
+            if tipo is None:
+                substack_fee_eur, _ = convertir_a_eur(substack_fee, moneda)
+                stripe_fee_eur, _ = convertir_a_eur(stripe_fee, moneda)
+            else:
+                substack_fee_eur = dividir_por_tipo(substack_fee, tipo)
+                stripe_fee_eur = dividir_por_tipo(stripe_fee, tipo)
+            
+            acc.substack_fee += substack_fee_eur
+            acc.stripe_fee += stripe_fee_eur
+            if por_email:
+                acc.num_pais_email += 1
+            
+            # Mes del cubo de ingresos (AAAA00 = sin fecha)
+            if cubo is not None:
+                mes = fecha.year * 100 + fecha.month if fecha else año * 100
+            
+            # Reembolso/contracargo: se clasifica al final, como su cargo
+            if importe < 0:
+                clave = fila[i_cargo].strip() or fila[i_id].strip()
+                pago_proc = None
+                if detalle:
+                    pago_proc = {
+                        'fecha': str(fecha) if fecha else 'N/A',
+                        'email': fila[i_email][:30],
+                        'importe_original': f"{motor.a_decimal(importe):.2f} {moneda}",
+                        'total_eur': a_texto(importe_eur),
+                        'base': None,
+                        'iva': None,
+                        'pais': None,
+                        'substack_fee': a_texto(substack_fee_eur),
+                        'stripe_fee': a_texto(stripe_fee_eur),
+                        'rectifica': clave or None,
+                    }
+                en_cubo = (mes, moneda, substack_fee_eur + stripe_fee_eur) if cubo is not None else None
+                acc.pendientes.append((hash_clave(clave) if clave else 0, pais, importe_eur, fecha or inicio_año,
+                                       pago_proc, en_cubo))
+                continue
+            
+            # Calcular desglose IVA
+            pais_es_ue = es_ue(pais) if pais else None
+            
+            # OPCIÓN CONSERVADORA: Sin país → tratar como UE (paga IVA)
+            if pais_es_ue is True or pais_es_ue is None:
+                if oss is not None and es_oss(pais):
+                    # Ventanilla única: IVA incluido del país del cliente
+                    try:
+                        tipo_iva = tipo_oss[pais, fecha]
+                    except KeyError:
+                        tipo_iva = tipo_oss[pais, fecha] = oss.tipo(pais, fecha or inicio_año)
+                    base, iva = desglose_iva_tipo(importe_eur, tipo_iva)
+                    d = celda_oss(acc.oss, pais, tipo_iva, cero)
+                    d['count'] += 1
+                    d['base'] += base
+                    d['iva'] += iva
+                else:
+                    # UE o sin país: IVA incluido → Base = Total / 1.21
+                    base, iva = desglose_iva(importe_eur)
+                es_ue_final = True
+            else:
+                # No-UE: Exportación exenta
+                base = importe_eur
+                iva = cero
+                es_ue_final = False
+            
+            if cubo is not None:
+                celda = cubo.celda(mes, pais, moneda, es_ue_final)
+                celda[0] += 1
+                celda[2] += importe_eur
+                celda[3] += base
+                celda[4] += iva
+                celda[5] += substack_fee_eur + stripe_fee_eur
             
-            print("\n" + "="*70)
-            print(f"   REPORTE FISCAL STRIPE/SUBSTACK - {resultado['periodo']['descripcion']}")
-            print("="*70)
+            # Datos del pago (solo si se pide el detalle)
+            pago_proc = None
+            if detalle:
+                pago_proc = {
+                    'fecha': str(fecha) if fecha else 'N/A',
+                    'email': fila[i_email][:30],
+                    'importe_original': f"{motor.a_decimal(importe):.2f} {moneda}",
+                    'total_eur': a_texto(importe_eur),
+                    'base': a_texto(base),
+                    'iva': a_texto(iva),
+                    'pais': pais if pais else 'DESCONOCIDO',
+                    'substack_fee': a_texto(substack_fee_eur),
+                    'stripe_fee': a_texto(stripe_fee_eur),
+                }
+                if por_email:
+                    pago_proc['pais_por_email'] = True
             
-            print(f"\n📊 RESUMEN GENERAL")
-            print(f"   Total pagos procesados:        {r['total_pagos']}")
-            print(f"   Total cobrado (Bruto):     {float(r['total_bruto_eur']):>12,.2f} EUR")
+            # Clasificar
+            if es_ue_final:
+                # UE (incluye pagos sin país por criterio conservador)
+                acc.num_ue += 1
+                if detalle:
+                    acc.detalle_ue.append(pago_proc)
+                acc.bruto_ue += importe_eur
+                acc.base_ue += base
+                acc.iva_ue += iva
+                pais_key = pais if pais else 'SIN_PAIS'
+                paises = acc.paises_ue
+                paises[pais_key] = paises.get(pais_key, {'count': 0, 'total': cero})
+                paises[pais_key]['count'] += 1
+                paises[pais_key]['total'] += importe_eur
+                if not pais:
+                    acc.num_sin_pais += 1
+                    if detalle:
+                        acc.detalle_sin_pais.append(pago_proc)
+                    acc.total_sin_pais += importe_eur
+            else:
+                # No-UE (exportación)
+                acc.num_no_ue += 1
+                if detalle:
+                    acc.detalle_no_ue.append(pago_proc)
+                acc.base_no_ue += base
+                paises = acc.paises_no_ue
+                paises[pais] = paises.get(pais, {'count': 0, 'total': cero})
+                paises[pais]['count'] += 1
+                paises[pais]['total'] += importe_eur
+                
+        except Exception as e:
+            # Solo al fallar: se vuelve a parsear para saber qué columna era
+            for campo, i in (('importe', i_importe), ('substack_fee', i_substack_fee), ('stripe_fee', i_stripe_fee)):
+                try:
+                    parsear_importe(fila[i])
+                except Exception:
+                    columna, valor = esquema.nombre(campo), fila[i]
+                    break
+            else:
+                columna, valor = '', ''
+            errores.añadir(e, columna, linea, valor)
+    
+    sin_fecha.cambios_zona.extend(getattr(parsear, 'cambios', ()))
+    if detalle and emitir is None:
+        for seccion in SECCIONES_PAGOS:
+            setattr(sin_fecha, seccion, [])
+    if vincular:
+        vincular_rectificaciones(cubos, cargos, motor.nombre, oss=oss)
+    if detalle and emitir is not None:
+        for acc in cubos.values():
+            for seccion in SECCIONES_DETALLE:
+                setattr(acc, seccion, None)
+    return cubos
+
+# ---------------------------------------------------------------------------
+# Motor columnar (NumPy, opcional)
+# ---------------------------------------------------------------------------
+
+TAM_LOTE_COLUMNAS = 1 << 16
+
+def _factorizar(valores: Tuple[str, ...]) -> Tuple['np.ndarray', List[str]]:
+    """Códigos enteros por fila y lista de valores distintos (en orden de aparición)."""
+    distintos = list(dict.fromkeys(valores))
+    indices = {v: i for i, v in enumerate(distintos)}
+    return np.fromiter(map(indices.__getitem__, valores), dtype=np.int32, count=len(valores)), distintos
+
+def _dividir_redondeando_np(n: 'np.ndarray', d: int) -> 'np.ndarray':
+    """_dividir_redondeando sobre un array (ROUND_HALF_UP, mitades lejos de cero)."""
+    q = (2 * np.abs(n) + d) // (2 * d)
+    return np.where(n >= 0, q, -q)
+
+def _convertir_a_eur_np(importes: 'np.ndarray', tc_micros: 'np.ndarray', es_eur: 'np.ndarray') -> 'np.ndarray':
+    """convertir_a_eur_micros sobre arrays (tc en micro-unidades por fila)."""
+    centimos = _dividir_redondeando_np(importes * tc_micros, ESCALA_MICROS * MICROS_CENTIMO)
+    return np.where(es_eur, importes, centimos * MICROS_CENTIMO)
+
+def _sumar_grupos(
+    destino: Dict[str, Dict],
+    claves: List[str],
+    grupos: 'np.ndarray',
+    importes: 'np.ndarray',
+    campo: str = 'total',
+    extra: Optional[Dict[str, 'np.ndarray']] = None,
+    inicial: Optional[Callable[[str], Dict]] = None
+):
+    """
+    Cuenta y suma `importes` por código de `grupos` y lo añade a `destino`
+    (dict clave → {'count', campo, ...}) en orden de primera aparición, como
+    haría el bucle fila a fila.
+    """
+    if not grupos.size:
+        return
+    codigos, primera, inversa = np.unique(grupos, return_index=True, return_inverse=True)
+    cuentas = np.bincount(inversa, minlength=len(codigos))
+    sumas = np.zeros(len(codigos), dtype=importes.dtype)
+    np.add.at(sumas, inversa, importes)
+    sumas_extra = {}
+    for nombre, valores in (extra or {}).items():
+        sumas_extra[nombre] = np.zeros(len(codigos), dtype=valores.dtype)
+        np.add.at(sumas_extra[nombre], inversa, valores)
+    
+    for i in np.argsort(primera, kind='stable'):
+        clave = claves[codigos[i]]
+        d = destino.get(clave)
+        if d is None:
+            d = destino[clave] = inicial(clave) if inicial else {'count': 0, campo: 0}
+        d['count'] += int(cuentas[i])
+        d[campo] += int(sumas[i])
+        for nombre, s in sumas_extra.items():
+            d[nombre] += int(s[i])
+
+def _desglose_iva_np(eur: 'np.ndarray', num: int, den: int) -> Tuple['np.ndarray', 'np.ndarray']:
+    """desglose_iva_micros sobre un array, con el divisor num/den (1.21 = 121/100)."""
+    base = _dividir_redondeando_np(eur * (den * 100), num * ESCALA_MICROS) * MICROS_CENTIMO
+    iva = _dividir_redondeando_np(eur - base, MICROS_CENTIMO) * MICROS_CENTIMO
+    return base, iva
+
+def _desglose_oss_np(
+    oss_acc: Dict[Tuple[str, Decimal], Dict],
+    tabla: TablaTiposIVA,
+    eur: 'np.ndarray',
+    pais: 'np.ndarray',
+    fecha: 'np.ndarray',
+    nombres_pais: List[str],
+    fechas: List[date],
+    base: 'np.ndarray',
+    iva: 'np.ndarray'
+):
+    """
+    Ventas OSS de un lote (arrays por fila; `fecha` son índices en `fechas`):
+    el tipo se busca una vez por (país, fecha) distinto, base e IVA se
+    recalculan en `base` e `iva` (in situ) una vez por tipo, y se suman por
+    (país, tipo) en `oss_acc`.
+    """
+    if not eur.size:
+        return
+    num_fechas = len(fechas)
+    pares, inversa = np.unique(pais.astype(np.int64) * num_fechas + fecha, return_inverse=True)
+    tipos: List[Decimal] = []
+    indice_tipo: Dict[Decimal, int] = {}
+    tipo_par = np.empty(len(pares), dtype=np.int64)
+    for i, par in enumerate(pares.tolist()):
+        p, f = divmod(par, num_fechas)
+        tipo = tabla.tipo(nombres_pais[p], fechas[f])
+        if tipo not in indice_tipo:
+            indice_tipo[tipo] = len(tipos)
+            tipos.append(tipo)
+        tipo_par[i] = indice_tipo[tipo]
+    tipo_fila = tipo_par[inversa]
+    for t, tipo in enumerate(tipos):
+        filas = tipo_fila == t
+        base[filas], iva[filas] = _desglose_iva_np(eur[filas], *(1 + tipo / 100).as_integer_ratio())
+    
+    grupos, inversa = np.unique(pais.astype(np.int64) * len(tipos) + tipo_fila, return_inverse=True)
+    cuentas = np.bincount(inversa, minlength=len(grupos))
+    sumas = []
+    for valores in (base, iva):
+        suma = np.zeros(len(grupos), dtype=valores.dtype)
+        np.add.at(suma, inversa, valores)
+        sumas.append(suma.tolist())
+    for i, grupo in enumerate(grupos.tolist()):
+        p, t = divmod(grupo, len(tipos))
+        d = celda_oss(oss_acc, nombres_pais[p], tipos[t], 0)
+        d['count'] += int(cuentas[i])
+        d['base'] += int(sumas[0][i])
+        d['iva'] += int(sumas[1][i])
+
+def _sumar_celdas(
+    cubo: CuboIngresos,
+    mes: 'np.ndarray',
+    pais: 'np.ndarray',
+    moneda: 'np.ndarray',
+    ue: 'np.ndarray',
+    nombres_pais: List[str],
+    nombres_moneda: List[str],
+    eur: 'np.ndarray',
+    base: 'np.ndarray',
+    iva: 'np.ndarray',
+    fees: 'np.ndarray'
+):
+    """
+    Suma pagos (arrays por fila, país -1 = sin país) a sus celdas del cubo:
+    las cuatro dimensiones se combinan en un código entero por fila y se
+    agrupa una sola vez.
+    """
+    if not mes.size:
+        return
+    num_pais, num_moneda = len(nombres_pais) + 1, len(nombres_moneda)
+    codigo = ((mes.astype(np.int64) * num_pais + (pais + 1)) * num_moneda + moneda) * 2 + ue
+    codigos, inversa = np.unique(codigo, return_inverse=True)
+    cuentas = np.bincount(inversa, minlength=len(codigos))
+    sumas = []
+    for valores in (eur, base, iva, fees):
+        suma = np.zeros(len(codigos), dtype=valores.dtype)
+        np.add.at(suma, inversa, valores)
+        sumas.append(suma.tolist())
+    for i, codigo in enumerate(codigos.tolist()):
+        codigo, es_ue = divmod(codigo, 2)
+        codigo, m = divmod(codigo, num_moneda)
+        mes_celda, p = divmod(codigo, num_pais)
+        celda = cubo.celda(mes_celda, nombres_pais[p - 1] if p else None, nombres_moneda[m], es_ue)
+        celda[0] += int(cuentas[i])
+        for j, suma in enumerate(sumas, start=2):
+            celda[j] += int(suma[i])
+
+def columnas_de_filas(
+    lote: List[List[str]],
+    esquema: EsquemaPagos,
+    dia: Optional[Callable[[str], str]] = None
+) -> Dict:
+    """
+    Factoriza las columnas que usa _acumular_lote: {campo: (códigos, distintos)}
+    para importe, moneda, fecha, substack_fee y stripe_fee, y 'paises' con
+    una entrada por columna de país en orden de prioridad. `dia` recorta la
+    fecha a lo que mira el parser (ver crear_parser_fechas). 'id', 'cargo' y
+    'email' van sin factorizar (casi todos distintos), o None si no hay
+    columna. 'incompletas' son las (posición, fila) de las FilaIncompleta.
+    """
+    def columna(i):
+        return _factorizar([f[i] for f in lote])
+    
+    def texto(campo):
+        i = getattr(esquema, campo)
+        return [f[i] for f in lote] if esquema.existe(campo) else None
+    
+    i_fecha = esquema.fecha
+    importe = columna(esquema.importe)
+    # Las FilaIncompleta llevan el importe vacío: solo se buscan entre esas
+    incompletas = []
+    if '' in importe[1]:
+        vacio = importe[1].index('')
+        incompletas = [(int(k), lote[k]) for k in np.flatnonzero(importe[0] == vacio)
+                       if lote[k].__class__ is FilaIncompleta]
+    return {
+        'id': texto('id'),
+        'cargo': texto('cargo'),
+        'email': texto('email'),
+        'importe': importe,
+        'moneda': columna(esquema.moneda),
+        'fecha': _factorizar([dia(f[i_fecha]) for f in lote]) if dia else columna(i_fecha),
+        'substack_fee': columna(esquema.substack_fee),
+        'stripe_fee': columna(esquema.stripe_fee),
+        'paises': [columna(i) for i in esquema.paises],
+        'incompletas': incompletas,
+    }
+
+def filas_de_columnas(columnas: Dict, esquema: EsquemaPagos) -> List[List[str]]:
+    """
+    Inverso de columnas_de_filas: las filas del lote con los campos que
+    usa acumular_filas (la fecha, ya recortada si lo estaba) y '' en el resto.
+    """
+    n = len(columnas['importe'][0])
+    filas = [[''] * (len(esquema.columnas) + 1) for _ in range(n)]
+    factorizadas = [(getattr(esquema, campo), columnas[campo])
+                    for campo in ('importe', 'moneda', 'fecha', 'substack_fee', 'stripe_fee')]
+    factorizadas += zip(esquema.paises, columnas['paises'])
+    for i, (codigos, distintos) in factorizadas:
+        for fila, codigo in zip(filas, codigos.tolist()):
+            fila[i] = distintos[codigo]
+    for campo in ('id', 'cargo', 'email'):
+        if columnas[campo] is not None:
+            i = getattr(esquema, campo)
+            for fila, valor in zip(filas, columnas[campo]):
+                fila[i] = valor
+    return filas
+
+def _lote_en_micros(columnas: Dict) -> bool:
+    """
+    Todos los importes y fees del lote caben en micro-unidades enteras. Si
+    alguno tiene más de 6 decimales (ver _a_micros), el lote va fila a fila.
+    """
+    parsear_importe = MotorEntero.parsear_importe
+    for campo in ('importe', 'substack_fee', 'stripe_fee'):
+        for valor in columnas[campo][1]:
+            try:
+                if not isinstance(parsear_importe(valor)[0], int):
+                    return False
+            except Exception:
+                pass  # Error de fila: lo registra _acumular_lote
+    return True
+
+def _registrar_errores_np(
+    errores: ErroresFilas,
+    columna: str,
+    filas_error: 'np.ndarray',
+    codigos: 'np.ndarray',
+    distintos: List[str],
+    error_u: Dict[int, Exception],
+    primera_linea: int
+):
+    """Registra las filas de la máscara `filas_error` agrupadas por la clase de error de su valor."""
+    por_clase: Dict[str, List[int]] = {}
+    for codigo, error in error_u.items():
+        por_clase.setdefault(type(error).__name__, []).append(codigo)
+    for clase, codigos_clase in por_clase.items():
+        filas = np.flatnonzero(filas_error & np.isin(codigos, codigos_clase))
+        if filas.size:
+            errores.registrar(clase, columna, int(filas.size), (
+                {'linea': primera_linea + int(i), 'valor': distintos[codigos[i]][:LARGO_VALOR_ERROR],
+                 'mensaje': str(error_u[codigos[i]])}
+                for i in filas[:MAX_MUESTRAS_ERROR]))
+
+def _acumular_lote(
+    columnas: Dict,
+    parsear: Callable,
+    cubo_de_fecha: Dict,
+    claves_cubo: List[Optional[int]],
+    año: int,
+    paises: Dict[Optional[str], int],
+    monedas: Dict[str, int],
+    errores: ErroresFilas,
+    primera_linea: int,
+    esquema: EsquemaPagos,
+    cargos: Optional[IndiceCargos] = None,
+    cubo_ingresos: bool = False,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """
+    Un lote factorizado (ver columnas_de_filas): mismas cifras que el bucle
+    de acumular_filas. Cada valor distinto se parsea una sola vez. Las filas
+    con error van a `errores`; la primera del lote está en `primera_linea`.
+    Los cargos se apuntan en `cargos` y los reembolsos quedan pendientes.
+    Con `cubo_ingresos` el cubo del lote va en cubos[None].cubo_ingresos.
+    """
+    parsear_importe = MotorEntero.parsear_importe
+    
+    # Importe
+    codigos_importe, distintos = columnas['importe']
+    n = len(codigos_importe)
+    importes_u = np.zeros(len(distintos), dtype=np.int64)
+    detectada_u = np.zeros(len(distintos), dtype=np.int32)
+    error_u: Dict[int, Exception] = {}
+    for i, valor in enumerate(distintos):
+        try:
+            importe, moneda = parsear_importe(valor)
+        except Exception as e:
+            error_u[i] = e
+            continue
+        importes_u[i] = importe
+        detectada_u[i] = monedas.setdefault(moneda, len(monedas))
+    importes = importes_u[codigos_importe]
+    valido = importes != 0
+    if error_u:
+        filas_error = np.isin(codigos_importe, list(error_u))
+        valido &= ~filas_error
+        _registrar_errores_np(errores, esquema.nombre('importe'), filas_error, codigos_importe,
+                              distintos, error_u, primera_linea)
+    es_cargo = valido & (importes > 0)
+    
+    # Moneda: la columna si es una de las conocidas; si no, la del símbolo
+    codigos, distintos = columnas['moneda']
+    moneda_u = np.array([monedas.setdefault(v.upper(), len(monedas))
+                         if v.upper() in ('EUR', 'CAD', 'USD', 'GBP') else -1
+                         for v in distintos], dtype=np.int32)
+    moneda = moneda_u[codigos]
+    moneda = np.where(moneda >= 0, moneda, detectada_u[codigos_importe])
+    
+    # Fecha → cubo (índice en claves_cubo, -1 = fuera de los trimestres pedidos)
+    codigos, distintos = columnas['fecha']
+    cubo_u = np.empty(len(distintos), dtype=np.int32)
+    mes_u = np.empty(len(distintos), dtype=np.int32)
+    fechas_u = []  # Sin fecha: 1 de enero, para buscar el tipo OSS
+    for i, valor in enumerate(distintos):
+        fecha = parsear(valor)
+        if fecha not in cubo_de_fecha:
+            t = trimestre_de(fecha, año) if fecha else None
+            cubo_de_fecha[fecha] = claves_cubo.index(t) if t in claves_cubo else -1
+        cubo_u[i] = cubo_de_fecha[fecha]
+        mes_u[i] = fecha.year * 100 + fecha.month if fecha else año * 100
+        fechas_u.append(fecha or date(año, 1, 1))
+    cubo = cubo_u[codigos]
+    mes = mes_u[codigos]
+    fecha_fila = codigos
+    valido &= cubo >= 0
+    
+    # País: primera columna con valor (billing > ip > ...), -1 si ninguna
+    pais = np.full(n, -1, dtype=np.int32)
+    for codigos, distintos in columnas['paises']:
+        pais_u = np.empty(len(distintos), dtype=np.int32)
+        for i, valor in enumerate(distintos):
+            valor = valor.strip().upper()
+            pais_u[i] = -1 if valor in VALORES_PAIS_VACIOS else paises.setdefault(valor, len(paises))
+        pais = np.where(pais >= 0, pais, pais_u[codigos])
+    
+    # Sin país: el de su email, si está en `paises_email`
+    por_email = None
+    emails = columnas['email']
+    if paises_email is not None and emails is not None:
+        por_email = np.zeros(n, dtype=bool)
+        buscar = paises_email.pais
+        for i in np.flatnonzero(pais < 0).tolist():
+            encontrado = buscar(emails[i])
+            if encontrado is not None:
+                pais[i] = paises.setdefault(encontrado, len(paises))
+                por_email[i] = True
+    
+    # Cargos (de cualquier trimestre) con su país, para vincular los reembolsos
+    ids, claves_cargo = columnas['id'], columnas['cargo']
+    nombres_pais = list(paises)
+    pais_fila = pais.tolist()
+    hash_clave = IndicePagos.hash_clave
+    if cargos is not None and ids is not None:
+        # Código de cargos de cada país del lote; el último (-1) es sin país
+        codigo_lote = [cargos.codigo(nombre) for nombre in nombres_pais] + [0]
+        hash_cargo, codigo_cargo = cargos.hashes.append, cargos.codigos.append
+        for i in np.flatnonzero(es_cargo).tolist():
+            clave = ids[i].strip()
+            if clave:
+                hash_cargo(hash_clave(clave))
+                codigo_cargo(codigo_lote[pais_fila[i]])
+    
+    # Fees: un error aquí descarta la fila pero la conversión ya contó
+    fees = []
+    fee_valido = valido.copy()
+    for campo in ('substack_fee', 'stripe_fee'):
+        codigos, distintos = columnas[campo]
+        fee_u = np.zeros(len(distintos), dtype=np.int64)
+        error_u = {}
+        for i, valor in enumerate(distintos):
+            try:
+                fee_u[i] = parsear_importe(valor)[0]
+            except Exception as e:
+                error_u[i] = e
+        if error_u:
+            filas_error = np.isin(codigos, list(error_u)) & fee_valido
+            fee_valido &= ~filas_error
+            _registrar_errores_np(errores, esquema.nombre(campo), filas_error, codigos,
+                                  distintos, error_u, primera_linea)
+        fees.append(fee_u[codigos])
+    
+    # Conversión con el tipo fijo de cada moneda
+    nombres_moneda = list(monedas)
+    eur_u = np.array([m.upper() == 'EUR' for m in nombres_moneda], dtype=bool)
+    tc = [Decimal('1.0') if es_eur else TIPOS_CAMBIO.get(m.upper(), Decimal('1.0'))
+          for m, es_eur in zip(nombres_moneda, eur_u)]
+    tc_micros_u = np.array([_a_micros(t) for t in tc], dtype=np.int64)
+    tc_micros = tc_micros_u[moneda]
+    es_eur = eur_u[moneda]
+    
+    # Los productos intermedios tienen que caber en int64; si no, enteros de Python
+    maximo = max([int(np.abs(a).max()) for a in (importes, *fees) if a.size] or [0])
+    den_iva = _IVA_DEN
+    if oss is not None:
+        den_iva = max([den_iva] + [(1 + t / 100).as_integer_ratio()[1] for t in oss.tipos()])
+    if maximo * max(int(tc_micros_u.max()), den_iva * 100) >= 2 ** 61:
+        importes, fees = importes.astype(object), [f.astype(object) for f in fees]
+    
+    ue_u = np.array([p in PAISES_UE for p in paises], dtype=bool)
+    oss_u = np.array([oss is not None and es_oss(p) for p in paises], dtype=bool)
+    nombres_pais.append('SIN_PAIS')
+    
+    cubos = {clave: AcumuladorPagos(0, detalle=False) for clave in claves_cubo}
+    celdas = cubos[None].cubo_ingresos = CuboIngresos(0) if cubo_ingresos else None
+    for c, clave in enumerate(claves_cubo):
+        acc = cubos[clave]
+        en_cubo = valido & (cubo == c)
+        if not en_cubo.any():
+            continue
+        
+        importes_c = importes[en_cubo]
+        moneda_c = moneda[en_cubo]
+        tc_c = tc_micros[en_cubo]
+        es_eur_c = es_eur[en_cubo]
+        eur = _convertir_a_eur_np(importes_c, tc_c, es_eur_c)
+        completo = fee_valido[en_cubo]
+        if por_email is not None:
+            acc.num_pais_email += int(por_email[en_cubo][completo].sum())
+        
+        # Conversiones (todas las monedas salvo EUR)
+        no_eur = ~es_eur_c
+        _sumar_grupos(acc.conversiones, nombres_moneda, moneda_c[no_eur], importes_c[no_eur],
+                      campo='original', extra={'eur': eur[no_eur]},
+                      inicial=lambda m: {'tc': str(tc[monedas[m]]), 'original': 0, 'eur': 0, 'count': 0})
+        
+        eur = eur[completo]
+        pais_c = pais[en_cubo][completo]
+        tc_c, es_eur_c = tc_c[completo], es_eur_c[completo]
+        substack_fee = _convertir_a_eur_np(fees[0][en_cubo][completo], tc_c, es_eur_c)
+        stripe_fee = _convertir_a_eur_np(fees[1][en_cubo][completo], tc_c, es_eur_c)
+        acc.substack_fee += int(substack_fee.sum())
+        acc.stripe_fee += int(stripe_fee.sum())
+        fee_c = substack_fee + stripe_fee
+        mes_c = mes[en_cubo][completo]
+        fecha_c = fecha_fila[en_cubo][completo]
+        moneda_c = moneda_c[completo]
+        
+        # Reembolsos: pocos, quedan pendientes fila a fila como en acumular_filas
+        reembolso = importes_c[completo] < 0
+        if reembolso.any():
+            filas_reembolso = np.flatnonzero(en_cubo)[completo][reembolso]
+            for i, importe_eur, fecha_r, mes_r, moneda_r, fee_r in zip(
+                    filas_reembolso.tolist(), eur[reembolso].tolist(), fecha_c[reembolso].tolist(),
+                    mes_c[reembolso].tolist(), moneda_c[reembolso].tolist(), fee_c[reembolso].tolist()):
+                clave = (claves_cargo[i].strip() if claves_cargo else '') or (ids[i].strip() if ids else '')
+                acc.pendientes.append((hash_clave(clave) if clave else 0,
+                                       nombres_pais[pais_fila[i]] if pais_fila[i] >= 0 else None,
+                                       int(importe_eur), fechas_u[fecha_r], None,
+                                       (mes_r, nombres_moneda[moneda_r], int(fee_r)) if celdas is not None else None))
+            no_reembolso = ~reembolso
+            eur, pais_c, fecha_c = eur[no_reembolso], pais_c[no_reembolso], fecha_c[no_reembolso]
+            fee_c, mes_c, moneda_c = fee_c[no_reembolso], mes_c[no_reembolso], moneda_c[no_reembolso]
+        
+        # UE (y sin país, criterio conservador) con IVA incluido; resto exportación
+        ue = np.where(pais_c >= 0, ue_u[np.maximum(pais_c, 0)], True)
+        eur_ue = eur[ue]
+        base, iva = _desglose_iva_np(eur_ue, _IVA_NUM, _IVA_DEN)
+        if oss is not None:
+            pais_ue = pais_c[ue]
+            en_oss = (pais_ue >= 0) & oss_u[np.maximum(pais_ue, 0)]
+            if en_oss.any():
+                base_oss, iva_oss = base[en_oss], iva[en_oss]
+                _desglose_oss_np(acc.oss, oss, eur_ue[en_oss], pais_ue[en_oss], fecha_c[ue][en_oss],
+                                 nombres_pais, fechas_u, base_oss, iva_oss)
+                base[en_oss], iva[en_oss] = base_oss, iva_oss
+        
+        acc.num_ue += int(ue.sum())
+        acc.bruto_ue += int(eur_ue.sum())
+        acc.base_ue += int(base.sum())
+        acc.iva_ue += int(iva.sum())
+        pais_ue = pais_c[ue]
+        _sumar_grupos(acc.paises_ue, nombres_pais, np.where(pais_ue >= 0, pais_ue, len(paises)), eur_ue)
+        sin_pais = pais_ue < 0
+        acc.num_sin_pais += int(sin_pais.sum())
+        acc.total_sin_pais += int(eur_ue[sin_pais].sum())
+        
+        eur_no_ue = eur[~ue]
+        acc.num_no_ue += int(eur_no_ue.size)
+        acc.base_no_ue += int(eur_no_ue.sum())
+        _sumar_grupos(acc.paises_no_ue, nombres_pais, pais_c[~ue], eur_no_ue)
+        
+        if celdas is not None:
+            base_c, iva_c = eur.copy(), np.zeros_like(eur)
+            base_c[ue], iva_c[ue] = base, iva
+            _sumar_celdas(celdas, mes_c, pais_c, moneda_c, ue, nombres_pais[:-1], nombres_moneda,
+                          eur, base_c, iva_c, fee_c)
+    
+    return cubos
+
+def acumular_columnas(
+    filas: Iterable[List[str]],
+    esquema: EsquemaPagos,
+    año: int,
+    trimestres: Iterable[int] = (1, 2, 3, 4),
+    *,
+    cargos: Optional[IndiceCargos] = None,
+    vincular: bool = True,
+    cubo_ingresos: bool = False,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """
+    Como acumular_filas (sin detalle, tipos fijos) pero por columnas con
+    NumPy: las filas se agrupan en lotes, cada columna se factoriza (cada
+    importe, fecha o país distinto se parsea una sola vez) y conversión,
+    clasificación UE, desglose de IVA y sumas por país se hacen sobre arrays
+    int64 en micro-unidades. Mismas cifras que MotorEntero, en su unidad.
+    """
+    if np is None:
+        raise ImportError("El motor numpy necesita NumPy (pip install numpy)")
+    
+    trimestres = tuple(trimestres)
+    cubos = cubos_vacios(trimestres, MotorEntero.nombre, detalle=False)
+    cubos[None].cargos = cargos
+    cubos[None].cubo_ingresos = CuboIngresos(0) if cubo_ingresos else None
+    claves_cubo = list(cubos)
+    
+    if hasattr(filas, 'lotes_columnas'):
+        # Origen ya columnar (Parquet/Arrow): la muestra de fechas sale del primer lote
+        parsear = crear_parser_fechas((fila[esquema.fecha] for fila in islice(filas, TAM_MUESTRA_FECHAS)),
+                                      utc=esquema.fecha_utc)
+        lotes = filas.lotes_columnas(esquema, getattr(parsear, 'dia', None))
+    else:
+        parsear, filas = _parser_fechas(filas, esquema.fecha, esquema.fecha_utc)
+        dia = getattr(parsear, 'dia', None)
+        lotes = (columnas_de_filas(lote, esquema, dia)
+                 for lote in iter(lambda: list(islice(filas, TAM_LOTE_COLUMNAS)), []))
+    
+    cubo_de_fecha: Dict[Optional[date], int] = {}
+    paises: Dict[Optional[str], int] = {}
+    monedas: Dict[str, int] = {}
+    linea = 2  # Línea 1 = cabecera
+    for columnas in lotes:
+        for k, fila in columnas.get('incompletas', ()):
+            fila.registrar(cubos[None].errores, linea + k)
+        if _lote_en_micros(columnas):
+            parciales = _acumular_lote(columnas, parsear, cubo_de_fecha, claves_cubo, año, paises, monedas,
+                                       cubos[None].errores, linea, esquema, cargos, cubo_ingresos, oss,
+                                       paises_email)
+        else:
+            # Importes con más de 6 decimales: el bucle de MotorEntero, exacto con Decimal
+            parciales = acumular_filas(filas_de_columnas(columnas, esquema), esquema, año, trimestres,
+                                       detalle=False, motor=MotorEntero.nombre, cargos=cargos, vincular=False,
+                                       cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email)
+            parciales[None].errores.ajustar_muestras(linea - 2)
+        fusionar_cubos(cubos, parciales)
+        linea += len(columnas['importe'][0])
+    cubos[None].cambios_zona.extend(getattr(parsear, 'cambios', ()))
+    if vincular:
+        vincular_rectificaciones(cubos, cargos, MotorEntero.nombre, oss=oss)
+    return cubos
+
+def formatear_resultado(
+    acc: AcumuladorPagos,
+    trimestre: Optional[int],
+    año: int,
+    motor: str = 'decimal'
+) -> Dict:
+    """Convierte un acumulador en el resultado del reporte (importes como texto)."""
+    a_decimal = MOTORES[motor].a_decimal
+    
+    conversiones = {
+        m: {'tc': c['tc'],
+            'original': str(redondear(a_decimal(c['original']))),
+            'eur': str(redondear(a_decimal(c['eur']))),
+            'count': c['count']}
+        for m, c in acc.conversiones.items()
+    }
+    paises_ue = {p: {'count': d['count'], 'total': str(redondear(a_decimal(d['total'])))}
+                 for p, d in acc.paises_ue.items()}
+    paises_no_ue = {p: {'count': d['count'], 'total': str(redondear(a_decimal(d['total'])))}
+                    for p, d in acc.paises_no_ue.items()}
+    
+    total_bruto_ue = a_decimal(acc.bruto_ue)
+    total_base_ue = a_decimal(acc.base_ue)
+    total_iva_ue = a_decimal(acc.iva_ue)
+    total_base_no_ue = a_decimal(acc.base_no_ue)
+    total_sin_pais = a_decimal(acc.total_sin_pais)
+    total_substack_fee = a_decimal(acc.substack_fee)
+    total_stripe_fee = a_decimal(acc.stripe_fee)
+    rect_bruto_ue = a_decimal(acc.rect_bruto_ue)
+    rect_base_ue = a_decimal(acc.rect_base_ue)
+    rect_iva_ue = a_decimal(acc.rect_iva_ue)
+    rect_base_no_ue = a_decimal(acc.rect_base_no_ue)
+    
+    total_fees = total_substack_fee + total_stripe_fee
+    # Rectificaciones en negativo: reducen las bases del periodo
+    total_ingresos = total_base_ue + total_base_no_ue + rect_base_ue + rect_base_no_ue
+    rendimiento_neto = total_ingresos - total_fees
+    total_bruto = total_bruto_ue + total_base_no_ue
+    
+    # Total pagos = UE + no-UE (sin_pais ya está incluido en UE)
+    total_pagos = acc.num_ue + acc.num_no_ue
+    
+    # Ventanilla única: ventas a otros países UE con su IVA, fuera de las casillas 01-15
+    desglose_oss = []
+    oss = dict.fromkeys(CAMPOS_OSS, 0)
+    for (pais, tipo), d in sorted(acc.oss.items()):
+        importes = {campo: d[campo] if campo in ('count', 'num_rect') else a_decimal(d[campo]) for campo in CAMPOS_OSS}
+        for campo, valor in importes.items():
+            oss[campo] += valor
+        desglose_oss.append({'pais': pais, 'nombre': NOMBRES_PAISES.get(pais, pais), 'tipo': str(tipo),
+                             **_formatear_oss(importes)})
+    
+    resultado = {
+        'periodo': {
+            'trimestre': trimestre,
+            'año': año,
+            'descripcion': f'{trimestre}T {año}' if trimestre else f'Año {año}'
+        },
+        'resumen': {
+            'total_pagos': total_pagos,
+            'total_bruto_eur': str(redondear(total_bruto)),
+            'ue': {
+                'cantidad': acc.num_ue,
+                'total_cobrado': str(redondear(total_bruto_ue)),
+                'base_imponible': str(redondear(total_base_ue)),
+                'iva_incluido': str(redondear(total_iva_ue)),
+            },
+            'no_ue': {
+                'cantidad': acc.num_no_ue,
+                'base_imponible': str(redondear(total_base_no_ue)),
+            },
+            'sin_pais': {
+                'cantidad': acc.num_sin_pais,
+                'total': str(redondear(total_sin_pais)),
+            },
+            'rectificaciones': {
+                'cantidad': acc.num_rectificaciones,
+                'sin_cargo_original': acc.num_rect_sin_cargo,
+                'ue': {
+                    'cantidad': acc.num_rect_ue,
+                    'total': str(redondear(rect_bruto_ue)),
+                    'base_imponible': str(redondear(rect_base_ue)),
+                    'iva': str(redondear(rect_iva_ue)),
+                },
+                'no_ue': {
+                    'cantidad': acc.num_rect_no_ue,
+                    'base_imponible': str(redondear(rect_base_no_ue)),
+                },
+            },
+        },
+        'fees': {
+            'substack': str(redondear(total_substack_fee)),
+            'stripe': str(redondear(total_stripe_fee)),
+            'total': str(redondear(total_fees)),
+        },
+        'paises': {'ue': paises_ue, 'no_ue': paises_no_ue},
+        'conversiones': conversiones,
+        'modelo_303': {
+            'casilla_01_base_21': str(redondear(total_base_ue - oss['base'])),
+            'casilla_03_cuota_21': str(redondear(total_iva_ue - oss['iva'])),
+            'casilla_14_rectificacion_base': str(redondear(rect_base_ue - oss['rect_base'])),
+            'casilla_15_rectificacion_cuota': str(redondear(rect_iva_ue - oss['rect_iva'])),
+            'casilla_60_exportaciones': str(redondear(total_base_no_ue + rect_base_no_ue)),
+        },
+        'modelo_130': {
+            'ingresos': str(redondear(total_ingresos)),
+            'gastos_fees': str(redondear(total_fees)),
+            'rendimiento_neto': str(redondear(rendimiento_neto)),
+        },
+        'detalle_ue': acc.detalle_ue,
+        'detalle_no_ue': acc.detalle_no_ue,
+        'detalle_sin_pais': acc.detalle_sin_pais if acc.detalle_sin_pais else None,
+        'detalle_rectificaciones': acc.detalle_rectificaciones if acc.detalle_rectificaciones else None,
+    }
+    if desglose_oss:
+        resultado['modelo_303']['casilla_123_oss'] = str(redondear(oss['base'] + oss['rect_base']))
+        resultado['oss'] = {'desglose': desglose_oss, 'total': _formatear_oss(oss)}
+    if acc.num_pais_email:
+        resultado['resumen']['pais_por_email'] = {'cantidad': acc.num_pais_email}
+    return resultado
+
+def _formatear_oss(d: Dict) -> Dict:
+    """Un grupo OSS (importes ya en Decimal) como en el resultado."""
+    return {
+        'cantidad': d['count'],
+        'base_imponible': str(redondear(d['base'])),
+        'cuota': str(redondear(d['iva'])),
+        'rectificaciones': {
+            'cantidad': d['num_rect'],
+            'base_imponible': str(redondear(d['rect_base'])),
+            'cuota': str(redondear(d['rect_iva'])),
+        },
+    }
+
+def cambios_de_trimestre(valores: Iterable[str], año: int, trimestre: Optional[int] = None) -> List[Dict]:
+    """
+    Los pagos con hora UTC que en hora de Madrid caen en otro trimestre
+    (AcumuladorPagos.cambios_zona), ordenados: los que salen de o entran en
+    `trimestre` de `año`, o en cualquiera de `año` si no se indica.
+    """
+    cambios = []
+    for valor in sorted(valores):
+        utc = date.fromisoformat(valor[:10])
+        madrid = date.fromisoformat(dia_madrid(valor))
+        de = (utc.year, (utc.month + 2) // 3)
+        a = (madrid.year, (madrid.month + 2) // 3)
+        if trimestre is None and año not in (de[0], a[0]):
+            continue
+        if trimestre is not None and (año, trimestre) not in (de, a):
+            continue
+        cambios.append({
+            'fecha_utc': valor[:19].replace('T', ' '),
+            'fecha_madrid': madrid.isoformat(),
+            'de': f"{de[1]}T {de[0]}",
+            'a': f"{a[1]}T {a[0]}",
+        })
+    return cambios
+
+def resultado_trimestre(
+    cubos: Dict[Optional[int], AcumuladorPagos],
+    trimestre: int,
+    año: int,
+    motor: str = 'decimal',
+    errores: bool = True
+) -> Dict:
+    """
+    Resultado de un trimestre a partir de los acumuladores de acumular_filas.
+    Con `errores`, la clave 'errores' lleva las filas con error de todo lo
+    leído (ver ErroresFilas). Los pagos que entran o salen del trimestre por
+    la hora de Madrid van en 'cambios_de_trimestre' (ver cambios_de_trimestre).
+    """
+    acc = cubos[trimestre]
+    sin_fecha = cubos[None]
+    if sin_fecha.num_pagos or sin_fecha.num_rectificaciones:
+        detalle = acc.detalle_ue is not None
+        acc = AcumuladorPagos(MOTORES[motor].cero, detalle).fusionar(acc).fusionar(sin_fecha)
+    resultado = formatear_resultado(acc, trimestre, año, motor)
+    cambios = cambios_de_trimestre(sin_fecha.cambios_zona, año, trimestre)
+    if cambios:
+        resultado['cambios_de_trimestre'] = cambios
+    if errores:
+        resultado['errores'] = sin_fecha.errores.a_lista() or None
+    return resultado
+
+def resultado_año_completo(
+    cubos: Dict[Optional[int], AcumuladorPagos],
+    año: int,
+    motor: str = 'decimal'
+) -> Dict:
+    """
+    Los cuatro trimestres y el resumen anual a partir de los acumuladores.
+    
+    Los pagos sin fecha entran en cada trimestre (igual que con --trimestre)
+    pero en el anual solo una vez; se indican en 'pagos_sin_fecha'. Las
+    filas con error van en 'errores' una sola vez, no en cada trimestre.
+    """
+    sin_fecha = cubos[None]
+    anual = AcumuladorPagos(MOTORES[motor].cero, sin_fecha.detalle_ue is not None)
+    for t in (1, 2, 3, 4):
+        anual.fusionar(cubos[t])
+    anual.fusionar(sin_fecha)
+    if anual.detalle_ue is not None:
+        # Cada pago sin fecha está en el detalle de los cuatro trimestres (ver DetalleRepartido)
+        for seccion in SECCIONES_PAGOS:
+            vistos = set()
+            setattr(anual, seccion, [pago for pago in getattr(anual, seccion)
+                                     if not (id(pago) in vistos or vistos.add(id(pago)))])
+    cambios = cambios_de_trimestre(sin_fecha.cambios_zona, año)
+    
+    return {
+        'año': año,
+        'trimestres': [resultado_trimestre(cubos, t, año, motor, errores=False) for t in (1, 2, 3, 4)],
+        'anual': formatear_resultado(anual, None, año, motor),
+        'pagos_sin_fecha': sin_fecha.num_pagos,
+        **({'cambios_de_trimestre': cambios} if cambios else {}),
+        'errores': sin_fecha.errores.a_lista() or None,
+    }
+
+def procesar_filas(
+    filas: Iterable[List[str]],
+    esquema: Optional[EsquemaPagos],
+    trimestre: int,
+    año: int,
+    detalle: bool = True,
+    motor: str = 'decimal'
+) -> Dict:
+    """
+    Núcleo de procesar_substack_stripe sobre filas ya indexadas por `esquema`
+    (ver leer_filas_csv / filas_desde_dicts). `motor` elige la aritmética
+    (ver MOTORES); el resultado es el mismo con ambos.
+    """
+    cubos = acumular_filas(filas, esquema, año, (trimestre,), detalle=detalle, motor=motor)
+    return resultado_trimestre(cubos, trimestre, año, motor)
+
+def procesar_año_completo(
+    filas: Iterable[List[str]],
+    esquema: Optional[EsquemaPagos],
+    año: int,
+    detalle: bool = True,
+    motor: str = 'decimal'
+) -> Dict:
+    """
+    Procesa los cuatro trimestres y el resumen anual con una sola lectura.
+    Cada trimestre coincide con procesar_filas para ese trimestre.
+    """
+    cubos = acumular_filas(filas, esquema, año, (1, 2, 3, 4), detalle=detalle, motor=motor)
+    return resultado_año_completo(cubos, año, motor)
+
+# ---------------------------------------------------------------------------
+# Ingresos por suscriptor (--suscriptores)
+# ---------------------------------------------------------------------------
+
+TOP_SUSCRIPTORES = 20
+
+class Suscriptores:
+    """
+    Ingresos acumulados por suscriptor (email) sin un objeto por suscriptor.
+    
+    Cada email distinto se guarda una sola vez, en minúsculas, seguido en
+    un bytearray (`_emails`, con su inicio en `_inicios`) y se localiza por
+    su hash de 64 bits (IndicePagos.hash_clave) en una TablaHashes que da
+    su número. Las cifras van en arrays por
+    columna indexados por ese número: ingresos de toda la exportación y de
+    cada trimestre de `año` en micro-euros (los reembolsos restan), cargos,
+    trimestres del año con algún cargo (un bit por trimestre) y primer y
+    último cargo (ordinal de la fecha). Son unos 100 bytes más el email por
+    suscriptor, así que cientos de miles caben en pocas decenas de MB.
+    """
+    
+    def __init__(self, año: int):
+        self.año = año
+        self._tabla = TablaHashes('I')
+        self._emails = bytearray()
+        self._inicios = array('Q', [0])
+        self.ingresos = array('q')
+        self.trimestres = [array('q') for _ in range(4)]
+        self.cargos = array('I')
+        self.con_cargo = array('B')
+        self.primero = array('I')
+        self.ultimo = array('I')
+        self.num_sin_email = 0
+        self.ingresos_sin_email = 0
+        self.errores = ErroresFilas()
+    
+    @property
+    def num(self) -> int:
+        return len(self.ingresos)
+    
+    def numero(self, email: str) -> int:
+        """Número del suscriptor con ese email (ya normalizado), creándolo si es nuevo."""
+        h = IndicePagos.hash_clave(email)
+        n = self._tabla.valor(h)
+        if n is not None:
+            return n
+        n = len(self.ingresos)
+        self._tabla.añadir(h, n)
+        self._emails += email.encode('utf-8')
+        self._inicios.append(len(self._emails))
+        self.ingresos.append(0)
+        for columna in self.trimestres:
+            columna.append(0)
+        self.cargos.append(0)
+        self.con_cargo.append(0)
+        self.primero.append(0)
+        self.ultimo.append(0)
+        return n
+    
+    def email(self, n: int) -> str:
+        return self._emails[self._inicios[n]:self._inicios[n + 1]].decode('utf-8')
+    
+    def top(self, n: int) -> List[int]:
+        """Los `n` suscriptores con más ingresos, de mayor a menor (heap de n, sin ordenar todos)."""
+        return heapq.nlargest(n, range(self.num), key=self.ingresos.__getitem__)
+    
+    @property
+    def num_recurrentes(self) -> int:
+        """Suscriptores con dos o más cargos."""
+        return self.num - self.cargos.count(0) - self.cargos.count(1)
+
+def acumular_suscriptores(
+    filas: Iterable[List[str]],
+    esquema: Optional[EsquemaPagos],
+    año: int,
+    suscriptores: Optional[Suscriptores] = None,
+    tipos_cambio: Optional[str] = None,
+    indice: Optional[IndicePagos] = None
+) -> Suscriptores:
+    """
+    Recorre las filas una vez y suma cada pago a su suscriptor (el email en
+    minúsculas) en `suscriptores` (ver Suscriptores), o en uno nuevo. Los
+    importes se convierten a EUR como en acumular_filas, en micro-euros.
+    Los pagos sin email se cuentan aparte.
+    """
+    if suscriptores is None:
+        suscriptores = Suscriptores(año)
+    if esquema is None:
+        return suscriptores
+    if indice is not None:
+        filas = indice.filtrar(filas, esquema)
+    if esquema.existe('reembolsado'):
+        filas = filas_con_reembolsos(filas, esquema)
+    
+    parsear_importe = MotorEntero.parsear_importe
+    convertir_a_eur = MotorEntero.convertir_a_eur
+    dividir_por_tipo = MotorEntero.dividir_por_tipo
+    tipo_del_dia = cargar_tipos_cambio(tipos_cambio).tipo if tipos_cambio else None
+    i_importe = esquema.importe
+    i_moneda = esquema.moneda
+    i_fecha = esquema.fecha
+    i_email = esquema.email
+    parsear, filas = _parser_fechas(filas, i_fecha, esquema.fecha_utc)
+    
+    numero = suscriptores.numero
+    ingresos, trimestres, cargos = suscriptores.ingresos, suscriptores.trimestres, suscriptores.cargos
+    con_cargo, primero, ultimo = suscriptores.con_cargo, suscriptores.primero, suscriptores.ultimo
+    # (ordinal, trimestre) de cada fecha, memorizado (hay pocas fechas distintas)
+    dias = {None: (0, 0)}
+    
+    for linea, fila in enumerate(filas, start=2):  # Línea 1 = cabecera
+        try:
+            importe, moneda_detectada = parsear_importe(fila[i_importe])
+            if not importe:
+                if fila.__class__ is FilaIncompleta:
+                    fila.registrar(suscriptores.errores, linea)
+                continue
+            moneda = fila[i_moneda].upper()
+            if moneda not in ('EUR', 'CAD', 'USD', 'GBP'):
+                moneda = moneda_detectada
+            fecha = parsear(fila[i_fecha])
             
-            print(f"\n{'-'*70}")
-            print(f"1. INGRESOS SUJETOS A IVA (CLIENTES UE)")
-            print(f"{'-'*70}")
-            print(f"   Pagos UE:                      {r['ue']['cantidad']}")
-            print(f"   Total cobrado (Bruto):     {float(r['ue']['total_cobrado']):>12,.2f} EUR")
-            print(f"\n   DESGLOSE (IVA incluido):")
-            print(f"   Base Imponible:            {float(r['ue']['base_imponible']):>12,.2f} EUR")
-            print(f"   IVA a repercutir (21%):    {float(r['ue']['iva_incluido']):>12,.2f} EUR")
+            tipo = None
+            if tipo_del_dia is not None and moneda != 'EUR' and fecha:
+                tipo = tipo_del_dia(moneda, fecha)
+            importe_eur = convertir_a_eur(importe, moneda)[0] if tipo is None else dividir_por_tipo(importe, tipo)
+        except Exception as e:
+            suscriptores.errores.añadir(e, esquema.nombre('importe'), linea, fila[i_importe])
+            continue
+        if not isinstance(importe_eur, int):
+            # Más de 6 decimales (ver _a_micros): los arrays van en micro-euros enteros
+            importe_eur = int(importe_eur.to_integral_value(ROUND_HALF_UP))
+        
+        email = fila[i_email].strip().lower()
+        if not email:
+            suscriptores.num_sin_email += 1
+            suscriptores.ingresos_sin_email += importe_eur
+            continue
+        n = numero(email)
+        ingresos[n] += importe_eur
+        try:
+            ordinal, trimestre = dias[fecha]
+        except KeyError:
+            ordinal, trimestre = dias[fecha] = (fecha.toordinal(), trimestre_de(fecha, año))
+        if trimestre:
+            trimestres[trimestre - 1][n] += importe_eur
+        if importe > 0:
+            cargos[n] += 1
+            if trimestre:
+                con_cargo[n] |= 1 << (trimestre - 1)
+            if ordinal:
+                if not primero[n] or ordinal < primero[n]:
+                    primero[n] = ordinal
+                if ordinal > ultimo[n]:
+                    ultimo[n] = ordinal
+    return suscriptores
+
+def resultado_suscriptores(suscriptores: Suscriptores, top: int = TOP_SUSCRIPTORES) -> Dict:
+    """
+    Resumen de los suscriptores: totales, cada trimestre del año (con
+    cargo, recurrentes que ya pagaron en un trimestre anterior, nuevos) y
+    los `top` con más ingresos.
+    """
+    s = suscriptores
+    texto = lambda micros: str(redondear(micros_a_decimal(micros)))
+    fecha = lambda ordinal: date.fromordinal(ordinal).isoformat() if ordinal else None
+    total = sum(s.ingresos)
+    
+    # Cada suscriptor tiene una de 16 combinaciones de trimestres: se cuentan una vez
+    por_combinacion = Counter(s.con_cargo)
+    trimestres = []
+    for t in range(4):
+        bit, anteriores = 1 << t, (1 << t) - 1
+        con_cargo = sum(k for c, k in por_combinacion.items() if c & bit)
+        recurrentes = sum(k for c, k in por_combinacion.items() if c & bit and c & anteriores)
+        trimestres.append({
+            'trimestre': t + 1,
+            'suscriptores_con_cargo': con_cargo,
+            'recurrentes': recurrentes,
+            'nuevos_en_el_año': con_cargo - recurrentes,
+            'ingresos': texto(sum(s.trimestres[t])),
+        })
+    
+    return {
+        'año': s.año,
+        'suscriptores': s.num,
+        'recurrentes': s.num_recurrentes,
+        'ingresos': texto(total),
+        'ingreso_medio': texto(_dividir_redondeando(total, s.num)) if s.num else '0.00',
+        'sin_email': {'cantidad': s.num_sin_email, 'total': texto(s.ingresos_sin_email)},
+        'trimestres': trimestres,
+        'top': [{
+            'posicion': posicion,
+            'email': s.email(n),
+            'ingresos': texto(s.ingresos[n]),
+            'trimestres': [texto(columna[n]) for columna in s.trimestres],
+            'cargos': s.cargos[n],
+            'primer_cargo': fecha(s.primero[n]),
+            'ultimo_cargo': fecha(s.ultimo[n]),
+        } for posicion, n in enumerate(s.top(top), start=1)],
+        'errores': s.errores.a_lista() or None,
+    }
+
+TAM_MIN_TROZO = 1 << 20
+TAM_BLOQUE_COMILLAS = 16 << 20
+
+def _fin_de_registro(mm: mmap.mmap, desde: int, comillas_impares: bool = False) -> int:
+    """
+    Posición justo después del primer salto de línea desde `desde` que no
+    está dentro de un campo entrecomillado. `comillas_impares` indica si en
+    `desde` hay un campo con comillas abierto. Las comillas escapadas ("")
+    cambian la paridad dos veces, así que no afectan.
+    """
+    pos = desde
+    while True:
+        salto = mm.find(b'\n', pos)
+        if salto == -1:
+            return len(mm)
+        if mm[pos:salto].count(b'"') % 2:
+            comillas_impares = not comillas_impares
+        if not comillas_impares:
+            return salto + 1
+        pos = salto + 1
+
+def _registros_hasta(mm: mmap.mmap, hasta: int) -> int:
+    """
+    Registros que terminan antes de `hasta` (saltos de línea fuera de
+    comillas), contados por bloques sobre el mmap sin copiar todo el prefijo.
+    """
+    registros = 0
+    impares = False
+    for inicio in range(0, hasta, TAM_BLOQUE_COMILLAS):
+        bloque = mm[inicio:min(inicio + TAM_BLOQUE_COMILLAS, hasta)]
+        if b'"' not in bloque:
+            if not impares:
+                registros += bloque.count(b'\n')
+            continue
+        # Los trozos entre comillas alternan fuera/dentro de un campo
+        trozos = bloque.split(b'"')
+        registros += sum(trozo.count(b'\n') for trozo in trozos[1 if impares else 0::2])
+        if len(trozos) % 2 == 0:
+            impares = not impares
+    return registros
+
+def dividir_csv(archivo: str, partes: int) -> Tuple[Optional[List[str]], List[Tuple[int, int]]]:
+    """
+    Divide un CSV en `partes` rangos de bytes que empiezan y terminan en un
+    límite de registro (los saltos de línea dentro de comillas no cortan).
+    Returns: (cabecera, [(inicio, fin), ...])
+    
+    Para saber si un punto de corte cae dentro de comillas se cuentan las
+    comillas desde el corte anterior, por bloques sobre el mmap: es una
+    lectura a velocidad de memoria, el parseo caro se hace en los procesos.
+    """
+    with open(archivo, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None, []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            tam = len(mm)
+            fin_cabecera = _fin_de_registro(mm, 0)
+            cabecera = next(csv.reader([mm[:fin_cabecera].decode('utf-8')]), None)
             
-            if resultado['paises']['ue']:
-                print(f"\n   Por país:")
-                for p, d in sorted(resultado['paises']['ue'].items(), key=lambda x: float(x[1]['total']), reverse=True):
-                    if p == 'SIN_PAIS':
-                        print(f"     ⚠️  SIN PAÍS (tratado como UE): {d['count']} pagos, {float(d['total']):,.2f} €")
-                    else:
-                        nombre = NOMBRES_PAISES.get(p, p)
-                        print(f"     {p} ({nombre}): {d['count']} pagos, {float(d['total']):,.2f} €")
+            partes = max(1, min(partes, (tam - fin_cabecera) // TAM_MIN_TROZO))
+            paso = (tam - fin_cabecera) // partes
+            rangos = []
+            inicio = fin_cabecera
+            for i in range(1, partes):
+                objetivo = max(fin_cabecera + i * paso, inicio)
+                # Paridad de comillas entre el inicio del trozo y el objetivo
+                impares = False
+                for bloque in range(inicio, objetivo, TAM_BLOQUE_COMILLAS):
+                    if mm[bloque:min(bloque + TAM_BLOQUE_COMILLAS, objetivo)].count(b'"') % 2:
+                        impares = not impares
+                corte = _fin_de_registro(mm, objetivo, impares)
+                if corte > inicio:
+                    rangos.append((inicio, corte))
+                    inicio = corte
+            if tam > inicio:
+                rangos.append((inicio, tam))
+    return cabecera, rangos
+
+def _lineas_rango(archivo: str, inicio: int, fin: int) -> Iterator[str]:
+    """Líneas de texto de un rango de bytes del archivo, leídas del mmap."""
+    with open(archivo, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(inicio)
+        while mm.tell() < fin:
+            yield mm.readline().decode('utf-8')
+
+def acumular_rango_csv(
+    archivo: str,
+    cabecera: List[str],
+    inicio: int,
+    fin: int,
+    año: int,
+    trimestres: Iterable[int] = (1, 2, 3, 4),
+    *,
+    detalle: bool = True,
+    motor: str = 'decimal',
+    tipos_cambio: Optional[str] = None,
+    indice: Optional[IndicePagos] = None,
+    cargos: Optional[IndiceCargos] = None,
+    vincular: bool = True,
+    cubo_ingresos: bool = False,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """Acumuladores de un trozo de CSV (ver dividir_csv). Se ejecuta en los procesos."""
+    esquema = EsquemaPagos(cabecera)
+    normalizar = esquema.normalizar
+    filas = (normalizar(fila) for fila in csv.reader(_lineas_rango(archivo, inicio, fin)) if fila)
+    cubos = acumular_filas(filas, esquema, año, trimestres, detalle=detalle, motor=motor,
+                           tipos_cambio=tipos_cambio, indice=indice, cargos=cargos, vincular=vincular,
+                           cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email)
+    errores = cubos[None].errores
+    if errores.grupos:
+        # Las líneas se han contado desde el inicio del trozo (la cabecera es el registro 1)
+        with open(archivo, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            errores.ajustar_muestras(_registros_hasta(mm, inicio) - 1, archivo)
+    return cubos
+
+def acumular_archivo(
+    archivo: str,
+    formato: str,
+    año: int,
+    trimestres: Iterable[int] = (1, 2, 3, 4),
+    *,
+    detalle: bool = True,
+    motor: str = 'decimal',
+    tipos_cambio: Optional[str] = None,
+    emitir: Optional[Callable] = None,
+    indice: Optional[IndicePagos] = None,
+    cargos: Optional[IndiceCargos] = None,
+    vincular: bool = True,
+    cubo_ingresos: bool = False,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """
+    Lee un archivo de pagos y devuelve sus acumuladores (ver acumular_filas).
+    Cada archivo resuelve su propio esquema: se pueden mezclar exportaciones
+    de Stripe y de Substack.
+    """
+    esquema, filas = abrir_filas(archivo, formato, streaming=True)
+    if esquema:
+        print(f"📥 {archivo}: formato {esquema.formato}", file=sys.stderr)
+    cubos = acumular_filas(filas, esquema, año, trimestres, detalle=detalle, motor=motor,
+                           tipos_cambio=tipos_cambio, emitir=emitir, indice=indice, cargos=cargos,
+                           vincular=vincular, cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email)
+    cubos[None].errores.ajustar_muestras(archivo=archivo)
+    return cubos
+
+VERSION_CHECKPOINT = 3
+
+def ruta_checkpoint(archivo: str, año: int) -> str:
+    """El checkpoint se guarda junto a la exportación: pagos.csv → pagos.csv.2025.checkpoint.json"""
+    return f"{archivo}.{año}.checkpoint.json"
+
+def ruta_indice(archivo: str, año: int) -> str:
+    """Índice de pagos vistos (con --deduplicar) junto al checkpoint: pagos.csv.2025.indice"""
+    return f"{archivo}.{año}.indice"
+
+def ruta_cargos(archivo: str, año: int) -> str:
+    """Índice de cargos (ver IndiceCargos) junto al checkpoint: pagos.csv.2025.cargos"""
+    return f"{archivo}.{año}.cargos"
+
+def hash_prefijo(archivo: str, hasta: int, tam_bloque: int = 8 << 20) -> str:
+    """SHA-256 de los primeros `hasta` bytes del archivo."""
+    h = hashlib.sha256()
+    with open(archivo, 'rb') as f:
+        pendiente = hasta
+        while pendiente > 0:
+            bloque = f.read(min(tam_bloque, pendiente))
+            if not bloque:
+                break
+            h.update(bloque)
+            pendiente -= len(bloque)
+    return h.hexdigest()
+
+def config_incremental(
+    tipos_cambio: Optional[str] = None,
+    deduplicar: bool = False,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None,
+    por_dia: bool = False
+) -> Dict:
+    """Opciones que, si cambian, invalidan el checkpoint."""
+    config = {
+        'tipos_cambio': hash_prefijo(tipos_cambio, os.path.getsize(tipos_cambio)) if tipos_cambio else None,
+    }
+    if deduplicar:
+        config['deduplicar'] = 'por_dia' if por_dia else True
+    if oss is not None:
+        config['oss'] = oss.huella()
+    if paises_email is not None:
+        config['paises_email'] = paises_email.huella()
+    return config
+
+def leer_checkpoint(archivo: str, año: int) -> Optional[Dict]:
+    """Checkpoint guardado para el archivo, sin validar (None si no hay o está dañado)."""
+    try:
+        with open(ruta_checkpoint(archivo, año), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def checkpoint_valido(previo: Optional[Dict], archivo: str, año: int, cabecera: List[str], config: Dict) -> bool:
+    """El checkpoint es de este año y configuración y el archivo solo ha crecido por el final."""
+    return (
+        previo is not None
+        and previo.get('version') == VERSION_CHECKPOINT
+        and previo.get('año') == año
+        and previo.get('config') == config
+        and previo.get('cabecera') == cabecera
+        and previo.get('offset', os.path.getsize(archivo) + 1) <= os.path.getsize(archivo)
+        and hash_prefijo(archivo, previo['offset']) == previo.get('sha256')
+    )
+
+def cargar_indices_incrementales(
+    archivos: List[str],
+    año: int,
+    tipos_cambio: Optional[str] = None,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None,
+    por_dia: bool = False
+) -> Dict[str, IndicePagos]:
+    """
+    Un IndicePagos por archivo, con los pagos que ese archivo ya ha contado
+    según su checkpoint (vacío si el checkpoint no vale y se va a procesar
+    entero). Cada índice ve a los demás: un pago repetido en dos
+    exportaciones solo está en el índice de la que lo contó.
+    """
+    config = config_incremental(tipos_cambio, deduplicar=True, oss=oss, paises_email=paises_email, por_dia=por_dia)
+    indices = {}
+    for archivo in archivos:
+        cabecera, _ = dividir_csv(archivo, 1)
+        if checkpoint_valido(leer_checkpoint(archivo, año), archivo, año, cabecera, config):
+            indices[archivo] = IndicePagos.cargar(ruta_indice(archivo, año), por_dia)
+        else:
+            indices[archivo] = IndicePagos(por_dia=por_dia)
+    for indice in indices.values():
+        indice.otros = list(indices.values())
+    return indices
+
+def acumular_incremental(
+    archivo: str,
+    año: int,
+    *,
+    motor: str = 'decimal',
+    tipos_cambio: Optional[str] = None,
+    indice: Optional[IndicePagos] = None,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """
+    Acumula un CSV que crece por el final reutilizando el checkpoint de la
+    ejecución anterior (ver ruta_checkpoint).
+    
+    El checkpoint guarda hasta qué byte se procesó, el SHA-256 de ese prefijo
+    y los acumuladores de los cuatro trimestres. Si el prefijo no ha cambiado
+    solo se parsean las filas añadidas; si ha cambiado (exportación
+    regenerada, filas editadas) o cambia la configuración (p. ej. el archivo
+    de tipos de cambio), se procesa entero. Siempre se acumula el año
+    completo y sin detalle de pagos.
+    
+    Con `indice` (ver cargar_indices_incrementales) se descartan los pagos
+    duplicados y el índice se guarda junto al checkpoint (ver ruta_indice).
+    Los cargos también (ver ruta_cargos): un reembolso añadido después se
+    vincula con su cargo aunque este se leyera en una ejecución anterior.
+    """
+    trimestres = (1, 2, 3, 4)
+    config = config_incremental(tipos_cambio, deduplicar=indice is not None, oss=oss, paises_email=paises_email,
+                                por_dia=indice is not None and indice.por_dia)
+    ruta = ruta_checkpoint(archivo, año)
+    tam = os.path.getsize(archivo)
+    previo = leer_checkpoint(archivo, año)
+    
+    cabecera, _ = dividir_csv(archivo, 1)
+    if cabecera is None:
+        return cubos_vacios(trimestres, motor, detalle=False)
+    EsquemaPagos(cabecera)  # Cabecera desconocida → error inmediato
+    
+    if checkpoint_valido(previo, archivo, año, cabecera, config):
+        inicio = previo['offset']
+        cubos = {None if k == 'sin_fecha' else int(k): AcumuladorPagos.desde_dict(v, motor)
+                 for k, v in previo['cubos'].items()}
+        cargos = IndiceCargos.cargar(ruta_cargos(archivo, año))
+        print(f"♻️  {archivo}: checkpoint válido, {tam - inicio:,} bytes nuevos", file=sys.stderr)
+    else:
+        if previo is not None:
+            print(f"♻️  {archivo}: el archivo ha cambiado, se procesa completo", file=sys.stderr)
+        inicio = 0
+        cubos = cubos_vacios(trimestres, motor, detalle=False)
+        cargos = IndiceCargos()
+        if indice is not None:
+            indice.vaciar()
+    
+    if tam > inicio:
+        if inicio == 0:
+            _, filas = leer_filas_csv(archivo)
+            nuevos = acumular_filas(filas, EsquemaPagos(cabecera), año, trimestres, detalle=False, motor=motor,
+                                    tipos_cambio=tipos_cambio, indice=indice, cargos=cargos, oss=oss,
+                                    paises_email=paises_email)
+        else:
+            nuevos = acumular_rango_csv(archivo, cabecera, inicio, tam, año, trimestres, detalle=False,
+                                        motor=motor, tipos_cambio=tipos_cambio, indice=indice, cargos=cargos,
+                                        oss=oss, paises_email=paises_email)
+        nuevos[None].errores.ajustar_muestras(archivo=archivo)
+        fusionar_cubos(cubos, nuevos)
+    
+    checkpoint = {
+        'version': VERSION_CHECKPOINT,
+        'año': año,
+        'config': config,
+        'cabecera': cabecera,
+        'offset': tam,
+        'sha256': hash_prefijo(archivo, tam),
+        'cubos': {('sin_fecha' if k is None else str(k)): acc.a_dict(motor) for k, acc in cubos.items()},
+    }
+    if indice is not None:
+        indice.guardar(ruta_indice(archivo, año))
+    if EsquemaPagos(cabecera).existe('id'):
+        cargos.guardar(ruta_cargos(archivo, año))
+    temporal = ruta + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(temporal, ruta)
+    
+    return cubos
+
+def consolidar_archivos(
+    archivos: List[str],
+    formato: str,
+    año: int,
+    trimestres: Iterable[int] = (1, 2, 3, 4),
+    *,
+    detalle: bool = True,
+    motor: str = 'decimal',
+    procesos: int = 1,
+    tipos_cambio: Optional[str] = None,
+    emitir: Optional[Callable] = None,
+    indice: Optional[IndicePagos] = None,
+    cargos: Optional[IndiceCargos] = None,
+    cubo_ingresos: bool = False,
+    oss: Optional[TablaTiposIVA] = None,
+    paises_email: Optional[PaisesPorEmail] = None
+) -> Dict[Optional[int], AcumuladorPagos]:
+    """
+    Procesa varias exportaciones (cuentas de Stripe, publicaciones de
+    Substack...) de forma independiente y suma sus acumuladores.
+    
+    Con procesos > 1 el trabajo se reparte en un pool: cada CSV se divide en
+    trozos (ver dividir_csv) y cada JSON o CSV comprimido va entero a un
+    proceso. Los resultados se fusionan en el orden de archivos y trozos,
+    así que la salida es idéntica a procesarlos uno detrás de otro.
+    
+    `emitir` como en acumular_filas; con procesos > 1 el detalle se entrega
+    al final, agrupado por trimestre y sección.
+    
+    `indice` (ver IndicePagos) se comparte entre todos los archivos, así que
+    con él se procesan uno detrás de otro aunque se pidan varios procesos.
+    
+    Los reembolsos se vinculan al final con los cargos de todos los archivos
+    y trozos (más los de `cargos`, que queda en consolidado[None].cargos):
+    el resultado no depende de en qué archivo o trozo esté cada cargo.
+    
+    Con `cubo_ingresos` cada archivo o trozo hace su cubo y se suman en
+    consolidado[None].cubo_ingresos.
+    """
+    trimestres = tuple(trimestres)
+    consolidado = cubos_vacios(trimestres, motor, detalle)
+    consolidado[None].cargos = cargos if cargos is not None else IndiceCargos()
+    if cubo_ingresos:
+        consolidado[None].cubo_ingresos = CuboIngresos(MOTORES[motor].cero)
+    
+    if procesos > 1 and indice is not None:
+        print("⚠️  Con --deduplicar los archivos se procesan en un solo proceso", file=sys.stderr)
+        procesos = 1
+    
+    if procesos <= 1:
+        for archivo in archivos:
+            fusionar_cubos(consolidado, acumular_archivo(
+                archivo, formato, año, trimestres, detalle=detalle, motor=motor, tipos_cambio=tipos_cambio,
+                emitir=emitir, indice=indice, cargos=consolidado[None].cargos, vincular=False,
+                cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email))
+        vincular_rectificaciones(consolidado, consolidado[None].cargos, motor, emitir, oss)
+        return consolidado
+    
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        tareas = []
+        for archivo in archivos:
+            # Un CSV comprimido no se puede partir por bytes: va entero a un proceso
+            if formato == 'csv' and tipo_compresion(archivo) is None:
+                cabecera, rangos = dividir_csv(archivo, procesos)
+                if cabecera is None:
+                    continue
+                EsquemaPagos(cabecera)  # Cabecera desconocida → error antes de repartir
+                print(f"📥 {archivo}: {len(rangos)} trozo(s) en paralelo", file=sys.stderr)
+                for inicio, fin in rangos:
+                    tareas.append(pool.submit(acumular_rango_csv, archivo, cabecera, inicio, fin,
+                                              año, trimestres, detalle=detalle, motor=motor,
+                                              tipos_cambio=tipos_cambio, vincular=False,
+                                              cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email))
+            else:
+                tareas.append(pool.submit(acumular_archivo, archivo, formato, año,
+                                          trimestres, detalle=detalle, motor=motor,
+                                          tipos_cambio=tipos_cambio, vincular=False,
+                                          cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email))
+        for tarea in tareas:
+            fusionar_cubos(consolidado, tarea.result())
+    vincular_rectificaciones(consolidado, consolidado[None].cargos, motor, oss=oss)
+    
+    if detalle and emitir is not None:
+        emitir_detalle(consolidado, emitir)
+    return consolidado
+
+def cargar_csv(archivo: str) -> List[Dict]:
+    pagos = []
+    with abrir_texto(archivo) as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            pagos.append(row)
+    return pagos
+
+def cargar_json(archivo: str) -> List[Dict]:
+    with abrir_texto(archivo) as f:
+        data = json.load(f)
+        return data if isinstance(data, list) else data.get('data', [data])
+
+def iterar_csv(archivo: str) -> Iterator[Dict]:
+    """Lee el CSV fila a fila, sin cargarlo entero en memoria."""
+    with abrir_texto(archivo, newline='') as f:
+        yield from csv.DictReader(f)
+
+def iterar_json(archivo: str, tam_bloque: int = 1 << 20) -> Iterator[Dict]:
+    """
+    Lee un JSON de pagos por bloques, emitiendo cada registro al decodificarlo.
+    
+    Soporta un array de nivel superior ([{...}, {...}]) y JSON Lines (un
+    objeto por línea). Un objeto {"data": [...]} se emite registro a registro,
+    aunque tiene que decodificarse entero.
+    """
+    decoder = json.JSONDecoder()
+    en_array = None
+    with abrir_texto(archivo) as f:
+        buffer = f.read(tam_bloque)
+        pos = 0
+        while True:
+            # Saltar separadores, leyendo más si se acaba el bloque
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buffer):
+                    break
+                buffer, pos = f.read(tam_bloque), 0
+                if not buffer:
+                    return
             
-            print(f"\n{'-'*70}")
-            print(f"2. INGRESOS EXENTOS DE IVA (EXPORTACIONES / NO-UE)")
-            print(f"{'-'*70}")
-            print(f"   Pagos no-UE:                   {r['no_ue']['cantidad']}")
-            print(f"   Base Imponible (= Total):  {float(r['no_ue']['base_imponible']):>12,.2f} EUR")
+            if en_array is None:
+                en_array = buffer[pos] == '['
+                if en_array:
+                    pos += 1
+                    continue
+            if en_array and buffer[pos] == ']':
+                return
             
-            if resultado['paises']['no_ue']:
-                print(f"\n   Por país:")
-                for p, d in sorted(resultado['paises']['no_ue'].items(), key=lambda x: float(x[1]['total']), reverse=True):
-                    nombre = NOMBRES_PAISES.get(p, p)
-                    print(f"     {p} ({nombre}): {d['count']} pagos, {float(d['total']):,.2f} €")
+            # Decodificar el siguiente valor, ampliando el bloque si está cortado
+            while True:
+                try:
+                    valor, pos = decoder.raw_decode(buffer, pos)
+                    break
+                except json.JSONDecodeError:
+                    # Leer al menos lo ya acumulado para no re-decodificar en bucle
+                    bloque = f.read(max(tam_bloque, len(buffer) - pos))
+                    if not bloque:
+                        raise
+                    buffer, pos = buffer[pos:] + bloque, 0
             
-            if resultado['conversiones']:
-                print(f"\n{'-'*70}")
-                print(f"💱 CONVERSIONES DE MONEDA")
-                print(f"{'-'*70}")
-                for m, d in resultado['conversiones'].items():
-                    print(f"   {m}: {d['count']} pagos, TC={d['tc']}")
-                    print(f"        {float(d['original']):,.2f} {m} → {float(d['eur']):,.2f} EUR")
+            if not en_array and isinstance(valor, dict) and isinstance(valor.get('data'), list):
+                yield from valor['data']
+            else:
+                yield valor
+
+def _pyarrow():
+    """Importa pyarrow solo cuando hace falta (dependencia opcional)."""
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Leer Parquet/Arrow necesita pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+class FilasArrow:
+    """
+    Filas de un archivo Parquet o Arrow IPC, leídas por lotes (record
+    batches) y solo con las columnas que usa EsquemaPagos.
+    
+    Se recorre como las filas de un CSV (valores como texto, '' si es nulo,
+    más la columna vacía del esquema). El motor numpy pide en cambio los
+    lotes ya por columnas (lotes_columnas), codificados como diccionario por
+    Arrow sin pasar por filas de Python. Arrow IPC se lee con memory map.
+    """
+    
+    def __init__(self, archivo: str, formato: str, columnas: List[str], tam_lote: int = TAM_LOTE_COLUMNAS):
+        self.archivo = archivo
+        self.formato = formato
+        self.columnas = columnas
+        self.tam_lote = tam_lote
+    
+    def _lotes(self) -> Iterator:
+        pa = _pyarrow()
+        if self.formato == 'parquet':
+            archivo = pa.parquet.ParquetFile(self.archivo, memory_map=True)
+            yield from archivo.iter_batches(batch_size=self.tam_lote, columns=self.columnas)
+            return
+        with pa.memory_map(self.archivo, 'r') as fuente:
+            try:
+                lector = pa.ipc.open_file(fuente)
+                lotes = (lector.get_batch(i) for i in range(lector.num_record_batches))
+            except pa.ArrowInvalid:
+                # Formato stream (.arrows): se lee en orden, también sin copiar
+                fuente.seek(0)
+                lotes = pa.ipc.open_stream(fuente)
+            for lote in lotes:
+                yield lote.select(self.columnas)
+    
+    @staticmethod
+    def _texto(columna):
+        """Columna como texto, igual que vendría en un CSV ('' para nulos)."""
+        pa = _pyarrow()
+        if not pa.types.is_string(columna.type):
+            columna = pa.compute.cast(columna, pa.string())
+        return pa.compute.fill_null(columna, '')
+    
+    @staticmethod
+    def _dias_madrid(columna, cambios: List[str]) -> Tuple['np.ndarray', List[str]]:
+        """
+        Día en Madrid de cada timestamp UTC, factorizado como en
+        lotes_columnas, con la tabla de cambios de hora vectorizada en vez de
+        pasar cada fila por texto. Los de fin de trimestre que cambian de día
+        se añaden a `cambios` como los apunta crear_dia_madrid.
+        """
+        pa = _pyarrow()
+        por_segundo = {'s': 1, 'ms': 10**3, 'us': 10**6, 'ns': 10**9}[columna.type.unit]
+        valido = columna.is_valid().to_numpy(zero_copy_only=False)
+        segundos = pa.compute.fill_null(columna.cast(pa.int64()), 0).to_numpy(zero_copy_only=False) // por_segundo
+        verano = np.searchsorted(np.array(TRANSICIONES_MADRID, dtype=np.int64), segundos, side='right') % 2
+        dia_utc = segundos // 86400
+        dia_local = (segundos + 3600 + 3600 * verano) // 86400
+        # Los nulos quedan como '' (sin fecha), igual que en _texto
+        unicos, codigos = np.unique(np.where(valido, dia_local, np.iinfo(np.int64).min), return_inverse=True)
+        dias = [date.fromordinal(EPOCA_ORDINAL + int(d)).isoformat() if d != np.iinfo(np.int64).min else ''
+                for d in unicos]
+        
+        movidos = np.flatnonzero(valido & (dia_local != dia_utc))
+        if len(movidos):
+            fines = np.array([date(año, int(fin[:2]), int(fin[3:])).toordinal() - EPOCA_ORDINAL
+                              for año in AÑOS_HORARIO for fin in FINES_TRIMESTRE], dtype=np.int64)
+            movidos = movidos[np.isin(dia_utc[movidos], fines)]
+            # Como 'Created (UTC)' en el CSV de Stripe
+            cambios.extend(datetime.fromtimestamp(int(segundos[i]), timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+                           for i in movidos)
+        return codigos.astype(np.int32), dias
+    
+    def __iter__(self) -> Iterator[Tuple[str, ...]]:
+        for lote in self._lotes():
+            columnas = [self._texto(c).to_pylist() for c in lote.columns]
+            yield from zip(*columnas, repeat('', lote.num_rows))
+    
+    def lotes_columnas(self, esquema: 'EsquemaPagos', dia: Optional[Callable[[str], str]] = None) -> Iterator[Dict]:
+        """Los lotes factorizados como columnas_de_filas, con dictionary_encode de Arrow."""
+        pa = _pyarrow()
+        for lote in self._lotes():
+            n = lote.num_rows
             
-            print(f"\n{'-'*70}")
-            print(f"3. GASTOS DEDUCIBLES (COMISIONES / FEES)")
-            print(f"{'-'*70}")
-            print(f"   Substack Fees:             {float(fees['substack']):>12,.2f} EUR")
-            print(f"   Stripe Fees:               {float(fees['stripe']):>12,.2f} EUR")
-            print(f"   TOTAL GASTOS:              {float(fees['total']):>12,.2f} EUR")
+            def texto(campo):
+                i = getattr(esquema, campo)
+                return self._texto(lote.column(i)).to_pylist() if esquema.existe(campo) else None
             
-            print(f"\n{'='*70}")
-            print(f"📋 IMPORTES PARA DECLARACIONES")
-            print(f"{'='*70}")
+            def columna(i, recortar=False):
+                if i >= len(self.columnas):
+                    return np.zeros(n, dtype=np.int32), ['']
+                original = lote.column(i)
+                if recortar and pa.types.is_timestamp(original.type) and getattr(dia, 'cambios', None) is not None:
+                    return self._dias_madrid(original, dia.cambios)
+                texto = self._texto(original)
+                if recortar and pa.types.is_timestamp(original.type):
+                    # Solo cuenta el día: 'AAAA-MM-DD hh:mm:ss' → 'AAAA-MM-DD'
+                    texto = pa.compute.utf8_slice_codeunits(texto, 0, 10)
+                codificada = pa.compute.dictionary_encode(texto)
+                return (codificada.indices.to_numpy(zero_copy_only=False).astype(np.int32),
+                        codificada.dictionary.to_pylist())
             
-            print(f"""
+            yield {
+                'id': texto('id'),
+                'cargo': texto('cargo'),
+                'email': texto('email'),
+                'importe': columna(esquema.importe),
+                'moneda': columna(esquema.moneda),
+                'fecha': columna(esquema.fecha, recortar=dia is not None),
+                'substack_fee': columna(esquema.substack_fee),
+                'stripe_fee': columna(esquema.stripe_fee),
+                'paises': [columna(i) for i in esquema.paises],
+            }
+
+def leer_filas_arrow(archivo: str, formato: str) -> Tuple[EsquemaPagos, FilasArrow]:
+    """
+    Abre un Parquet ('parquet') o Arrow IPC ('arrow') y devuelve (esquema,
+    filas) como leer_filas_csv, leyendo solo las columnas necesarias.
+    """
+    pa = _pyarrow()
+    if formato == 'parquet':
+        nombres = pa.parquet.read_schema(archivo, memory_map=True).names
+    else:
+        with pa.memory_map(archivo, 'r') as fuente:
+            try:
+                nombres = pa.ipc.open_file(fuente).schema.names
+            except pa.ArrowInvalid:
+                fuente.seek(0)
+                nombres = pa.ipc.open_stream(fuente).schema.names
+    
+    completo = EsquemaPagos(nombres)
+    usadas = {completo.importe, completo.moneda, completo.fecha, completo.substack_fee,
+              completo.stripe_fee, completo.email, completo.id, completo.cargo, completo.reembolsado,
+              *completo.paises}
+    proyeccion = [nombre for i, nombre in enumerate(nombres) if i in usadas]
+    
+    esquema = EsquemaPagos(proyeccion)
+    esquema.formato = completo.formato
+    return esquema, FilasArrow(archivo, formato, proyeccion)
+
+def abrir_filas(
+    archivo: str,
+    formato: str = 'csv',
+    streaming: bool = True
+) -> Tuple[Optional[EsquemaPagos], Iterable[List[str]]]:
+    """
+    Abre una exportación CSV, JSON, Parquet o Arrow IPC y devuelve
+    (esquema, filas). Sin streaming, un JSON se carga entero con
+    cargar_json; Parquet y Arrow se leen siempre por lotes.
+    """
+    if formato in ('parquet', 'arrow'):
+        return leer_filas_arrow(archivo, formato)
+    if formato == 'json':
+        pagos = iterar_json(archivo) if streaming else cargar_json(archivo)
+        return filas_desde_dicts(pagos)
+    return leer_filas_csv(archivo)
+
+def imprimir_errores(errores: Optional[List[Dict]]):
+    """Filas con error agrupadas (ver ErroresFilas), con la primera línea de cada grupo."""
+    if not errores:
+        return
+    print(f"\n{'-'*70}")
+    print(f"⚠️  FILAS CON ERROR (no incluidas)")
+    print(f"{'-'*70}")
+    for grupo in errores:
+        print(f"   {grupo['clase']} en '{grupo['columna'] or '?'}': {grupo['count']} filas")
+        for muestra in grupo['muestras'][:1]:
+            print(f"        p. ej. línea {muestra['linea']}: {muestra['valor']!r}")
+
+def imprimir_cambios_de_trimestre(cambios: Optional[List[Dict]], muestras: int = 5):
+    """Los pagos que cambian de trimestre por la hora de Madrid (ver cambios_de_trimestre)."""
+    if not cambios:
+        return
+    print(f"\n   🕐 {len(cambios)} pago(s) de fin de trimestre cuentan en otro trimestre en hora de Madrid:")
+    for c in cambios[:muestras]:
+        print(f"      {c['fecha_utc']} UTC → {c['fecha_madrid']} ({c['de']} → {c['a']})")
+    if len(cambios) > muestras:
+        print(f"      ... y {len(cambios) - muestras} más (ver 'cambios_de_trimestre' en --json)")
+
+def avisar_duplicados(duplicados: int, sin_clave: int):
+    """Resumen de --deduplicar en stderr: pagos descartados y pagos sin id ni hora que no se han podido comparar."""
+    print(f"🔁 {duplicados} pago(s) duplicado(s) descartado(s)", file=sys.stderr)
+    if sin_clave:
+        print(f"⚠️  {sin_clave} pago(s) sin id y con fecha sin hora no se deduplican "
+              "(--deduplicar-por-dia los compara por día + email + importe)", file=sys.stderr)
+
+def imprimir_reporte(resultado: Dict):
+    """Imprime el reporte fiscal de un trimestre (o del año) en texto."""
+    r = resultado['resumen']
+    m303 = resultado['modelo_303']
+    m130 = resultado['modelo_130']
+    fees = resultado['fees']
+    
+    print("\n" + "="*70)
+    print(f"   REPORTE FISCAL STRIPE/SUBSTACK - {resultado['periodo']['descripcion']}")
+    print("="*70)
+    
+    print(f"\n📊 RESUMEN GENERAL")
+    print(f"   Total pagos procesados:        {r['total_pagos']}")
+    print(f"   Total cobrado (Bruto):     {float(r['total_bruto_eur']):>12,.2f} EUR")
+    if resultado.get('duplicados_descartados'):
+        print(f"   ⚠️  Pagos duplicados descartados: {resultado['duplicados_descartados']}")
+    if r.get('pais_por_email'):
+        print(f"   📇 País completado por email:  {r['pais_por_email']['cantidad']}")
+    imprimir_cambios_de_trimestre(resultado.get('cambios_de_trimestre'))
+    
+    print(f"\n{'-'*70}")
+    print(f"1. INGRESOS SUJETOS A IVA (CLIENTES UE)")
+    print(f"{'-'*70}")
+    print(f"   Pagos UE:                      {r['ue']['cantidad']}")
+    print(f"   Total cobrado (Bruto):     {float(r['ue']['total_cobrado']):>12,.2f} EUR")
+    print(f"\n   DESGLOSE (IVA incluido):")
+    print(f"   Base Imponible:            {float(r['ue']['base_imponible']):>12,.2f} EUR")
+    print(f"   IVA a repercutir (21%):    {float(r['ue']['iva_incluido']):>12,.2f} EUR")
+    
+    if resultado['paises']['ue']:
+        print(f"\n   Por país:")
+        for p, d in sorted(resultado['paises']['ue'].items(), key=lambda x: float(x[1]['total']), reverse=True):
+            if p == 'SIN_PAIS':
+                print(f"     ⚠️  SIN PAÍS (tratado como UE): {d['count']} pagos, {float(d['total']):,.2f} €")
+            else:
+                nombre = NOMBRES_PAISES.get(p, p)
+                print(f"     {p} ({nombre}): {d['count']} pagos, {float(d['total']):,.2f} €")
+    
+    oss = resultado.get('oss')
+    if oss:
+        print(f"\n   VENTANILLA ÚNICA (OSS, modelo 369): IVA del país del cliente, fuera del 303")
+        for g in oss['desglose']:
+            rect = g['rectificaciones']
+            print(f"     {g['pais']} al {g['tipo']}%: {g['cantidad']} pagos, base {float(g['base_imponible']):,.2f} €, "
+                  f"cuota {float(g['cuota']):,.2f} €"
+                  + (f" (rectif. {float(rect['base_imponible']):,.2f} / {float(rect['cuota']):,.2f} €)"
+                     if rect['cantidad'] else ""))
+        t = oss['total']
+        print(f"     Total OSS: base {float(t['base_imponible']):,.2f} €, cuota {float(t['cuota']):,.2f} €")
+    
+    print(f"\n{'-'*70}")
+    print(f"2. INGRESOS EXENTOS DE IVA (EXPORTACIONES / NO-UE)")
+    print(f"{'-'*70}")
+    print(f"   Pagos no-UE:                   {r['no_ue']['cantidad']}")
+    print(f"   Base Imponible (= Total):  {float(r['no_ue']['base_imponible']):>12,.2f} EUR")
+    
+    if resultado['paises']['no_ue']:
+        print(f"\n   Por país:")
+        for p, d in sorted(resultado['paises']['no_ue'].items(), key=lambda x: float(x[1]['total']), reverse=True):
+            nombre = NOMBRES_PAISES.get(p, p)
+            print(f"     {p} ({nombre}): {d['count']} pagos, {float(d['total']):,.2f} €")
+    
+    rect = r['rectificaciones']
+    if rect['cantidad']:
+        print(f"\n{'-'*70}")
+        print(f"↩️  RECTIFICACIONES (REEMBOLSOS Y CONTRACARGOS)")
+        print(f"{'-'*70}")
+        print(f"   UE:    {rect['ue']['cantidad']:>5}   Base {float(rect['ue']['base_imponible']):>12,.2f}   "
+              f"IVA {float(rect['ue']['iva']):>10,.2f} EUR")
+        print(f"   No-UE: {rect['no_ue']['cantidad']:>5}   Base {float(rect['no_ue']['base_imponible']):>12,.2f} EUR")
+        if rect['sin_cargo_original']:
+            print(f"   ⚠️  {rect['sin_cargo_original']} sin su cargo original: clasificados por su propio país")
+    
+    if resultado['conversiones']:
+        print(f"\n{'-'*70}")
+        print(f"💱 CONVERSIONES DE MONEDA")
+        print(f"{'-'*70}")
+        for m, d in resultado['conversiones'].items():
+            print(f"   {m}: {d['count']} pagos, TC={d['tc']}")
+            print(f"        {float(d['original']):,.2f} {m} → {float(d['eur']):,.2f} EUR")
+    
+    print(f"\n{'-'*70}")
+    print(f"3. GASTOS DEDUCIBLES (COMISIONES / FEES)")
+    print(f"{'-'*70}")
+    print(f"   Substack Fees:             {float(fees['substack']):>12,.2f} EUR")
+    print(f"   Stripe Fees:               {float(fees['stripe']):>12,.2f} EUR")
+    print(f"   TOTAL GASTOS:              {float(fees['total']):>12,.2f} EUR")
+    
+    print(f"\n{'='*70}")
+    print(f"📋 IMPORTES PARA DECLARACIONES")
+    print(f"{'='*70}")
+    
+    print(f"""
    ┌────────────────────────────────────────────────────────────────┐
    │  MODELO 303 - IVA TRIMESTRAL                                   │
    ├────────────────────────────────────────────────────────────────┤
    │  Casilla 01 (Base imponible 21%):          {float(m303['casilla_01_base_21']):>12,.2f} EUR  │
-   │  Casilla 03 (Cuota devengada 21%):         {float(m303['casilla_03_cuota_21']):>12,.2f} EUR  │
-   │  Casilla 60 (Exportaciones exentas):       {float(m303['casilla_60_exportaciones']):>12,.2f} EUR  │
+   │  Casilla 03 (Cuota devengada 21%):         {float(m303['casilla_03_cuota_21']):>12,.2f} EUR  │""")
+    if rect['cantidad']:
+        print(f"""   │  Casilla 14 (Modificación bases):          {float(m303['casilla_14_rectificacion_base']):>12,.2f} EUR  │
+   │  Casilla 15 (Modificación cuotas):         {float(m303['casilla_15_rectificacion_cuota']):>12,.2f} EUR  │""")
+    if 'casilla_123_oss' in m303:
+        print(f"""   │  Casilla 123 (No sujetas, OSS):            {float(m303['casilla_123_oss']):>12,.2f} EUR  │""")
+    print(f"""   │  Casilla 60 (Exportaciones exentas):       {float(m303['casilla_60_exportaciones']):>12,.2f} EUR  │
    └────────────────────────────────────────────────────────────────┘
 """)
-            print(f"""   ┌────────────────────────────────────────────────────────────────┐
+    print(f"""   ┌────────────────────────────────────────────────────────────────┐
    │  MODELO 130 - PAGO FRACCIONADO IRPF                            │
    ├────────────────────────────────────────────────────────────────┤
    │  Base imponible (UE + no-UE):             {float(m130['ingresos']):>12,.2f} EUR  │
@@ -498,21 +4257,359 @@ Ejemplo: python3 procesar_stripe.py --archivo pagos.csv --trimestre 4 --año 202
    │  Rendimiento Neto:                         {float(m130['rendimiento_neto']):>12,.2f} EUR  │
    └────────────────────────────────────────────────────────────────┘
 """)
-            print(f"{'-'*70}")
-            print(f"📌 METODOLOGÍA APLICADA")
-            print(f"{'-'*70}")
-            print(f"   • IVA INCLUIDO: Base = Total ÷ 1.21 para clientes UE")
-            print(f"   • Territorialidad: Por PAÍS (billing > ip), no por moneda")
-            print(f"   • Sin país identificado: Tratado como UE (criterio conservador)")
-            print(f"   • Exportaciones: Clientes no-UE exentos de IVA")
-            print(f"   • Fees: Gastos deducibles para IRPF (no para IVA)")
-            print("="*70 + "\n")
+    imprimir_errores(resultado.get('errores'))
+    print(f"{'-'*70}")
+    print(f"📌 METODOLOGÍA APLICADA")
+    print(f"{'-'*70}")
+    print(f"   • IVA INCLUIDO: Base = Total ÷ 1.21 para clientes UE")
+    print(f"   • Territorialidad: Por PAÍS (billing > ip), no por moneda")
+    print(f"   • Sin país identificado: Tratado como UE (criterio conservador)")
+    if r.get('pais_por_email'):
+        print(f"   • País por email: el de la exportación de clientes (--clientes), si no es ambiguo")
+    if resultado.get('cambios_de_trimestre') is not None:
+        print(f"   • Fechas UTC (Stripe): cuenta el día en hora de Madrid (CET/CEST)")
+    print(f"   • Exportaciones: Clientes no-UE exentos de IVA")
+    print(f"   • Fees: Gastos deducibles para IRPF (no para IVA)")
+    print(f"   • Reembolsos: rectifican el trimestre en que se hacen, clasificados como su cargo")
+    if oss:
+        print(f"   • OSS: ventas a otros países UE con el IVA de ese país en la fecha del pago")
+    print("="*70 + "\n")
+
+def imprimir_suscriptores(resultado: Dict):
+    """Imprime el resumen por suscriptor (ver resultado_suscriptores)."""
+    print("\n" + "="*70)
+    print(f"   INGRESOS POR SUSCRIPTOR STRIPE/SUBSTACK - {resultado['año']}")
+    print("="*70)
+    print(f"   Suscriptores:                  {resultado['suscriptores']}")
+    print(f"   Recurrentes (2 o más cargos):  {resultado['recurrentes']}")
+    print(f"   Ingresos (bruto, toda la exportación): {float(resultado['ingresos']):>12,.2f} EUR")
+    print(f"   Ingreso medio por suscriptor:          {float(resultado['ingreso_medio']):>12,.2f} EUR")
+    if resultado['sin_email']['cantidad']:
+        print(f"   ⚠️  {resultado['sin_email']['cantidad']} pagos sin email: "
+              f"{float(resultado['sin_email']['total']):,.2f} EUR no asignados")
+    
+    print(f"\n   {'Periodo':<8}{'Con cargo':>11}{'Recurrentes':>13}{'Nuevos':>9}{'Ingresos':>15}")
+    print(f"   {'-'*56}")
+    for t in resultado['trimestres']:
+        print(f"   {str(t['trimestre']) + 'T':<8}{t['suscriptores_con_cargo']:>11}{t['recurrentes']:>13}"
+              f"{t['nuevos_en_el_año']:>9}{float(t['ingresos']):>15,.2f}")
+    
+    if resultado['top']:
+        print(f"\n   TOP {len(resultado['top'])} POR INGRESOS")
+        for s in resultado['top']:
+            print(f"   {s['posicion']:>3}. {s['email'][:38]:<38}{float(s['ingresos']):>12,.2f} EUR"
+                  f"  {s['cargos']:>4} cargos")
+    imprimir_errores(resultado['errores'])
+    print("="*70 + "\n")
+
+def imprimir_resumen_anual(resultado: Dict):
+    """Imprime la tabla de los cuatro trimestres y el total anual."""
+    print("\n" + "="*70)
+    print(f"   RESUMEN ANUAL STRIPE/SUBSTACK - {resultado['año']}")
+    print("="*70)
+    print(f"   {'Periodo':<8}{'Pagos':>7}{'Cas. 01':>13}{'Cas. 03':>12}{'Cas. 60':>13}{'Rend. neto':>14}")
+    print(f"   {'-'*67}")
+    for r in resultado['trimestres'] + [resultado['anual']]:
+        periodo = f"{r['periodo']['trimestre']}T" if r['periodo']['trimestre'] else 'AÑO'
+        m303 = r['modelo_303']
+        print(f"   {periodo:<8}{r['resumen']['total_pagos']:>7}"
+              f"{float(m303['casilla_01_base_21']):>13,.2f}"
+              f"{float(m303['casilla_03_cuota_21']):>12,.2f}"
+              f"{float(m303['casilla_60_exportaciones']):>13,.2f}"
+              f"{float(r['modelo_130']['rendimiento_neto']):>14,.2f}")
+    rect = resultado['anual']['resumen']['rectificaciones']
+    if rect['cantidad']:
+        m303 = resultado['anual']['modelo_303']
+        print(f"\n   ↩️  {rect['cantidad']} rectificaciones (reembolsos): casilla 14 "
+              f"{float(m303['casilla_14_rectificacion_base']):,.2f}, casilla 15 "
+              f"{float(m303['casilla_15_rectificacion_cuota']):,.2f} (las de no-UE ya restadas en Cas. 60; todas, en el rendimiento)")
+    oss = resultado['anual'].get('oss')
+    if oss:
+        print(f"\n   🇪🇺 OSS (modelo 369, fuera del 303): base {float(oss['total']['base_imponible']):,.2f}, "
+              f"cuota {float(oss['total']['cuota']):,.2f} en {len(oss['desglose'])} país(es)/tipo(s)")
+    por_email = resultado['anual']['resumen'].get('pais_por_email')
+    if por_email:
+        print(f"\n   📇 {por_email['cantidad']} pagos sin país en la exportación, completado por el email del cliente")
+    imprimir_cambios_de_trimestre(resultado.get('cambios_de_trimestre'))
+    if resultado['pagos_sin_fecha']:
+        print(f"\n   ⚠️  {resultado['pagos_sin_fecha']} pagos sin fecha: incluidos en cada trimestre y una vez en el año")
+    if resultado.get('duplicados_descartados'):
+        print(f"   ⚠️  {resultado['duplicados_descartados']} pagos duplicados descartados")
+    imprimir_errores(resultado['errores'])
+    print("="*70 + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Procesador de Ingresos Stripe/Substack para Autónomos',
+        epilog="""
+REGLAS APLICADAS:
+  1. IVA INCLUIDO: Base = Total / 1.21 (para UE)
+  2. Territorialidad por PAÍS (billing > ip), no por moneda
+  3. Fees de Substack/Stripe = gastos deducibles IRPF
+
+Ejemplo: python3 procesar_stripe.py --archivo pagos.csv --trimestre 4 --año 2025
+Año entero (una lectura): python3 procesar_stripe.py --archivo pagos.csv --año 2025 --año-completo
+Desde la API de Stripe: STRIPE_API_KEY=rk_live_... python3 procesar_stripe.py --stripe-api --trimestre 4 --año 2025
+        """
+    )
+    
+    origen = parser.add_mutually_exclusive_group(required=True)
+    origen.add_argument('--archivo', nargs='+',
+                        help='Una o varias exportaciones (varias cuentas/publicaciones se consolidan)')
+    origen.add_argument('--stripe-api', action='store_true',
+                        help='Descarga los cargos del periodo con la API de Stripe (clave en STRIPE_API_KEY; '
+                             'basta una clave restringida de solo lectura de cargos)')
+    parser.add_argument('--trimestre', type=int, choices=[1,2,3,4])
+    parser.add_argument('--año-completo', action='store_true',
+                        help='Los 4 trimestres y el resumen anual con una sola lectura del archivo')
+    parser.add_argument('--año', type=int, required=True)
+    parser.add_argument('--formato', choices=['csv', 'json', 'parquet', 'arrow'], default='csv',
+                        help='parquet/arrow (IPC) necesitan pyarrow y solo leen las columnas usadas')
+    parser.add_argument('--json', action='store_true', help='Salida JSON')
+    parser.add_argument('--exportar', type=str)
+    parser.add_argument('--jsonl', action='store_true',
+                        help='JSON Lines en --exportar (o en la salida): cada pago se escribe al procesarlo; '
+                             '--exportar solo se sustituye si el proceso termina bien')
+    parser.add_argument('--compacto', action='store_true', help='JSON sin indentar (más pequeño y rápido)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Sin red: --tipos-cambio bce y --stripe-api usan solo la caché')
+    parser.add_argument('--tipos-cambio', type=str,
+                        help='CSV de tipos diarios (formato BCE eurofxref-hist.csv) o "bce" para descargarlo '
+                             'con caché: convierte con el tipo de la fecha de cada pago')
+    parser.add_argument('--url-tipos', type=str, default=URL_TIPOS_BCE,
+                        help='Origen de --tipos-cambio bce (zip o CSV del BCE)')
+    parser.add_argument('--url-stripe', type=str, default=URL_API_STRIPE,
+                        help='Servidor de la API de Stripe (para pruebas con un servidor local)')
+    parser.add_argument('--conexiones', type=int, default=CONEXIONES_STRIPE,
+                        help=f'Tramos de fechas descargados en paralelo con --stripe-api (default: {CONEXIONES_STRIPE})')
+    parser.add_argument('--cache-dir', type=str, default=DIR_CACHE,
+                        help=f'Directorio de caché (default: {DIR_CACHE})')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Lee el archivo por partes sin cargarlo en memoria (sin detalle de pagos)')
+    parser.add_argument('--motor', choices=sorted(MOTORES), default='decimal',
+                        help='Aritmética: decimal (por defecto), entero (coma fija, más rápida, mismas cifras) '
+                             'o numpy (por columnas, la más rápida sin detalle; necesita pip install numpy)')
+    parser.add_argument('--solo-resumen', action='store_true',
+                        help='Solo totales, sin detalle de pagos: memoria según países/monedas, no según pagos')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reutiliza un checkpoint junto al CSV y solo procesa las filas añadidas (sin detalle de pagos)')
+    parser.add_argument('--deduplicar', action='store_true',
+                        help='Descarta pagos repetidos entre archivos o descargas solapadas (por id del cargo; '
+                             'sin id, por fecha y hora + email + importe, y sin hora no se deduplican). '
+                             'Con --incremental el índice se guarda junto al checkpoint')
+    parser.add_argument('--deduplicar-por-dia', action='store_true',
+                        help='Con --deduplicar, descarta también los pagos sin id cuya fecha no lleva hora por '
+                             'día + email + importe (dos compras iguales el mismo día cuentan una vez)')
+    parser.add_argument('--indice-cargos', type=str,
+                        help='Archivo con los cargos ya leídos (se crea si no existe y se actualiza): los '
+                             'reembolsos de este periodo se clasifican como sus cargos de periodos anteriores')
+    parser.add_argument('--oss', action='store_true',
+                        help='Ventanilla única: ventas a otros países de la UE con el IVA de ese país (tabla de '
+                             'tipos con fechas), agrupadas por país y tipo para el modelo 369 y fuera del 303')
+    parser.add_argument('--tipos-oss', type=str,
+                        help='CSV pais,desde,tipo que sustituye los tipos OSS de esos países (implica --oss)')
+    parser.add_argument('--clientes', type=str,
+                        help='Exportación de clientes o cargos de Stripe (CSV, puede ir comprimido): los pagos '
+                             'sin país toman el del email del cliente en vez de tratarse como UE')
+    parser.add_argument('--suscriptores', type=int, nargs='?', const=TOP_SUSCRIPTORES, metavar='N',
+                        help='En vez del reporte fiscal: ingresos por suscriptor (toda la exportación y cada '
+                             f'trimestre del año), recurrentes y los N con más ingresos (default: {TOP_SUSCRIPTORES})')
+    parser.add_argument('--cubo', type=str,
+                        help='SQLite con los totales por mes, país, moneda y UE para consultarlos después con '
+                             'cubo_ingresos.py sin releer los pagos (se crea o se actualizan los meses del periodo)')
+    parser.add_argument('--procesos', type=int, default=1,
+                        help='Procesos en paralelo: reparte archivos y trozos de cada CSV (default: 1)')
+    
+    args = parser.parse_args()
+    
+    if not args.trimestre and not args.año_completo and args.suscriptores is None:
+        parser.error("Debe indicar --trimestre o --año-completo")
+    if args.suscriptores is not None and (args.stripe_api or args.incremental or args.jsonl or args.cubo):
+        parser.error("--suscriptores lee --archivo y no admite --stripe-api, --incremental, --jsonl ni --cubo")
+    
+    salida_jsonl = None
+    try:
+        trimestres = (1, 2, 3, 4) if args.año_completo else (args.trimestre,)
+        # El informe de texto no muestra el detalle: solo se genera si va a
+        # salir en el JSON
+        detalle = bool(args.json or args.jsonl or args.exportar) and not (args.streaming or args.solo_resumen)
+        
+        # JSON Lines: cabecera, cada pago según se procesa y el resumen al final.
+        # --exportar se escribe en un temporal que solo lo sustituye al terminar
+        escritor = emitir = None
+        if args.jsonl:
+            salida_jsonl = open(args.exportar + '.tmp', 'w', encoding='utf-8') if args.exportar else sys.stdout
+            escritor = EscritorJSON(salida_jsonl, lineas=True, compacto=args.compacto)
+            escritor.cabecera({'trimestre': None if args.año_completo else args.trimestre, 'año': args.año})
+            if detalle:
+                def emitir(trimestre, seccion, pago):
+                    escritor.registro(seccion, {'trimestre': trimestre, **pago})
+        
+        if args.tipos_cambio == 'bce':
+            proveedor = ProveedorTiposBCE(args.url_tipos, args.cache_dir, offline=args.offline)
+            args.tipos_cambio = proveedor.obtener()
+            proveedor.pool.cerrar()
+        
+        if args.deduplicar_por_dia and not args.deduplicar:
+            parser.error("--deduplicar-por-dia va con --deduplicar")
+        indice = IndicePagos(por_dia=args.deduplicar_por_dia) if args.deduplicar and not args.incremental else None
+        
+        if args.suscriptores is not None:
+            suscriptores = Suscriptores(args.año)
+            for archivo in args.archivo:
+                esquema, filas = abrir_filas(archivo, args.formato, streaming=True)
+                if esquema:
+                    print(f"📥 {archivo}: formato {esquema.formato}", file=sys.stderr)
+                acumular_suscriptores(filas, esquema, args.año, suscriptores, args.tipos_cambio, indice)
+                suscriptores.errores.ajustar_muestras(archivo=archivo)
+            resultado = resultado_suscriptores(suscriptores, args.suscriptores)
+            if indice is not None:
+                resultado['duplicados_descartados'] = indice.duplicados
+                avisar_duplicados(indice.duplicados, indice.sin_clave)
+            if args.exportar:
+                with open(args.exportar, 'w', encoding='utf-8') as f:
+                    volcar_json(resultado, f, args.compacto)
+                print(f"✅ Exportado a {args.exportar}", file=sys.stderr)
+            if args.json:
+                volcar_json(resultado, sys.stdout, args.compacto)
+            else:
+                imprimir_suscriptores(resultado)
+            return
+        if args.indice_cargos and args.incremental:
+            parser.error("--incremental ya guarda los cargos junto al checkpoint: no admite --indice-cargos")
+        cargos = IndiceCargos.cargar(args.indice_cargos) if args.indice_cargos else None
+        if args.cubo and args.incremental:
+            parser.error("--cubo no admite --incremental (el checkpoint no guarda el cubo)")
+        cubo_ingresos = bool(args.cubo)
+        oss = TablaTiposIVA(args.tipos_oss) if args.oss or args.tipos_oss else None
+        paises_email = None
+        if args.clientes:
+            paises_email = PaisesPorEmail.leer(args.clientes)
+            print(f"📇 {args.clientes}: {paises_email.num:,} email(s) con país"
+                  + (f", {paises_email.ambiguos:,} con varios países (no se usan)" if paises_email.ambiguos else ""),
+                  file=sys.stderr)
+        
+        if args.stripe_api:
+            if args.incremental:
+                parser.error("--incremental solo admite CSV")
+            clave = os.environ.get('STRIPE_API_KEY')
+            if not clave:
+                parser.error("--stripe-api necesita la clave de API en la variable STRIPE_API_KEY")
+            cliente = ClienteStripe(clave, args.url_stripe, args.cache_dir, args.conexiones, args.offline)
+            try:
+                esquema, filas = filas_api_stripe(cliente, args.año, trimestres)
+                cubos = acumular_filas(filas, esquema, args.año, trimestres, detalle=detalle, motor=args.motor,
+                                       tipos_cambio=args.tipos_cambio, emitir=emitir, indice=indice,
+                                       cargos=cargos, cubo_ingresos=cubo_ingresos, oss=oss,
+                                       paises_email=paises_email)
+            finally:
+                cliente.cerrar()
+            print(f"🌐 API de Stripe: {cliente.peticiones} petición(es), {cliente.paginas_cache} página(s) de la caché",
+                  file=sys.stderr)
+        elif args.incremental:
+            if args.formato != 'csv':
+                parser.error("--incremental solo admite CSV")
+            if any(tipo_compresion(archivo) for archivo in args.archivo):
+                parser.error("--incremental necesita el CSV sin comprimir (compara y lee por posición de bytes)")
+            cubos = cubos_vacios((1, 2, 3, 4), args.motor, detalle=False)
+            if args.deduplicar:
+                indices = cargar_indices_incrementales(args.archivo, args.año, args.tipos_cambio, oss, paises_email,
+                                                       args.deduplicar_por_dia)
+            else:
+                indices = {}
+            for archivo in args.archivo:
+                fusionar_cubos(cubos, acumular_incremental(archivo, args.año, motor=args.motor,
+                                                           tipos_cambio=args.tipos_cambio,
+                                                           indice=indices.get(archivo), oss=oss,
+                                                           paises_email=paises_email))
+            duplicados = sum(indice.duplicados for indice in indices.values())
+            sin_clave = sum(indice.sin_clave for indice in indices.values())
+        elif len(args.archivo) == 1 and detalle and emitir is None and args.procesos <= 1:
+            esquema, filas = abrir_filas(args.archivo[0], args.formato, streaming=False)
+            if esquema:
+                print(f"📥 Formato detectado: {esquema.formato}", file=sys.stderr)
+            filas = list(filas)
+            print(f"📥 {len(filas)} registros cargados", file=sys.stderr)
+            cubos = acumular_filas(filas, esquema, args.año, trimestres, detalle=detalle, motor=args.motor,
+                                   tipos_cambio=args.tipos_cambio, emitir=emitir, indice=indice, cargos=cargos,
+                                   cubo_ingresos=cubo_ingresos, oss=oss, paises_email=paises_email)
+        else:
+            if args.streaming:
+                print(f"📥 Leyendo {len(args.archivo)} archivo(s) en modo streaming", file=sys.stderr)
+            cubos = consolidar_archivos(args.archivo, args.formato, args.año, trimestres, detalle=detalle,
+                                        motor=args.motor, procesos=args.procesos, tipos_cambio=args.tipos_cambio,
+                                        emitir=emitir, indice=indice, cargos=cargos, cubo_ingresos=cubo_ingresos,
+                                        oss=oss, paises_email=paises_email)
+        
+        if args.año_completo:
+            resultado = resultado_año_completo(cubos, args.año, args.motor)
+        else:
+            resultado = resultado_trimestre(cubos, args.trimestre, args.año, args.motor)
+        if args.indice_cargos and cubos[None].cargos is not None:
+            cubos[None].cargos.guardar(args.indice_cargos)
+        if args.cubo:
+            cubo = cubos[None].cubo_ingresos or CuboIngresos()
+            cubo.guardar(args.cubo, meses_periodo(args.año, trimestres), MOTORES[args.motor].a_decimal)
+            print(f"📦 Cubo de ingresos: {len(cubo.celdas)} celda(s) en {args.cubo}", file=sys.stderr)
+        rectificaciones = sum(acc.num_rectificaciones for acc in cubos.values())
+        if rectificaciones:
+            sin_cargo = sum(acc.num_rect_sin_cargo for acc in cubos.values())
+            print(f"↩️  {rectificaciones} reembolso(s)/contracargo(s) como rectificaciones"
+                  + (f", {sin_cargo} sin su cargo (clasificados por su propio país)" if sin_cargo else ""),
+                  file=sys.stderr)
+        if oss is None:
+            a_decimal = MOTORES[args.motor].a_decimal
+            ventas_ue = sum(a_decimal(d['total']) for acc in cubos.values()
+                            for pais, d in acc.paises_ue.items() if es_oss(pais))
+            if ventas_ue > UMBRAL_OSS:
+                print(f"⚠️  Ventas a otros países de la UE: {ventas_ue:,.2f} EUR, más de {UMBRAL_OSS:,} EUR: "
+                      "lleva el IVA de cada país (ventanilla única, --oss)", file=sys.stderr)
+        if paises_email is not None:
+            completados = sum(acc.num_pais_email for acc in cubos.values())
+            print(f"📇 {completados} pago(s) sin país completado(s) por el email del cliente", file=sys.stderr)
+        cambios = resultado.get('cambios_de_trimestre')
+        if cambios:
+            print(f"🕐 {len(cambios)} pago(s) cambian de trimestre con la hora de Madrid "
+                  "(ver 'cambios_de_trimestre')", file=sys.stderr)
+        errores = cubos[None].errores
+        if errores.grupos:
+            print(f"⚠️  {errores.num_filas} fila(s) con error, no incluidas (ver 'errores')", file=sys.stderr)
+        if args.deduplicar:
+            if indice is not None:
+                duplicados, sin_clave = indice.duplicados, indice.sin_clave
+            resultado['duplicados_descartados'] = duplicados
+            avisar_duplicados(duplicados, sin_clave)
+        
+        if escritor:
+            escritor.cerrar(resultado)
+            if args.exportar:
+                salida_jsonl.close()
+                os.replace(salida_jsonl.name, args.exportar)
+                print(f"✅ Exportado a {args.exportar}", file=sys.stderr)
+        elif args.exportar:
+            with open(args.exportar, 'w', encoding='utf-8') as f:
+                volcar_json(resultado, f, args.compacto)
+            print(f"✅ Exportado a {args.exportar}", file=sys.stderr)
+        
+        if args.jsonl and not args.exportar:
+            pass  # Ya escrito en la salida estándar
+        elif args.json:
+            volcar_json(resultado, sys.stdout, args.compacto)
+        elif args.año_completo:
+            imprimir_resumen_anual(resultado)
+        else:
+            imprimir_reporte(resultado)
             
     except Exception as e:
         print(f"❌ Error: {e}", file=sys.stderr)
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if salida_jsonl is not None and salida_jsonl is not sys.stdout:
+            salida_jsonl.close()
+            if os.path.exists(salida_jsonl.name):
+                os.remove(salida_jsonl.name)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Salida JSON por partes para los scripts de gestor-autonomos.
+
+Los resultados grandes (detalle de pagos, libro de facturas) se escriben a
+medida que se procesan en lugar de montar el dict completo y volcarlo al
+final: la cabecera primero, luego los registros de detalle uno a uno y por
+último los totales.
+"""
+
+import json
+import tempfile
+from typing import Dict, IO, Iterator, Optional
+
+MAX_DIFERIDOS_MEMORIA = 8 << 20   # bytes; a partir de aquí van a disco
+
+class EscritorJSON:
+    """
+    Escribe un documento JSON o JSON Lines por partes.
+    
+    JSON: un objeto con las claves de cabecera, después una lista por sección
+    ({"ingresos": [...], "gastos": [...]}) y al final las claves del resumen.
+    Con indentación el resultado es el mismo que json.dump(..., indent=2).
+    Los registros de una sección tienen que ir seguidos.
+    
+    JSON Lines: una línea por objeto con la clave "registro": "cabecera",
+    el nombre de la sección o "resumen". Las secciones se pueden mezclar.
+    """
+    
+    def __init__(self, salida: IO[str], lineas: bool = False, compacto: bool = False):
+        self.salida = salida
+        self.lineas = lineas
+        self.indent = None if compacto or lineas else 2
+        self.separadores = (',', ':') if compacto else ((',', ': ') if self.indent else (', ', ': '))
+        self._abierto = False
+        self._seccion: Optional[str] = None
+        self._vacia = True
+        self._cerradas = set()
+    
+    def _json(self, valor, nivel: int = 0) -> str:
+        texto = json.dumps(valor, indent=self.indent, separators=self.separadores, ensure_ascii=False)
+        if self.indent and nivel:
+            texto = texto.replace('\n', '\n' + ' ' * (self.indent * nivel))
+        return texto
+    
+    def _linea(self, registro: str, datos: Dict):
+        self.salida.write(self._json({'registro': registro, **datos}))
+        self.salida.write('\n')
+    
+    def _salto(self, nivel: int) -> str:
+        return '\n' + ' ' * (self.indent * nivel) if self.indent else ''
+    
+    def _cerrar_seccion(self):
+        if self._seccion is not None:
+            self.salida.write(']' if self._vacia else self._salto(1) + ']')
+            self._cerradas.add(self._seccion)
+            self._seccion = None
+    
+    def _clave(self, clave: str) -> None:
+        self._cerrar_seccion()
+        self.salida.write(',' if self._abierto else '{')
+        self._abierto = True
+        self.salida.write(self._salto(1) + self._json(clave) + self.separadores[1])
+    
+    def cabecera(self, datos: Dict):
+        """Claves conocidas antes de procesar (periodo, archivo...)."""
+        if self.lineas:
+            self._linea('cabecera', datos)
+            return
+        for clave, valor in datos.items():
+            self._clave(clave)
+            self.salida.write(self._json(valor, 1))
+    
+    def abrir(self, seccion: str):
+        """Empieza la lista `seccion` (sale como [] aunque no tenga registros)."""
+        if self.lineas or seccion == self._seccion:
+            return
+        if seccion in self._cerradas:
+            raise ValueError(f"La sección '{seccion}' ya se ha cerrado")
+        self._clave(seccion)
+        self.salida.write('[')
+        self._seccion = seccion
+        self._vacia = True
+    
+    def registro(self, seccion: str, datos: Dict):
+        """Un registro de detalle de `seccion`."""
+        if self.lineas:
+            self._linea(seccion, datos)
+            return
+        self.abrir(seccion)
+        if not self._vacia:
+            self.salida.write(',')
+        self.salida.write(self._salto(2) + self._json(datos, 2))
+        self._vacia = False
+    
+    def cerrar(self, datos: Dict):
+        """Claves del resumen, que solo se conocen al terminar, y fin del documento."""
+        if self.lineas:
+            self._linea('resumen', datos)
+            return
+        for clave, valor in datos.items():
+            self._clave(clave)
+            self.salida.write(self._json(valor, 1))
+        self._cerrar_seccion()
+        self.salida.write(self._salto(0) + '}\n' if self._abierto else '{}\n')
+
+class RegistrosDiferidos:
+    """
+    Registros apartados en un temporal (en memoria hasta
+    MAX_DIFERIDOS_MEMORIA bytes, después en disco), una línea JSON compacta
+    por registro, para escribirlos cuando la entrada se ha leído entera.
+    
+    Así un error a mitad de lectura no deja un JSON cortado en la salida, y
+    las claves que dependen de todos los registros (totales) pueden ir antes
+    que la lista sin tener los registros en memoria.
+    """
+    
+    def __init__(self):
+        self._archivo = tempfile.SpooledTemporaryFile(MAX_DIFERIDOS_MEMORIA, mode='w+',
+                                                      encoding='utf-8', newline='\n')
+        self.num = 0
+    
+    def añadir(self, datos: Dict):
+        self._archivo.write(json.dumps(datos, separators=(',', ':'), ensure_ascii=False))
+        self._archivo.write('\n')
+        self.num += 1
+    
+    def __iter__(self) -> Iterator[Dict]:
+        self._archivo.seek(0)
+        for linea in self._archivo:
+            yield json.loads(linea)
+    
+    def cerrar(self):
+        self._archivo.close()
+    
+    def __enter__(self) -> 'RegistrosDiferidos':
+        return self
+    
+    def __exit__(self, *exc):
+        self.cerrar()
+
+def volcar_json(datos: Dict, salida: IO[str], compacto: bool = False):
+    """json.dump sin pasar por un str intermedio, con indentación o compacto."""
+    if compacto:
+        json.dump(datos, salida, separators=(',', ':'), ensure_ascii=False)
+    else:
+        json.dump(datos, salida, indent=2, ensure_ascii=False)
+    salida.write('\n')
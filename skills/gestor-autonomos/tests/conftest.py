@@ -0,0 +1,6 @@
+"""Los scripts se importan como módulos sueltos, igual que entre ellos."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
@@ -0,0 +1,65 @@
+"""Pruebas del cubo de ingresos que rellena procesar_stripe.py --cubo."""
+
+import pytest
+
+import procesar_stripe
+from cubo_ingresos import CuboIngresos, consultar, meses_periodo
+from procesar_stripe import MOTORES, acumular_filas, leer_filas_csv
+
+
+def escribir_csv(tmp_path, lineas, nombre='pagos.csv'):
+    ruta = tmp_path / nombre
+    ruta.write_text('\n'.join(lineas) + '\n', encoding='utf-8')
+    return str(ruta)
+
+
+def rellenar_cubo(ruta_csv, ruta_cubo, motor, trimestres=(1,)):
+    esquema, filas = leer_filas_csv(ruta_csv)
+    cubos = acumular_filas(filas, esquema, 2025, trimestres, detalle=False, motor=motor, cubo_ingresos=True)
+    cubo = cubos[None].cubo_ingresos or CuboIngresos()
+    cubo.guardar(ruta_cubo, meses_periodo(2025, trimestres), MOTORES[motor].a_decimal)
+    return cubos
+
+
+@pytest.fixture
+def pagos(tmp_path):
+    return escribir_csv(tmp_path, [
+        'id,Amount,Currency,Created (UTC),Customer Email,Stripe fee,country (billing)',
+        'ch_1,12.10,eur,2025-01-10 10:00:00,a@x.com,0.50,ES',
+        'ch_2,20.00,usd,2025-02-10 10:00:00,b@x.com,0.90,US',
+        'ch_3,24.20,eur,2025-02-11 10:00:00,c@x.com,1.00,ES',
+        'ch_1,-2.42,eur,2025-03-01 10:00:00,a@x.com,0.00,',
+        'ch_4,50.00,eur,2025-04-01 10:00:00,d@x.com,1.00,FR',
+    ])
+
+
+@pytest.mark.parametrize('motor', [m for m in MOTORES if m != 'numpy' or procesar_stripe.np is not None])
+def test_cubo_por_mes_y_pais(tmp_path, pagos, motor):
+    ruta = str(tmp_path / f'{motor}.sqlite')
+    cubos = rellenar_cubo(pagos, ruta, motor)
+
+    por_mes_pais = {(g['mes'], g['pais']): g for g in consultar(ruta, por=('mes', 'pais'))['grupos']}
+    assert set(por_mes_pais) == {('2025-01', 'ES'), ('2025-02', 'US'), ('2025-02', 'ES'), ('2025-03', 'ES')}
+    assert por_mes_pais['2025-02', 'ES']['bruto'] == '24.20'
+    assert por_mes_pais['2025-02', 'ES']['base'] == '20.00'
+    # El reembolso resta en marzo en la celda del país de su cargo
+    marzo = por_mes_pais['2025-03', 'ES']
+    assert (marzo['num_pagos'], marzo['num_rectificaciones'], marzo['bruto']) == (0, 1, '-2.42')
+
+    # El total del cubo cuadra con el resumen del trimestre
+    total = consultar(ruta, por=())['total']
+    resultado = procesar_stripe.resultado_trimestre(cubos, 1, 2025, motor)
+    assert total['num_pagos'] == resultado['resumen']['total_pagos']
+    assert total['fees'] == resultado['fees']['total']
+    assert consultar(ruta, por=('ue',), ue=False)['total']['bruto'] == '18.40'
+
+
+def test_cubo_sustituye_los_meses_del_periodo(tmp_path, pagos):
+    ruta = str(tmp_path / 'ingresos.sqlite')
+    rellenar_cubo(pagos, ruta, 'decimal')
+    rellenar_cubo(pagos, ruta, 'decimal')
+    rellenar_cubo(pagos, ruta, 'decimal', trimestres=(2,))
+    por_trimestre = {g['trimestre']: g for g in consultar(ruta, por=('trimestre',))['grupos']}
+    assert set(por_trimestre) == {'2025-T1', '2025-T2'}
+    assert por_trimestre['2025-T1']['num_pagos'] == 3
+    assert por_trimestre['2025-T2']['bruto'] == '50.00'
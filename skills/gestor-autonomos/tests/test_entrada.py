@@ -0,0 +1,67 @@
+"""Pruebas de la lectura de exportaciones comprimidas."""
+
+import bz2
+import gzip
+import lzma
+import zipfile
+
+import pytest
+
+import procesar_stripe
+from entrada import abrir_texto, tipo_compresion
+
+CSV = ('id,Amount,Currency,Created (UTC),country (billing)\n'
+       'ch_1,10.00,eur,2025-01-10 10:00:00,ES\n'
+       'ch_2,20.00,usd,2025-02-10 10:00:00,US\n')
+
+
+def comprimir(tmp_path, tipo):
+    """El CSV de prueba comprimido con `tipo`, con una extensión que no lo delata."""
+    ruta = tmp_path / f'pagos-{tipo}.csv'
+    datos = CSV.encode('utf-8')
+    if tipo == 'gzip':
+        ruta.write_bytes(gzip.compress(datos))
+    elif tipo == 'bzip2':
+        ruta.write_bytes(bz2.compress(datos))
+    elif tipo == 'xz':
+        ruta.write_bytes(lzma.compress(datos))
+    elif tipo == 'zip':
+        with zipfile.ZipFile(ruta, 'w') as z:
+            z.writestr('LEEME.txt', 'exportación de pagos')
+            z.writestr('pagos.csv', datos)
+    elif tipo == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+        ruta.write_bytes(zstandard.ZstdCompressor().compress(datos))
+    else:
+        ruta.write_bytes(datos)
+    return str(ruta)
+
+
+@pytest.mark.parametrize('tipo', ['gzip', 'zip', 'bzip2', 'xz', 'zstd', None])
+def test_compresion_por_firma_y_lectura_al_vuelo(tmp_path, tipo):
+    ruta = comprimir(tmp_path, tipo)
+    assert tipo_compresion(ruta) == tipo
+    with abrir_texto(ruta, newline='') as f:
+        assert f.read() == CSV
+
+
+@pytest.mark.parametrize('tipo', ['gzip', 'zip', 'zstd'])
+def test_csv_comprimido_mismas_cifras(tmp_path, tipo):
+    plano = comprimir(tmp_path, None)
+    ruta = comprimir(tmp_path, tipo)
+    resultados = []
+    for archivo in (plano, ruta):
+        esquema, filas = procesar_stripe.abrir_filas(archivo)
+        cubos = procesar_stripe.acumular_filas(filas, esquema, 2025, (1,))
+        resultados.append(procesar_stripe.resultado_trimestre(cubos, 1, 2025))
+    assert resultados[0] == resultados[1]
+    assert resultados[1]['resumen']['total_bruto_eur'] == '28.40'
+
+
+def test_zip_sin_csv_ni_json(tmp_path):
+    ruta = tmp_path / 'pagos.zip'
+    with zipfile.ZipFile(ruta, 'w') as z:
+        z.writestr('a.txt', 'a')
+        z.writestr('b.txt', 'b')
+    with pytest.raises(ValueError, match='ningún CSV'):
+        abrir_texto(str(ruta))
@@ -0,0 +1,614 @@
+"""Pruebas de procesar_stripe.py: motores de cálculo, lectura por trozos y descargas."""
+
+import http.client
+import http.server
+import io
+import json
+import mmap
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import zipfile
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import procesar_stripe
+from procesar_stripe import MOTORES, abrir_filas, acumular_filas, leer_filas_csv, resultado_trimestre
+
+
+def escribir_csv(tmp_path, lineas, nombre='pagos.csv'):
+    ruta = tmp_path / nombre
+    ruta.write_text('\n'.join(lineas) + '\n', encoding='utf-8')
+    return str(ruta)
+
+
+def procesar(ruta, motor, trimestre=1, año=2025):
+    esquema, filas = leer_filas_csv(ruta)
+    cubos = acumular_filas(filas, esquema, año, (trimestre,), detalle=False, motor=motor)
+    return resultado_trimestre(cubos, trimestre, año, motor)
+
+
+def motores():
+    """Los tres motores; numpy solo si está instalado."""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return [m for m in MOTORES if m != 'numpy']
+    return list(MOTORES)
+
+
+def test_importes_con_mas_de_6_decimales_igual_en_todos_los_motores(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'id,Amount,Currency,Created (UTC),Customer Email,Stripe fee,country (billing)',
+        'ch_1,10.1234567,eur,2025-02-01 10:00:00,a@x.com,0.3000001,ES',
+        'ch_2,60.00,usd,2025-02-02 10:00:00,b@x.com,0.50,US',
+        'ch_3,12.9999999,gbp,2025-03-03 10:00:00,c@x.com,0.50,FR',
+        'ch_4,-3.0000005,eur,2025-03-04 10:00:00,a@x.com,0,ES',
+    ])
+    resultados = {motor: procesar(ruta, motor) for motor in motores()}
+
+    referencia = resultados.pop('decimal')
+    assert referencia['resumen']['total_pagos'] == 3
+    assert not referencia['errores']
+    for motor, resultado in resultados.items():
+        assert resultado == referencia, motor
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_registros_json_con_claves_distintas(tmp_path, streaming):
+    ruta = tmp_path / 'pagos.json'
+    ruta.write_text(json.dumps([
+        {'amount': '10.00', 'date': '2025-02-01'},
+        {'amount': '100.00', 'currency': 'usd', 'date': '2025-02-02', 'country (billing)': 'US'},
+        {'Amount': '20.00', 'Currency': 'gbp', 'date': '2025-02-03', 'Country': 'GB', 'Stripe fee': '1.00'},
+    ]), encoding='utf-8')
+    for motor in motores():
+        esquema, filas = abrir_filas(str(ruta), 'json', streaming=streaming)
+        resultado = resultado_trimestre(acumular_filas(filas, esquema, 2025, (1,), detalle=False, motor=motor),
+                                        1, 2025, motor)
+        resumen = resultado['resumen']
+        assert resumen['sin_pais'] == {'cantidad': 1, 'total': '10.00'}, motor
+        assert resumen['no_ue'] == {'cantidad': 2, 'base_imponible': '115.40'}, motor
+        assert set(resultado['conversiones']) == {'USD', 'GBP'}, motor
+
+
+def test_filas_cortas_son_errores(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'id,Amount,Currency,Created (UTC),Customer Email,country (billing),Notas',
+        'ch_1,10.00,eur,2025-02-01 10:00:00,a@x.com,ES,',
+        'ch_2,20.00,eur,2025-02-02 10:00:00',
+        'ch_3,30.00,usd,2025-02-03 10:00:00,c@x.com,US',
+    ])
+    for motor in motores():
+        resultado = procesar(ruta, motor)
+        assert resultado['resumen']['total_pagos'] == 2, motor
+        assert resultado['resumen']['ue']['cantidad'] == 1, motor
+        [grupo] = resultado['errores']
+        assert grupo['count'] == 1
+        assert grupo['muestras'][0]['linea'] == 3
+        assert grupo['muestras'][0]['valor'].startswith('ch_2,20.00')
+
+
+def test_pagos_sin_fecha_en_su_sitio_del_detalle(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'email,date,currency,amount,country (billing)',
+        'a@x.com,02-Jan-25,eur,€10.00,ES',
+        'b@x.com,,eur,€20.00,ES',
+        'c@x.com,03-Jan-25,eur,€30.00,ES',
+    ])
+    esquema, filas = leer_filas_csv(ruta)
+    cubos = acumular_filas(filas, esquema, 2025, (1, 2))
+    for trimestre, emails in ((1, ['a@x.com', 'b@x.com', 'c@x.com']), (2, ['b@x.com'])):
+        resultado = resultado_trimestre(cubos, trimestre, 2025)
+        assert [p['email'] for p in resultado['detalle_ue']] == emails
+
+
+def test_reembolsos_se_restan_como_rectificaciones(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'id,Amount,Currency,Created (UTC),Customer Email,country (billing)',
+        'ch_1,10.00,eur,2025-02-01 10:00:00,a@x.com,ES',
+        'ch_1,10.00,eur,2025-02-01 10:00:00,a@x.com,ES',
+        'ch_1,-4.00,eur,2025-02-05 10:00:00,a@x.com,',
+        'ch_1,-4.00,eur,2025-02-05 10:00:00,a@x.com,',
+        'ch_1, -6.00 ,eur,2025-02-06 10:00:00,a@x.com,',
+        'ch_2,-0.00,eur,2025-02-07 10:00:00,b@x.com,ES',
+    ])
+    esquema, filas = leer_filas_csv(ruta)
+    indice = procesar_stripe.IndicePagos()
+    unicas = list(indice.filtrar(filas, esquema))
+    assert [fila[esquema.importe] for fila in unicas] == ['10.00', '-4.00', ' -6.00 ', '-0.00']
+    assert indice.duplicados == 2
+
+    for motor in motores():
+        esquema, filas = leer_filas_csv(ruta)
+        cubos = acumular_filas(procesar_stripe.IndicePagos().filtrar(filas, esquema), esquema, 2025, (1,),
+                               detalle=False, motor=motor)
+        resumen = resultado_trimestre(cubos, 1, 2025, motor)['resumen']
+        assert resumen['total_bruto_eur'] == '10.00', motor
+        assert resumen['rectificaciones']['cantidad'] == 2, motor
+        assert resumen['rectificaciones']['ue']['total'] == '-10.00', motor
+
+
+def test_importe_reembolsado_de_cargos_como_rectificaciones(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'id,Amount,Amount Refunded,Currency,Created (UTC),Customer Email,Card Country,Stripe fee',
+        'ch_1,10.00,4.00,eur,2025-02-01 10:00:00,a@x.com,ES,0.50',
+        'ch_2,20.00,0.00,usd,2025-02-02 10:00:00,b@x.com,US,0.90',
+        'ch_3,30.00,30.00,usd,2025-02-03 10:00:00,c@x.com,US,1.00',
+        'ch_4,12.10,,eur,2025-02-04 10:00:00,d@x.com,FR,0.40',
+    ])
+    for motor in motores():
+        resumen = procesar(ruta, motor)['resumen']
+        assert resumen['total_bruto_eur'] == '68.10', motor
+        rectificaciones = resumen['rectificaciones']
+        assert (rectificaciones['cantidad'], rectificaciones['sin_cargo_original']) == (2, 0), motor
+        assert rectificaciones['ue']['total'] == '-4.00', motor
+        assert rectificaciones['no_ue']['base_imponible'] == '-27.60', motor
+
+    esquema, filas = leer_filas_csv(escribir_csv(tmp_path, [
+        'id,Amount,Refunded,Currency,Created (UTC),country (billing)',
+        'ch_1,10.00,true,eur,2025-02-01 10:00:00,ES',
+        'ch_2,20.00,false,eur,2025-02-02 10:00:00,ES',
+    ], 'cargos.csv'))
+    resumen = resultado_trimestre(acumular_filas(filas, esquema, 2025, (1,)), 1, 2025)['resumen']
+    assert resumen['rectificaciones']['ue']['total'] == '-10.00'
+
+
+def test_deduplicar_exportaciones_solapadas(tmp_path):
+    cabecera = 'id,Amount,Currency,Created (UTC),Customer Email,country (billing)'
+    enero = escribir_csv(tmp_path, [cabecera,
+                                    'ch_1,10.00,eur,2025-01-10 10:00:00,a@x.com,ES',
+                                    'ch_2,20.00,eur,2025-01-31 10:00:00,b@x.com,ES'], 'enero.csv')
+    febrero = escribir_csv(tmp_path, [cabecera,
+                                      'ch_2,20.00,eur,2025-01-31 10:00:00,b@x.com,ES',
+                                      'ch_3,30.00,eur,2025-02-10 10:00:00,c@x.com,ES'], 'febrero.csv')
+    for motor in motores():
+        indice = procesar_stripe.IndicePagos()
+        cubos = procesar_stripe.consolidar_archivos([enero, febrero], 'csv', 2025, (1,), detalle=False,
+                                                    motor=motor, indice=indice)
+        resumen = resultado_trimestre(cubos, 1, 2025, motor)['resumen']
+        assert resumen['total_bruto_eur'] == '60.00', motor
+        assert indice.duplicados == 1, motor
+
+
+def test_deduplicar_sin_id_no_junta_compras_del_mismo_dia(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'email,date,currency,amount',
+        'a@x.com,02-Jan-25,eur,€10.00',
+        'a@x.com,02-Jan-25,eur,€10.00',
+        'a@x.com,2025-01-03 10:00:00,eur,€10.00',
+        'a@x.com,2025-01-03 11:00:00,eur,€10.00',
+        'a@x.com,2025-01-03 11:00:00,eur,€10.00',
+    ])
+    esquema, filas = leer_filas_csv(ruta)
+    indice = procesar_stripe.IndicePagos()
+    assert len(list(indice.filtrar(filas, esquema))) == 4
+    assert (indice.duplicados, indice.sin_clave) == (1, 2)
+
+    esquema, filas = leer_filas_csv(ruta)
+    indice = procesar_stripe.IndicePagos(por_dia=True)
+    assert len(list(indice.filtrar(filas, esquema))) == 3
+    assert (indice.duplicados, indice.sin_clave) == (2, 0)
+
+
+def test_incremental_solo_procesa_lo_añadido(tmp_path, capsys):
+    cabecera = 'id,Amount,Currency,Created (UTC),Customer Email,country (billing)'
+    primeras = [cabecera,
+                'ch_1,10.00,eur,2025-01-10 10:00:00,a@x.com,ES',
+                'ch_2,20.00,usd,2025-02-10 10:00:00,b@x.com,US']
+    añadidas = ['ch_3,30.00,eur,2025-03-10 10:00:00,c@x.com,FR',
+                'ch_2,-5.00,usd,2025-03-11 10:00:00,b@x.com,']
+    for motor in motores():
+        ruta = escribir_csv(tmp_path, primeras, f'{motor}.csv')
+        procesar_stripe.acumular_incremental(ruta, 2025, motor=motor)
+        with open(ruta, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(añadidas) + '\n')
+        capsys.readouterr()
+        cubos = procesar_stripe.acumular_incremental(ruta, 2025, motor=motor)
+        assert 'checkpoint válido' in capsys.readouterr().err, motor
+        # Mismas cifras que leyendo el archivo completo, con el reembolso vinculado a su cargo
+        assert resultado_trimestre(cubos, 1, 2025, motor) == procesar(ruta, motor), motor
+        assert cubos[1].num_rect_no_ue == 1 and cubos[1].num_rect_sin_cargo == 0, motor
+
+        # Un cambio en lo ya procesado invalida el checkpoint
+        contenido = open(ruta, encoding='utf-8').read()
+        with open(ruta, 'w', encoding='utf-8') as f:
+            f.write(contenido.replace('10.00,eur', '11.00,eur'))
+        cubos = procesar_stripe.acumular_incremental(ruta, 2025, motor=motor)
+        assert 'se procesa completo' in capsys.readouterr().err, motor
+        assert resultado_trimestre(cubos, 1, 2025, motor) == procesar(ruta, motor), motor
+
+
+@pytest.mark.parametrize('formato', ['parquet', 'arrow'])
+def test_parquet_y_arrow_solo_leen_las_columnas_usadas(tmp_path, formato):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+    import pyarrow.parquet
+    lineas = ['id,Amount,Currency,Created (UTC),Customer Email,Stripe fee,country (billing),Description',
+              'ch_1,10.00,eur,2025-01-10 10:00:00,a@x.com,0.50,ES,uno',
+              'ch_2,20.00,usd,2025-02-10 10:00:00,b@x.com,0.90,US,dos',
+              'ch_3,30.00,eur,2025-03-10 10:00:00,c@x.com,1.00,,tres',
+              'ch_2,-5.00,usd,2025-03-11 10:00:00,b@x.com,0.00,,cuatro']
+    nombres = lineas[0].split(',')
+    valores = list(zip(*(linea.split(',') for linea in lineas[1:])))
+    columnas = {nombre: pa.array([v or None for v in columna]) for nombre, columna in zip(nombres, valores)}
+    columnas['Metadata'] = pa.array([1, 2, 3, 4])
+    tabla = pa.table(columnas)
+    ruta = str(tmp_path / f'pagos.{formato}')
+    if formato == 'parquet':
+        pa.parquet.write_table(tabla, ruta)
+    else:
+        with pa.ipc.new_file(ruta, tabla.schema) as escritor:
+            escritor.write_table(tabla)
+
+    esquema, filas = procesar_stripe.abrir_filas(ruta, formato)
+    assert 'Description' not in filas.columnas and 'Metadata' not in filas.columnas
+    assert esquema.formato == 'stripe'
+    csv = escribir_csv(tmp_path, lineas)
+    for motor in motores():
+        esquema, filas = procesar_stripe.abrir_filas(ruta, formato)
+        cubos = acumular_filas(filas, esquema, 2025, (1,), detalle=False, motor=motor)
+        assert resultado_trimestre(cubos, 1, 2025, motor) == procesar(csv, motor), motor
+
+
+def test_oss_tipo_de_cada_pais_en_la_fecha_del_pago(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'id,Amount,Currency,Created (UTC),country (billing)',
+        'ch_1,11.90,eur,2025-07-10 10:00:00,DE',
+        'ch_2,12.20,eur,2025-06-30 10:00:00,EE',
+        'ch_3,12.40,eur,2025-07-02 10:00:00,EE',
+        'ch_4,12.10,eur,2025-07-03 10:00:00,ES',
+        'ch_1,-5.95,eur,2025-08-01 10:00:00,',
+    ])
+    tipos = escribir_csv(tmp_path, ['pais,desde,tipo', 'DE,2025-01-01,7'], 'tipos.csv')
+    for motor in motores():
+        esquema, filas = leer_filas_csv(ruta)
+        cubos = acumular_filas(filas, esquema, 2025, (2, 3), detalle=False, motor=motor,
+                               oss=procesar_stripe.TablaTiposIVA())
+        segundo, tercero = (resultado_trimestre(cubos, t, 2025, motor) for t in (2, 3))
+        # Estonia sube del 22 % al 24 % el 1 de julio de 2025
+        assert [(d['pais'], d['tipo'], d['cuota']) for d in segundo['oss']['desglose']] == [('EE', '22', '2.20')]
+        desglose = {d['pais']: d for d in tercero['oss']['desglose']}
+        assert (desglose['EE']['tipo'], desglose['EE']['base_imponible']) == ('24', '10.00'), motor
+        # El reembolso va al tipo alemán, el país de su cargo
+        assert desglose['DE']['rectificaciones'] == {'cantidad': 1, 'base_imponible': '-5.00', 'cuota': '-0.95'}
+        # España sigue en las casillas del 21 %, fuera de la OSS
+        assert tercero['modelo_303']['casilla_01_base_21'] == '10.00', motor
+        assert tercero['modelo_303']['casilla_123_oss'] == '15.00', motor
+
+        esquema, filas = leer_filas_csv(ruta)
+        cubos = acumular_filas(filas, esquema, 2025, (3,), detalle=False, motor=motor,
+                               oss=procesar_stripe.TablaTiposIVA(tipos))
+        alemania = resultado_trimestre(cubos, 3, 2025, motor)['oss']['desglose'][0]
+        assert (alemania['tipo'], alemania['base_imponible'], alemania['cuota']) == ('7', '11.12', '0.78'), motor
+
+    with pytest.raises(ValueError, match='línea 2'):
+        procesar_stripe.TablaTiposIVA(escribir_csv(tmp_path, ['pais,desde,tipo', 'ES,2025-01-01,21'], 'es.csv'))
+
+
+def test_clientes_completan_el_pais_por_email(tmp_path):
+    clientes = escribir_csv(tmp_path, [
+        'id,Email,Address Country,Card Address Country',
+        'cus_1,Ana@X.com,US,',
+        'cus_2,b@x.com,,FR',
+        'cus_3,c@x.com,GB,',
+        'cus_4,c@x.com,US,',
+        'cus_5,d@x.com,DE,',
+    ], 'clientes.csv')
+    paises = procesar_stripe.PaisesPorEmail.leer(clientes)
+    assert (paises.num, paises.ambiguos) == (4, 1)
+    assert [paises.pais(e) for e in (' ana@x.com', 'b@x.com', 'c@x.com', 'z@x.com', '')] == ['US', 'FR', None, None, None]
+
+    ruta = escribir_csv(tmp_path, [
+        'email,date,currency,amount,country',
+        'ana@x.com,02-Jan-25,eur,€10.00,',
+        'b@x.com,03-Jan-25,eur,€12.10,',
+        'c@x.com,04-Jan-25,eur,€12.10,',
+        'd@x.com,05-Jan-25,eur,€12.10,ES',
+    ])
+    for motor in motores():
+        esquema, filas = leer_filas_csv(ruta)
+        cubos = acumular_filas(filas, esquema, 2025, (1,), detalle=False, motor=motor, paises_email=paises)
+        resultado = resultado_trimestre(cubos, 1, 2025, motor)
+        assert resultado['resumen']['pais_por_email'] == {'cantidad': 2}, motor
+        # Ana pasa a exportación; c@x.com (dos países) sigue sin país; el país del pago manda
+        assert resultado['modelo_303']['casilla_60_exportaciones'] == '10.00', motor
+        assert set(resultado['paises']['ue']) == {'FR', 'ES', 'SIN_PAIS'}, motor
+
+    with pytest.raises(ValueError, match='columna de email'):
+        procesar_stripe.PaisesPorEmail.leer(escribir_csv(tmp_path, ['id,Country', 'cus_1,ES'], 'sin_email.csv'))
+
+
+def test_suscriptores_por_email(tmp_path):
+    ruta = escribir_csv(tmp_path, [
+        'id,Amount,Currency,Created (UTC),Customer Email,country (billing)',
+        'ch_1,10.00,eur,2025-01-10 10:00:00,A@x.com,ES',
+        'ch_2,10.00,eur,2025-04-10 10:00:00,a@x.com ,ES',
+        'ch_3,50.00,eur,2025-04-11 10:00:00,b@x.com,ES',
+        'ch_3,-20.00,eur,2025-05-01 10:00:00,b@x.com,',
+        'ch_4,5.00,eur,2024-12-20 10:00:00,c@x.com,ES',
+        'ch_5,5.00,eur,2025-02-20 10:00:00,c@x.com,ES',
+        'ch_5,5.00,eur,2025-02-20 10:00:00,c@x.com,ES',
+        'ch_6,7.00,eur,2025-03-01 10:00:00,,ES',
+        'ch_7,12.00,usd,2025-07-01 10:00:00,d@x.com,US',
+    ])
+    esquema, filas = leer_filas_csv(ruta)
+    suscriptores = procesar_stripe.Suscriptores(2025)
+    procesar_stripe.acumular_suscriptores(filas, esquema, 2025, suscriptores, indice=procesar_stripe.IndicePagos())
+    resultado = procesar_stripe.resultado_suscriptores(suscriptores, top=2)
+
+    # Un suscriptor por email en minúsculas; el repetido ch_5 cuenta una vez
+    assert (resultado['suscriptores'], resultado['recurrentes']) == (4, 2)
+    assert resultado['sin_email'] == {'cantidad': 1, 'total': '7.00'}
+    assert [t['ingresos'] for t in resultado['trimestres']] == ['15.00', '40.00', '11.04', '0.00']
+    # Recurrente en un trimestre: ya pagó en otro anterior del año (el cargo de 2024 de c@x.com no cuenta)
+    assert [(t['suscriptores_con_cargo'], t['recurrentes']) for t in resultado['trimestres']] == \
+        [(2, 0), (2, 1), (1, 0), (0, 0)]
+    # El reembolso resta de su suscriptor
+    assert [(s['email'], s['ingresos'], s['cargos']) for s in resultado['top']] == \
+        [('b@x.com', '30.00', 1), ('a@x.com', '20.00', 2)]
+    assert (resultado['top'][1]['primer_cargo'], resultado['top'][1]['ultimo_cargo']) == ('2025-01-10', '2025-04-10')
+
+
+@pytest.mark.parametrize('muestra', [[], ['', 'N/A'], ['02/01/2025', '03/01/2025']])
+def test_fechas_utc_en_madrid_aunque_no_se_detecte_formato_iso(muestra):
+    parsear = procesar_stripe.crear_parser_fechas(muestra, utc=True)
+    assert parsear('2025-03-31 22:30:00') == date(2025, 4, 1)
+    assert parsear('2025-03-31 21:30:00') == date(2025, 3, 31)
+    assert parsear('2025-01-01 12:00:00') == date(2025, 1, 1)
+    assert parsear.cambios == ['2025-03-31 22:30:00']
+    assert parsear.dia('2025-03-31 22:30:00') == '2025-04-01'
+
+
+@pytest.mark.parametrize('bloque', [3, 7, 1 << 20])
+def test_registros_hasta_no_cuenta_saltos_entre_comillas(tmp_path, monkeypatch, bloque):
+    monkeypatch.setattr(procesar_stripe, 'TAM_BLOQUE_COMILLAS', bloque)
+    contenido = b'id,nota\n1,"a\nb"\n2,"c ""x""\n\nd"\n3,e\n'
+    ruta = tmp_path / 'notas.csv'
+    ruta.write_bytes(contenido)
+    with open(ruta, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        registros = [procesar_stripe._registros_hasta(mm, contenido.index(marca)) for marca in (b'1,', b'2,', b'3,')]
+        assert registros == [1, 2, 3]
+        assert procesar_stripe._registros_hasta(mm, len(contenido)) == 4
+
+
+class ServidorTipos(http.server.BaseHTTPRequestHandler):
+    """
+    Sirve el zip de tipos con ETag; `cortes` peticiones se cierran sin
+    responder y `basura` reciben una respuesta que no es HTTP.
+    """
+    protocol_version = 'HTTP/1.1'
+    cuerpo = b''
+    etag = '"v1"'
+    cortes = 0
+    basura = 0
+    peticiones: list = []
+    conexiones: list = []
+
+    def setup(self):
+        super().setup()
+        self.conexiones.append(self.client_address)
+
+    def do_GET(self):
+        self.peticiones.append(dict(self.headers))
+        if ServidorTipos.cortes:
+            ServidorTipos.cortes -= 1
+            self.close_connection = True
+            return
+        if ServidorTipos.basura:
+            ServidorTipos.basura -= 1
+            self.wfile.write(b'esto no es HTTP\r\n\r\n')
+            return
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.cuerpo)))
+        self.end_headers()
+        self.wfile.write(self.cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servidor_tipos():
+    datos = io.BytesIO()
+    with zipfile.ZipFile(datos, 'w') as z:
+        z.writestr('eurofxref-hist.csv', 'Date,USD,GBP\n2025-01-02,1.0350,0.8290\n')
+    ServidorTipos.cuerpo = datos.getvalue()
+    ServidorTipos.cortes = 0
+    ServidorTipos.basura = 0
+    ServidorTipos.peticiones = []
+    ServidorTipos.conexiones = []
+    servidor = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ServidorTipos)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    yield f'http://127.0.0.1:{servidor.server_address[1]}/eurofxref-hist.zip'
+    servidor.shutdown()
+    servidor.server_close()
+
+
+def test_tipos_bce_200_y_despues_304_en_la_misma_conexion(tmp_path, servidor_tipos):
+    pool = procesar_stripe.PoolConexiones(timeout=5)
+    proveedor = procesar_stripe.ProveedorTiposBCE(servidor_tipos, str(tmp_path), caducidad=0, pool=pool)
+    ruta = proveedor.obtener()
+    with open(ruta, encoding='utf-8') as f:
+        assert f.read().startswith('Date,USD,GBP')
+    with open(proveedor.ruta_meta, encoding='utf-8') as f:
+        assert json.load(f)['etag'] == '"v1"'
+
+    assert proveedor.obtener() == ruta
+    assert [p.get('If-None-Match') for p in ServidorTipos.peticiones] == [None, '"v1"']
+    assert len(ServidorTipos.conexiones) == 1
+    with open(proveedor.ruta_meta, encoding='utf-8') as f:
+        assert json.load(f)['etag'] == '"v1"'
+    pool.cerrar()
+
+
+def test_tipos_bce_sin_caducar_no_conecta(tmp_path, servidor_tipos):
+    proveedor = procesar_stripe.ProveedorTiposBCE(servidor_tipos, str(tmp_path))
+    ruta = proveedor.obtener()
+    otro = procesar_stripe.ProveedorTiposBCE(servidor_tipos, str(tmp_path))
+    assert otro.obtener() == ruta
+    assert len(ServidorTipos.peticiones) == 1
+    assert otro.pool.peticiones == 0
+
+
+def test_tipos_bce_conexion_cortada(tmp_path, servidor_tipos):
+    pool = procesar_stripe.PoolConexiones(timeout=5)
+    proveedor = procesar_stripe.ProveedorTiposBCE(servidor_tipos, str(tmp_path), caducidad=0, pool=pool)
+    ServidorTipos.cortes = 1
+    ruta = proveedor.obtener()
+    assert pool.peticiones == 1
+    assert len(ServidorTipos.peticiones) == 2
+    assert len(ServidorTipos.conexiones) == 2
+
+    # Dos cortes seguidos agotan el reintento: se sirve la copia en caché
+    ServidorTipos.cortes = 2
+    assert proveedor.obtener() == ruta
+    with open(ruta, encoding='utf-8') as f:
+        assert f.read().startswith('Date,USD,GBP')
+    pool.cerrar()
+
+
+class PoolFalso:
+    """Hace de PoolConexiones para ClienteStripe: respuestas preparadas por petición."""
+
+    def __init__(self, responder):
+        self.responder = responder
+        self.peticiones = 0
+        self.urls = []
+
+    def get(self, url, cabeceras=None):
+        self.peticiones += 1
+        self.urls.append(url)
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+        return self.responder(params)
+
+    def cerrar(self):
+        pass
+
+
+def pagina(cargos, has_more=False):
+    return 200, {}, json.dumps({'data': cargos, 'has_more': has_more}).encode()
+
+
+def cliente_falso(tmp_path, responder, **opciones):
+    pools, esperas = [], []
+
+    def crear_pool():
+        pools.append(PoolFalso(responder))
+        return pools[-1]
+
+    cliente = procesar_stripe.ClienteStripe('sk_test_1', dir_cache=str(tmp_path), crear_pool=crear_pool,
+                                            esperar=esperas.append, **opciones)
+    return cliente, pools, esperas
+
+
+DESDE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_stripe_reintenta_429_y_5xx(tmp_path):
+    respuestas = iter([(429, {'retry-after': '2'}, b''), (503, {}, b''), pagina([{'id': 'ch_1'}])])
+    cliente, pools, esperas = cliente_falso(tmp_path, lambda params: next(respuestas))
+    assert [c['id'] for c in cliente.cargos(DESDE, DESDE + timedelta(days=1))] == ['ch_1']
+    assert cliente.peticiones == 3
+    assert esperas == [2.0, 1.0]
+
+
+def test_stripe_se_rinde_tras_max_reintentos(tmp_path):
+    cliente, pools, esperas = cliente_falso(tmp_path, lambda params: (500, {}, b''))
+    with pytest.raises(RuntimeError, match='intentos'):
+        list(cliente.cargos(DESDE, DESDE + timedelta(days=1)))
+    assert cliente.peticiones == procesar_stripe.MAX_REINTENTOS_HTTP
+    assert esperas == [0.5, 1.0, 2.0, 4.0, 8.0]
+
+
+def test_stripe_error_4xx_sin_reintentar(tmp_path):
+    cuerpo = json.dumps({'error': {'message': 'Invalid API Key'}}).encode()
+    cliente, pools, esperas = cliente_falso(tmp_path, lambda params: (401, {}, cuerpo))
+    with pytest.raises(RuntimeError, match='Invalid API Key'):
+        list(cliente.cargos(DESDE, DESDE + timedelta(days=1)))
+    assert cliente.peticiones == 1
+    assert not esperas
+
+
+def cargos_por_semana(params):
+    """Dos páginas por tramo semanal; los tramos más tardíos responden antes."""
+    semana = (int(params['created[gte]']) - int(DESDE.timestamp())) // (7 * 86400)
+    time.sleep(0.02 * (3 - semana))
+    if 'starting_after' not in params:
+        return pagina([{'id': f's{semana}_0'}, {'id': f's{semana}_1'}], has_more=True)
+    assert params['starting_after'] == f's{semana}_1'
+    return pagina([{'id': f's{semana}_2'}])
+
+
+def test_stripe_tramos_semanales_en_orden(tmp_path):
+    cliente, pools, esperas = cliente_falso(tmp_path, cargos_por_semana, conexiones=3)
+    ids = [c['id'] for c in cliente.cargos(DESDE, DESDE + timedelta(days=21))]
+    assert ids == [f's{semana}_{i}' for semana in range(3) for i in range(3)]
+    assert cliente.peticiones == 6
+    assert len(pools) == 3
+
+
+def test_stripe_cache_de_paginas(tmp_path):
+    cliente, pools, esperas = cliente_falso(tmp_path, cargos_por_semana)
+    hasta = DESDE + timedelta(days=14)
+    ids = [c['id'] for c in cliente.cargos(DESDE, hasta)]
+    assert cliente.peticiones == 4
+
+    # Los tramos cerrados se sirven de la caché, sin red
+    otro, pools, esperas = cliente_falso(tmp_path, cargos_por_semana, offline=True)
+    assert [c['id'] for c in otro.cargos(DESDE, hasta)] == ids
+    assert (otro.peticiones, otro.paginas_cache) == (0, 4)
+
+    # Otra clave de API no comparte la caché
+    ajeno = procesar_stripe.ClienteStripe('sk_test_2', dir_cache=str(tmp_path), offline=True)
+    with pytest.raises(RuntimeError, match='offline'):
+        list(ajeno.cargos(DESDE, hasta))
+
+
+def test_stripe_tramo_abierto_no_se_guarda(tmp_path):
+    ahora = datetime.now(timezone.utc)
+    cliente, pools, esperas = cliente_falso(tmp_path, lambda params: pagina([{'id': 'ch_1'}]))
+    list(cliente.cargos(ahora - timedelta(days=1), ahora + timedelta(days=1)))
+    list(cliente.cargos(ahora - timedelta(days=1), ahora + timedelta(days=1)))
+    assert (cliente.peticiones, cliente.paginas_cache) == (2, 0)
+
+
+def test_pool_descarta_la_conexion_tras_un_error(servidor_tipos):
+    pool = procesar_stripe.PoolConexiones(timeout=5)
+    ServidorTipos.basura = 1
+    with pytest.raises(http.client.HTTPException):
+        pool.get(servidor_tipos)
+    estado, cabeceras, cuerpo = pool.get(servidor_tipos)
+    assert estado == 200 and cuerpo == ServidorTipos.cuerpo
+    assert len(ServidorTipos.conexiones) == 2
+    pool.cerrar()
+
+
+def test_jsonl_exportar_no_pisa_el_archivo_si_falla(tmp_path):
+    script = os.path.join(os.path.dirname(procesar_stripe.__file__), 'procesar_stripe.py')
+    destino = tmp_path / 'pagos.jsonl'
+    destino.write_text('anterior\n', encoding='utf-8')
+    orden = [sys.executable, script, '--año', '2025', '--trimestre', '1', '--jsonl', '--exportar', str(destino)]
+
+    fallo = subprocess.run(orden + ['--archivo', str(tmp_path / 'no-existe.csv')], capture_output=True)
+    assert fallo.returncode == 1
+    assert destino.read_text(encoding='utf-8') == 'anterior\n'
+    assert os.listdir(tmp_path) == ['pagos.jsonl']
+
+    ruta = escribir_csv(tmp_path, ['id,Amount,Currency,Created (UTC),country (billing)',
+                                   'ch_1,10.00,eur,2025-02-01 10:00:00,ES'])
+    subprocess.run(orden + ['--archivo', ruta], capture_output=True, check=True)
+    registros = [json.loads(linea)['registro'] for linea in destino.read_text(encoding='utf-8').splitlines()]
+    assert registros == ['cabecera', 'detalle_ue', 'resumen']
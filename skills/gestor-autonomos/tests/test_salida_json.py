@@ -0,0 +1,40 @@
+"""Pruebas de la salida JSON por partes de los scripts de facturas."""
+
+import io
+import json
+
+import pytest
+
+from generar_libro import escribir_libro_json, iterar_libro
+from procesar_facturas import escribir_csv_json, procesar_csv
+
+
+def escribir_facturas(tmp_path, filas, nombre='facturas.csv'):
+    ruta = tmp_path / nombre
+    ruta.write_text('\n'.join(['numero,fecha,nif,concepto,base_imponible,tipo_iva,tipo_retencion'] + filas) + '\n',
+                    encoding='utf-8')
+    return str(ruta)
+
+
+def test_facturas_json_mismas_claves_y_orden_que_procesar_csv(tmp_path):
+    ruta = escribir_facturas(tmp_path, [
+        'F1,2025-01-15,12345678Z,Diseño,100.50,21,15',
+        'F2,2025-01-20,12345678Z,Error,abc,21,0',
+        'F3,2025-02-01,B12345678,Web,250,21,0',
+    ])
+    salida = io.StringIO()
+    assert escribir_csv_json(ruta, 'emitidas', salida) is None
+    escrito = json.loads(salida.getvalue())
+    esperado = procesar_csv(ruta, 'emitidas')
+    del escrito['fecha_proceso'], esperado['fecha_proceso']
+    assert list(escrito) == list(esperado)
+    assert escrito == esperado
+
+
+def test_libro_json_sin_salida_si_falla_una_factura(tmp_path):
+    ruta = escribir_facturas(tmp_path, ['F1,2025-01-15,12345678Z,Diseño,100.50,21,15',
+                                        'F2,2025-01-20,12345678Z,Error,abc,21,0'])
+    salida = io.StringIO()
+    with pytest.raises(Exception):
+        escribir_libro_json(1, 2025, iterar_libro(ruta), salida)
+    assert salida.getvalue() == ''